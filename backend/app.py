@@ -1,16 +1,28 @@
 import os
+import json
+import time
+from datetime import datetime
 from pathlib import Path
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
 
 from preprocess import preprocess_gtfs
-from gtfs_repo import GTFSRepository
+from gtfs_repo import GTFSRepository, parse_hhmmss_to_minutes, parse_hhmmss_to_seconds
 from planner import MultiModalPlanner
+from departures import DepartureIndex
+from vehicles import VehicleIndex
+from dataset import Dataset, DatasetStore, PreprocessJobs, dataset_version, process_lock
+from slices import SliceIndex, build_slices, slices_fresh
+from shapes import DAY_LEVEL, ShapeSegments, decode_polyline
+from plan_cache import PlanCache
+from plan_pool import Overloaded, PlanDispatcher
+import metrics
 
 BASE_DIR = Path(__file__).resolve().parent
 IN_DIR = BASE_DIR / "resources"        
 OUT_DIR = BASE_DIR / "gtfs-out"      
 FRONTEND_DIR = BASE_DIR.parent / "frontend"
+PREPROCESS_LOCK = OUT_DIR / ".preprocess.lock"
 
 REQUIRED_GTFS_FILES = {
     "routes.txt",
@@ -21,11 +33,47 @@ REQUIRED_GTFS_FILES = {
     "calendar_dates.txt"
 }
 
+# cache connessioni per data: dimensione LRU e giorni da precalcolare all'avvio
+CONN_CACHE_SIZE = int(os.environ.get("ORAORA_CONN_CACHE_SIZE", "16"))
+PREWARM_DAYS = int(os.environ.get("ORAORA_PREWARM_DAYS", "0"))
+PREWARM_START = os.environ.get("ORAORA_PREWARM_START")  # YYYYMMDD, default oggi
+# minuti minimi di cambio; ORAORA_TRANSFER_TIMES punta a un JSON {stop_id: minuti}
+MIN_TRANSFER = int(os.environ.get("ORAORA_MIN_TRANSFER", "0"))
+TRANSFER_TIMES_FILE = os.environ.get("ORAORA_TRANSFER_TIMES")
+# processi per /plan/batch (0 = tutto nel processo del server)
+BATCH_WORKERS = int(os.environ.get("ORAORA_BATCH_WORKERS", "0"))
+# carica gtfs-out/dataset.bin (mmap) invece dei JSON quando è presente e aggiornato
+USE_SNAPSHOT = os.environ.get("ORAORA_USE_SNAPSHOT", "1") != "0"
+# preprocess in streaming (stop_times/shapes a blocchi) per feed più grandi della memoria
+STREAMING_PREPROCESS = os.environ.get("ORAORA_STREAMING_PREPROCESS", "0") == "1"
+# max-age delle fette /data/day chieste con ?v=<versione corrente> (il contenuto non cambia più)
+DATA_MAX_AGE = int(os.environ.get("ORAORA_DATA_MAX_AGE", str(365 * 24 * 3600)))
+# cache dei risultati di /plan: risultati massimi (0 = disattivata), durata in secondi e
+# ampiezza in minuti delle fasce di depart_after che condividono le voci
+PLAN_CACHE_SIZE = int(os.environ.get("ORAORA_PLAN_CACHE_SIZE", "2048"))
+PLAN_CACHE_TTL = float(os.environ.get("ORAORA_PLAN_CACHE_TTL", "600"))
+PLAN_CACHE_BUCKET = int(os.environ.get("ORAORA_PLAN_CACHE_BUCKET", "15"))
+# processi che calcolano /plan fuori dal server (0 = nel thread della richiesta) e calcoli
+# distinti in coda oltre i quali /plan risponde 503
+PLAN_WORKERS = int(os.environ.get("ORAORA_PLAN_WORKERS", "0"))
+PLAN_QUEUE_LIMIT = int(os.environ.get("ORAORA_PLAN_QUEUE_LIMIT", "64"))
+# con più worker: ogni quanti secondi controllare se un altro processo ha rigenerato gtfs-out/ (0 = mai)
+RELOAD_CHECK = float(os.environ.get("ORAORA_RELOAD_CHECK", "2"))
+# risultati massimi per pagina di /departures e /trips
+MAX_PAGE_SIZE = int(os.environ.get("ORAORA_MAX_PAGE_SIZE", "200"))
+# server di sviluppo (python app.py); in produzione gunicorn -c gunicorn.conf.py wsgi:app
+DEBUG = os.environ.get("ORAORA_DEBUG", "0") == "1"
+
 app = Flask(__name__, static_folder=None)
 CORS(app)
 
-repo = GTFSRepository(str(OUT_DIR))
-planner = None
+# dataset corrente (repository + planner), sostituito in blocco a ogni ricaricamento
+store = DatasetStore()
+# fette precompresse per il frontend in gtfs-out/slices/
+slice_index = SliceIndex(OUT_DIR)
+shape_segments = ShapeSegments(slice_index)
+# risultati di /plan, svuotata a ogni nuovo dataset
+plan_cache = PlanCache(PLAN_CACHE_SIZE, PLAN_CACHE_TTL, PLAN_CACHE_BUCKET)
 
 def gtfs_present(in_dir: Path) -> bool:
     if not in_dir.exists():
@@ -33,81 +81,483 @@ def gtfs_present(in_dir: Path) -> bool:
     files = {p.name for p in in_dir.iterdir() if p.is_file()}
     return REQUIRED_GTFS_FILES.issubset(files)
 
+def load_transfer_times() -> dict:
+    if not TRANSFER_TIMES_FILE:
+        return {}
+    with open(TRANSFER_TIMES_FILE, 'r', encoding='utf-8') as f:
+        return {str(k): int(v) for k, v in json.load(f).items()}
+
+def make_planner(repo: GTFSRepository) -> MultiModalPlanner:
+    p = MultiModalPlanner(repo, cache_size=CONN_CACHE_SIZE, min_transfer=MIN_TRANSFER,
+                          transfer_minutes=load_transfer_times())
+    if PREWARM_DAYS > 0:
+        warmed = p.prewarm(PREWARM_DAYS, start=PREWARM_START)
+        print(f"Connessioni precalcolate per {len(warmed)} giorni.")
+    return p
+
+# pool per /plan (con ORAORA_PLAN_WORKERS > 0): richieste identiche in corso condividono il calcolo
+dispatcher = PlanDispatcher(str(OUT_DIR), PLAN_WORKERS, max_pending=PLAN_QUEUE_LIMIT, cache_size=CONN_CACHE_SIZE,
+                            min_transfer=MIN_TRANSFER, transfer_minutes=load_transfer_times(),
+                            prewarm_days=PREWARM_DAYS, prewarm_start=PREWARM_START) if PLAN_WORKERS > 0 else None
+
+metrics.REGISTRY.callback("oraora_plan_cache_events_total", "Eventi della cache di /plan", "counter",
+                          lambda: {(k,): v for k, v in plan_cache.stats().items()
+                                   if k in ("hits", "misses", "expired", "evictions", "invalidations")}, ("event",))
+metrics.REGISTRY.callback("oraora_plan_cache_entries", "Risultati nella cache di /plan", "gauge",
+                          lambda: {(): plan_cache.stats()["entries"]})
+if dispatcher is not None:
+    metrics.REGISTRY.callback("oraora_plan_pool_events_total", "Calcoli del pool di /plan", "counter",
+                              lambda: {(k,): v for k, v in dispatcher.stats().items()
+                                       if k in ("computed", "coalesced", "rejected", "failed")}, ("event",))
+    metrics.REGISTRY.callback("oraora_plan_pool_pending", "Calcoli distinti in corso nel pool di /plan", "gauge",
+                              lambda: {(): dispatcher.stats()["pending"]})
+metrics.REGISTRY.callback("oraora_dataset_info", "Versione del dataset servito", "gauge",
+                          lambda: {(store.current.version,): 1} if store.current else {}, ("version",))
+
+def dataset_changed(dataset: Dataset):
+    """Dopo la pubblicazione di un nuovo dataset: via i risultati e i processi del vecchio."""
+    plan_cache.invalidate(dataset.version)
+    if dispatcher is not None:
+        dispatcher.reset(dataset.version)
+
+def build_dataset() -> Dataset:
+    """Repository, planner e indici nuovi da gtfs-out/, senza toccare quelli in uso."""
+    version = dataset_version(OUT_DIR)
+    repo = GTFSRepository(str(OUT_DIR), use_snapshot=USE_SNAPSHOT)
+    repo.load()
+    return Dataset(repo=repo, planner=make_planner(repo), departures=DepartureIndex(repo),
+                   vehicles=VehicleIndex(repo), version=version, loaded_at=datetime.now().isoformat())
+
+def run_preprocess(params: dict) -> dict:
+    """Job di /preprocess: preprocess su gtfs-out/, poi nuovo dataset pubblicato al posto del vecchio."""
+    # un solo preprocess alla volta anche tra worker diversi
+    with process_lock(PREPROCESS_LOCK, blocking=False):
+        stats = preprocess_gtfs(params["in_dir"], str(OUT_DIR),
+                                include_route_types=tuple(params["include_route_types"]),
+                                force=params["force"], streaming=params["streaming"])
+    current = store.current
+    if current is not None and current.version == dataset_version(OUT_DIR) and "snapshot" in stats["skipped"]:
+        return {"stats": stats, "dataset_version": current.version, "reloaded": False}
+    dataset = build_dataset()
+    store.publish(dataset)
+    dataset_changed(dataset)
+    return {"stats": stats, "dataset_version": dataset.version, "reloaded": True}
+
+jobs = PreprocessJobs(run_preprocess)
+
 def auto_bootstrap():
     """
     Default:
-      - se NON esiste gtfs-out/timetable.json (test a caso - tanto devono esserci tutti per farlo funzionare)
-      - e in resources/ ci sono i GTFS
-      => preprocess automatico su gtfs-out/
+      - se in resources/ ci sono i GTFS => preprocess incrementale su gtfs-out/
+        (con gli input invariati rispetto a gtfs-out/manifest.json non riscrive nulla)
+      - altrimenti si usano i JSON già presenti in gtfs-out/, se ci sono
     """
     os.makedirs(OUT_DIR, exist_ok=True)
     timetable_json = OUT_DIR / "timetable.json"
 
-    if not timetable_json.exists():
-        if gtfs_present(IN_DIR):
-            print(f"Preprocess automatico: {IN_DIR} -> {OUT_DIR}")
-            preprocess_gtfs(str(IN_DIR), str(OUT_DIR), include_route_types=(2, 3))
-        else:
-            print(f"Nessun JSON e GTFS non trovati in {IN_DIR}. Metti i file GTFS in resources/ o chiama /preprocess.")
+    if gtfs_present(IN_DIR):
+        # senza preload_app ogni worker passa di qui: il primo fa il preprocess, gli altri
+        # aspettano il lock e trovano tutto aggiornato
+        with process_lock(PREPROCESS_LOCK):
+            stats = preprocess_gtfs(str(IN_DIR), str(OUT_DIR), include_route_types=(2, 3),
+                                    streaming=STREAMING_PREPROCESS)
+        print(f"Preprocess incrementale: {IN_DIR} -> {OUT_DIR} (stage saltati: {', '.join(stats['skipped']) or 'nessuno'})")
+    elif not timetable_json.exists():
+        print(f"Nessun JSON e GTFS non trovati in {IN_DIR}. Metti i file GTFS in resources/ o chiama /preprocess.")
 
     if timetable_json.exists():
-        repo.load()
-        global planner
-        planner = MultiModalPlanner(repo)
+        dataset = build_dataset()
+        store.publish(dataset)
+        dataset_changed(dataset)
         print("Repository caricato.")
+        if not slices_fresh(OUT_DIR, dataset.version):
+            # gtfs-out/ prodotto senza fette (es. senza resources/): si generano dal dataset caricato
+            build_slices(OUT_DIR, dataset.version, repo=dataset.repo)
     else:
         print("Nessun dataset caricato. Chiama /preprocess appena hai i GTFS.")
 
 auto_bootstrap()
 
-def ensure_loaded():
-    global planner
-    if not repo.routes:
-        repo.load()
-    if planner is None:
-        planner = MultiModalPlanner(repo)
+def ensure_loaded() -> Dataset:
+    """Dataset corrente: va preso una volta per richiesta e usato fino alla risposta."""
+    dataset = store.load_once(build_dataset)
+    if RELOAD_CHECK > 0:
+        dataset, reloaded = store.reload_if_changed(OUT_DIR, build_dataset, RELOAD_CHECK)
+        if reloaded:
+            dataset_changed(dataset)
+    return dataset
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_request(resp):
+    started = g.get("started")
+    if started is not None:
+        metrics.observe_request(request.endpoint, request.method, resp.status_code, time.perf_counter() - started)
+    return resp
 
 @app.route("/health")
 def health():
     return jsonify({"ok": True})
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Metriche Prometheus: latenze per endpoint e per solver, fasi del planner, cache."""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/preprocess", methods=["POST"])
 def do_preprocess():
     """
     Se non viene passato 'in_dir', userà automaticamente backend/resources
     e salverà in backend/gtfs-out.
+    Il preprocess gira in background (202 + stato del job, 409 se ce n'è già uno attivo);
+    a fine job il nuovo dataset sostituisce il vecchio. Con "wait": true risponde a job finito.
     """
     body = request.get_json(force=True, silent=True) or {}
     in_dir = body.get("in_dir") or str(IN_DIR)
     include_types = body.get("include_route_types", [2, 3])
+    force = bool(body.get("force", False))  # ignora il manifest e ricostruisce tutto
+    streaming = bool(body.get("streaming", STREAMING_PREPROCESS))
 
     if not gtfs_present(Path(in_dir)):
         return jsonify({"error": f"I file GTFS richiesti non sono presenti in {in_dir}"}), 400
 
-    stats = preprocess_gtfs(in_dir, str(OUT_DIR), include_route_types=tuple(include_types))
-    repo.load()
-    global planner
-    planner = MultiModalPlanner(repo)
-    return jsonify({"ok": True, "stats": stats, "out_dir": str(OUT_DIR)})
+    job, started = jobs.submit({"in_dir": in_dir, "include_route_types": list(include_types),
+                                "force": force, "streaming": streaming})
+    if not started:
+        return jsonify({"ok": False, "error": "preprocess già in corso", "job": job}), 409
+    if body.get("wait"):
+        job = jobs.wait(job["id"])
+        if job["state"] == "failed":
+            return jsonify({"ok": False, "error": job["error"], "job": job}), 500
+        return jsonify({"ok": True, "stats": job["result"]["stats"], "out_dir": str(OUT_DIR), "job": job})
+    return jsonify({"ok": True, "job": job, "status_url": f"/preprocess/status/{job['id']}"}), 202
+
+@app.route("/preprocess/status", methods=["GET"])
+@app.route("/preprocess/status/<string:job_id>", methods=["GET"])
+def preprocess_status(job_id=None):
+    """Stato di un job di preprocess (l'ultimo se non si indica l'id) e versione del dataset servito."""
+    job = jobs.status(job_id)
+    if job is None and job_id is not None:
+        return jsonify({"error": f"job {job_id} non trovato"}), 404
+    current = store.current
+    return jsonify({
+        "job": job,
+        "dataset": {"version": current.version, "loaded_at": current.loaded_at} if current else None
+    })
 
 @app.route("/data/<string:fname>.json", methods=["GET"])
 def get_json(fname):
     return send_from_directory(str(OUT_DIR), f"{fname}.json")
 
+def send_slice(entry, immutable: bool):
+    """
+    File di gtfs-out/slices/ nella variante precompressa accettata dal client, con ETag e
+    Last-Modified della versione del dataset (If-None-Match / If-Modified-Since -> 304).
+    """
+    path, etag, last_modified = entry
+    path, encoding = slice_index.variant(path, request.accept_encodings)
+    resp = send_file(path, mimetype="application/json", conditional=False, etag=False)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+        etag = f"{etag}-{encoding}"
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    if immutable:
+        resp.headers["Cache-Control"] = f"public, max-age={DATA_MAX_AGE}, immutable"
+    else:
+        resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+@app.route("/data/catalog", methods=["GET"])
+def data_catalog():
+    """Linee, fermate, date e sequenze di fermate per linea: quanto serve al primo caricamento."""
+    entry = slice_index.catalog()
+    if entry is None:
+        return jsonify({"error": "dataset non ancora preprocessato"}), 503
+    # sempre rivalidato: è il catalogo a dire al client la versione corrente
+    return send_slice(entry, immutable=False)
+
+@app.route("/data/day/<string:date>", methods=["GET"])
+def data_day(date):
+    """
+    Trip attivi nella data (YYYYMMDD) e shape che usano. Con ?v=<versione del catalogo>
+    la risposta si può tenere in cache a lungo: a un nuovo dataset cambia l'URL.
+    """
+    if len(date) != 8 or not date.isdigit():
+        return jsonify({"error": "date deve essere YYYYMMDD"}), 400
+    entry = slice_index.day(date)
+    if entry is None:
+        if slice_index.version is None:
+            return jsonify({"error": "dataset non ancora preprocessato"}), 503
+        return jsonify({"error": f"nessun trip attivo il {date}"}), 404
+    return send_slice(entry, immutable=request.args.get("v") == slice_index.version)
+
+@app.route("/data/shape/<string:shape_id>/segment", methods=["GET"])
+def data_shape_segment(shape_id):
+    """
+    Tratto della shape tra due fermate: ?from=<stop_id>&to=<stop_id>[&level=full|high|mid|low]
+    [&format=coords]. Di default encoded polyline; con ?v=<versione> si tiene in cache come le fette.
+    """
+    origin, destination = request.args.get("from"), request.args.get("to")
+    if not origin or not destination:
+        return jsonify({"error": "from e to sono obbligatori"}), 400
+    try:
+        segment = shape_segments.segment(shape_id, origin, destination, request.args.get("level", DAY_LEVEL))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if segment is None:
+        if slice_index.shapes() is None:
+            return jsonify({"error": "dataset non ancora preprocessato"}), 503
+        return jsonify({"error": f"fermate {origin}, {destination} non trovate sulla shape {shape_id}"}), 404
+    if request.args.get("format") == "coords":
+        segment["coords"] = decode_polyline(segment.pop("polyline"))
+
+    _, etag, last_modified = slice_index.shapes()
+    resp = jsonify(segment)
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    if request.args.get("v") == segment["version"]:
+        resp.headers["Cache-Control"] = f"public, max-age={DATA_MAX_AGE}, immutable"
+    else:
+        resp.headers["Cache-Control"] = "no-cache"
+    return resp.make_conditional(request)
+
+def date_arg(date: str) -> str:
+    """Data di servizio YYYYMMDD; ValueError se non è una data del calendario."""
+    try:
+        if len(date) != 8 or not date.isdigit():
+            raise ValueError
+        datetime.strptime(date, "%Y%m%d")
+    except ValueError:
+        raise ValueError("date deve essere YYYYMMDD") from None
+    return date
+
+def board_args():
+    """date, after (minuti), offset e limit comuni a /departures e /trips; ValueError se non validi."""
+    date = date_arg(request.args.get("date", ""))
+    try:
+        after = parse_hhmmss_to_minutes(request.args.get("after", "00:00"))
+    except ValueError:
+        after = None
+    if after is None:
+        raise ValueError("after deve essere HH:MM")
+    try:
+        offset = int(request.args.get("offset", 0))
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        offset = limit = -1
+    if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"offset >= 0 e 0 < limit <= {MAX_PAGE_SIZE}")
+    return date, after, offset, limit
+
+def page_json(res: dict, key: str, offset: int, limit: int, **fields):
+    next_offset = offset + limit if offset + limit < res["total"] else None
+    return jsonify({**fields, "total": res["total"], "offset": offset, "limit": limit,
+                    "next_offset": next_offset, key: res["items"]})
+
+@app.route("/departures", methods=["GET"])
+def departures_endpoint():
+    """Prossime partenze da una fermata: ?stop=&date=YYYYMMDD[&after=HH:MM][&offset=&limit=]."""
+    dataset = ensure_loaded()
+    stop = request.args.get("stop")
+    try:
+        date, after, offset, limit = board_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not stop:
+        return jsonify({"error": "stop è obbligatorio"}), 400
+    res = dataset.departures.departures(stop, date, after, offset, limit)
+    if res is None:
+        return jsonify({"error": f"fermata {stop} sconosciuta"}), 404
+    return page_json(res, "departures", offset, limit, stop=stop, date=date, after=request.args.get("after", "00:00"))
+
+@app.route("/trips", methods=["GET"])
+def trips_endpoint():
+    """
+    Trip diretti tra due fermate: ?from=&to=&date=YYYYMMDD[&after=HH:MM][&route=][&offset=&limit=],
+    in ordine di partenza dall'origine.
+    """
+    dataset = ensure_loaded()
+    origin, destination = request.args.get("from"), request.args.get("to")
+    try:
+        date, after, offset, limit = board_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not origin or not destination:
+        return jsonify({"error": "from e to sono obbligatori"}), 400
+    res = dataset.departures.trips(origin, destination, date, after, offset, limit, route_id=request.args.get("route"))
+    if res is None:
+        return jsonify({"error": f"fermata {origin} o {destination} sconosciuta"}), 404
+    return page_json(res, "trips", offset, limit, **{"from": origin, "to": destination}, date=date,
+                     after=request.args.get("after", "00:00"))
+
+@app.route("/vehicles", methods=["GET"])
+def vehicles_endpoint():
+    """
+    Posizione interpolata di tutti i mezzi in circolazione: ?date=YYYYMMDD&time=HH:MM[:SS]
+    (senza parametri: adesso). Con un istante esplicito e ?v=<versione> la risposta non cambia più.
+    """
+    dataset = ensure_loaded()
+    now = datetime.now()
+    date = request.args.get("date", now.strftime("%Y%m%d"))
+    time_str = request.args.get("time", now.strftime("%H:%M:%S"))
+    try:
+        date_arg(date)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        seconds = parse_hhmmss_to_seconds(time_str)
+    except ValueError:
+        seconds = None
+    if seconds is None:
+        return jsonify({"error": "time deve essere HH:MM[:SS]"}), 400
+
+    res = dataset.vehicles.vehicles(date, seconds)
+    resp = jsonify({"version": dataset.version, "date": date, "time": time_str, **res})
+    if "time" in request.args and request.args.get("v") == dataset.version:
+        resp.headers["Cache-Control"] = f"public, max-age={DATA_MAX_AGE}, immutable"
+    else:
+        resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+def int_field(data: dict, name: str, minimum: int = 0):
+    """Campo intero facoltativo del body JSON (None se manca); ValueError se non è un intero >= minimum."""
+    value = data.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{name} deve essere un intero >= {minimum}")
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"{name} deve essere un intero >= {minimum}") from None
+    if value < minimum:
+        raise ValueError(f"{name} deve essere un intero >= {minimum}")
+    return value
+
+def time_field(data: dict, name: str, default: str) -> int:
+    """Orario HH:MM[:SS] del body JSON (default se manca), in minuti; ValueError se non valido."""
+    value = data.get(name, default)
+    try:
+        minutes = parse_hhmmss_to_minutes(value) if isinstance(value, str) else None
+    except ValueError:
+        minutes = None
+    if minutes is None:
+        raise ValueError(f"{name} deve essere HH:MM[:SS]")
+    return minutes
+
 @app.route("/plan", methods=["POST"])
 def plan_endpoint():
-    ensure_loaded()
+    dataset = ensure_loaded()
     data = request.get_json(force=True)
     origin = data.get("origin")
     destination = data.get("destination")
     date = data.get("date")
     optimize = data.get("optimize", "time")
     depart_after = data.get("depart_after", "00:00:00")
+    solver = data.get("solver")  # "csa" (default) | "raptor"
+    debug = bool(data.get("debug")) or request.args.get("debug") == "1"
+
+    if not origin or not destination or not date:
+        return jsonify({"found": False, "message": "origin, destination, date sono obbligatori"}), 400
+    try:
+        min_transfer = int_field(data, "min_transfer")
+    except ValueError as e:
+        return jsonify({"found": False, "message": str(e)}), 400
+
+    engine = dispatcher if dispatcher is not None else dataset.planner
+    started = time.perf_counter()
+    try:
+        # le fasi si misurano sempre (per /metrics); "debug" resta nella risposta solo se richiesto
+        res, hit = plan_cache.plan(engine, dataset.version, origin, destination, date, depart_after, optimize,
+                                   min_transfer=min_transfer, solver=solver, debug=True)
+    except Overloaded as e:
+        resp = jsonify({"found": False, "message": str(e)})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "1"
+        return resp
+    elapsed = time.perf_counter() - started
+    res = dict(res)
+    info = res.pop("debug", None)
+    metrics.observe_plan(info, res.get("scan"), hit, elapsed)
+    if debug:
+        # su un hit le fasi sono quelle del calcolo che ha riempito la cache
+        res["debug"] = dict(info or {}, cache="hit" if hit else "miss", request_seconds=round(elapsed, 6))
+    resp = jsonify(res)
+    resp.headers["X-Plan-Cache"] = "hit" if hit else "miss"
+    return resp
+
+@app.route("/plan/cache", methods=["GET"])
+def plan_cache_stats():
+    """Contatori della cache di /plan (hit, miss, scadute, espulse) e sua occupazione."""
+    return jsonify(plan_cache.stats())
+
+@app.route("/plan/pool", methods=["GET"])
+def plan_pool_stats():
+    """Pool di /plan: calcoli avviati, condivisi tra richieste identiche, rifiutati per coda piena."""
+    return jsonify(dispatcher.stats() if dispatcher is not None else {"workers": 0})
+
+@app.route("/plan/batch", methods=["POST"])
+def plan_batch_endpoint():
+    """
+    Body: {"requests": [{origin, destination, date, depart_after, optimize}, ...]}
+    Risposta: {"results": [...]} nello stesso ordine delle richieste.
+    """
+    planner = ensure_loaded().planner
+    data = request.get_json(force=True) or {}
+    reqs = data.get("requests")
+    if not isinstance(reqs, list):
+        return jsonify({"error": "requests deve essere una lista"}), 400
+
+    results = planner.plan_many(reqs, workers=BATCH_WORKERS)
+    return jsonify({"count": len(results), "results": results})
+
+@app.route("/plan/profile", methods=["POST"])
+def profile_endpoint():
+    """Tutte le partenze ottime tra depart_from e depart_until in una sola scansione."""
+    planner = ensure_loaded().planner
+    data = request.get_json(force=True)
+    origin = data.get("origin")
+    destination = data.get("destination")
+    date = data.get("date")
+    depart_from = data.get("depart_from", "00:00:00")
+    depart_until = data.get("depart_until", "23:59:59")
 
     if not origin or not destination or not date:
         return jsonify({"found": False, "message": "origin, destination, date sono obbligatori"}), 400
+    try:
+        min_transfer = int_field(data, "min_transfer")
+        if time_field(data, "depart_from", depart_from) > time_field(data, "depart_until", depart_until):
+            raise ValueError("depart_from deve essere <= depart_until")
+    except ValueError as e:
+        return jsonify({"found": False, "message": str(e)}), 400
+
+    res = planner.profile(origin, destination, date, depart_from, depart_until, min_transfer=min_transfer)
+    return jsonify(res)
+
+@app.route("/isochrone", methods=["POST"])
+def isochrone_endpoint():
+    """Arrivo migliore verso tutte le fermate da una origine, con cutoff opzionale."""
+    planner = ensure_loaded().planner
+    data = request.get_json(force=True)
+    origin = data.get("origin")
+    date = data.get("date")
+    depart_after = data.get("depart_after", "00:00:00")
+
+    if not origin or not date:
+        return jsonify({"found": False, "message": "origin, date sono obbligatori"}), 400
+    try:
+        max_minutes = int_field(data, "max_minutes")
+        min_transfer = int_field(data, "min_transfer")
+        time_field(data, "depart_after", depart_after)
+    except ValueError as e:
+        return jsonify({"found": False, "message": str(e)}), 400
 
-    res = planner.plan(origin, destination, date, depart_after, optimize)
+    res = planner.isochrone(origin, date, depart_after, max_minutes=max_minutes, min_transfer=min_transfer)
     return jsonify(res)
 
 # fa partire il fe
@@ -124,4 +574,4 @@ def static_proxy(path):
     return send_from_directory(str(FRONTEND_DIR), path)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=DEBUG)
@@ -0,0 +1,70 @@
+"""
+Tempi per stage di preprocess_gtfs sul feed incluso e su un feed sintetico
+ottenuto replicando trip, stop_times, shapes e calendar_dates `--scale` volte.
+Con --streaming usa l'ingestione a blocchi; --trace-memory misura anche il picco
+delle allocazioni con tracemalloc (molto più lento).
+
+    python benchmarks/bench_preprocess.py [--scale 100] [--streaming] [--trace-memory]
+"""
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from preprocess import preprocess_gtfs
+
+def scale_feed(src: Path, dst: Path, factor: int):
+    """Copia il feed replicando trip/shape/servizi con id suffissati."""
+    dst.mkdir(parents=True, exist_ok=True)
+    read = lambda name: pd.read_csv(src / name, dtype=str, keep_default_na=False)
+
+    def replicate(df, cols):
+        parts = []
+        for k in range(factor):
+            part = df.copy()
+            for c in cols:
+                part[c] = part[c] + f"~{k}"
+            parts.append(part)
+        return pd.concat(parts, ignore_index=True)
+
+    for name in ("routes.txt", "stops.txt"):
+        read(name).to_csv(dst / name, index=False)
+    replicate(read("trips.txt"), ["trip_id", "shape_id", "service_id"]).to_csv(dst / "trips.txt", index=False)
+    replicate(read("stop_times.txt"), ["trip_id"]).to_csv(dst / "stop_times.txt", index=False)
+    replicate(read("shapes.txt"), ["shape_id"]).to_csv(dst / "shapes.txt", index=False)
+    replicate(read("calendar_dates.txt"), ["service_id"]).to_csv(dst / "calendar_dates.txt", index=False)
+
+def run(label: str, in_dir: Path, out_dir: Path, streaming: bool = False, trace_memory: bool = False):
+    t0 = time.perf_counter()
+    stats = preprocess_gtfs(str(in_dir), str(out_dir), streaming=streaming, measure_memory=trace_memory)
+    total = time.perf_counter() - t0
+    print(f"\n{label}: {stats['trips']} trip, {stats['shapes']} shape, totale {total:.3f} s")
+    for stage, secs in stats["timings"].items():
+        print(f"  {stage:14s} {secs:8.3f} s")
+    for key in ("process_peak_rss_mb", "peak_memory_mb"):
+        if key in stats:
+            print(f"  {key:19s} {stats[key]:8.1f} MB")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--in-dir", default=str(BACKEND_DIR / "resources"))
+    ap.add_argument("--scale", type=int, default=100)
+    ap.add_argument("--streaming", action="store_true")
+    ap.add_argument("--trace-memory", action="store_true")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        run("feed incluso", Path(args.in_dir), tmp / "out", args.streaming, args.trace_memory)
+        if args.scale > 1:
+            scale_feed(Path(args.in_dir), tmp / "scaled", args.scale)
+            run(f"feed sintetico x{args.scale}", tmp / "scaled", tmp / "out-scaled", args.streaming, args.trace_memory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Confronto tra i solver per optimize='transfers' sul feed incluso (gtfs-out/).
+
+    python benchmarks/bench_solvers.py [--queries 500] [--seed 1]
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from gtfs_repo import GTFSRepository
+from planner import MultiModalPlanner
+
+DATES = ["20241216", "20250105", "20250301", "20250614"]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--queries", type=int, default=500)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out-dir", default=str(BACKEND_DIR / "gtfs-out"))
+    args = ap.parse_args()
+
+    repo = GTFSRepository(args.out_dir)
+    repo.load()
+    planner = MultiModalPlanner(repo)
+
+    rng = random.Random(args.seed)
+    stops = sorted(repo.stops)
+    queries = []
+    for _ in range(args.queries):
+        o, d = rng.sample(stops, 2)
+        queries.append((o, d, rng.choice(DATES), f"{rng.randint(4, 22):02d}:{rng.randint(0, 59):02d}:00"))
+
+    # connessioni e pattern già pronti: si misura solo la query
+    for date in DATES:
+        planner.raptor.day(planner.connections_for(date))
+
+    solvers = {
+        "csa-transfers": lambda q: planner.plan(*q, "transfers"),
+        "raptor": lambda q: planner.plan(*q, "transfers", solver="raptor"),
+    }
+    results = {}
+    for name, run in solvers.items():
+        times, answers = [], []
+        for q in queries:
+            t0 = time.perf_counter()
+            res = run(q)
+            times.append((time.perf_counter() - t0) * 1000)
+            answers.append((res["transfers"], res["total_minutes"]) if res["found"] else None)
+        results[name] = answers
+        print(f"{name:14s} mean {statistics.mean(times):7.3f} ms  p50 {percentile(times, 0.5):7.3f} ms  "
+              f"p95 {percentile(times, 0.95):7.3f} ms  found {sum(a is not None for a in answers)}/{len(queries)}")
+
+    same = fewer = other = 0
+    for a, b in zip(results["csa-transfers"], results["raptor"]):
+        if a == b:
+            same += 1
+        elif a and b and b < a:
+            fewer += 1
+        else:
+            other += 1
+    print(f"stesso risultato {same}, raptor migliore (cambi, minuti) {fewer}, altro {other}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Verifica delle profile query sul feed incluso (gtfs-out/): per finestre casuali, ogni
+partenza nella finestra che /plan trova (earliest arrival da ogni minuto della finestra)
+deve comparire nel profilo, e nessuna opzione del profilo può arrivare prima di /plan.
+
+    python benchmarks/check_profile.py [--windows 300] [--min-transfer 0] [--seed 1]
+"""
+import argparse
+import random
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from gtfs_repo import GTFSRepository, parse_hhmmss_to_minutes
+from planner import MultiModalPlanner, fmt_minutes
+
+def check_window(planner: MultiModalPlanner, o: str, d: str, date: str, dep_from: int, dep_to: int,
+                 min_transfer: int) -> list:
+    """Errori trovati nella finestra [dep_from, dep_to] (lista vuota se il profilo è corretto)."""
+    prof = planner.profile(o, d, date, fmt_minutes(dep_from), fmt_minutes(dep_to), min_transfer=min_transfer)
+    options = [(parse_hhmmss_to_minutes(opt["departure"]), parse_hhmmss_to_minutes(opt["arrival"]))
+               for opt in prof["options"]]
+    errors = []
+    t = dep_from
+    while t <= dep_to:
+        res = planner.plan(o, d, date, fmt_minutes(t) + ":00", "time", min_transfer=min_transfer)
+        if not res["found"]:
+            break
+        dep = parse_hhmmss_to_minutes(res["segments"][0]["departure"])
+        arr = parse_hhmmss_to_minutes(res["segments"][-1]["arrival"])
+        later = [a for dp, a in options if dp >= t]
+        if later and min(later) < arr:
+            errors.append(f"profilo arriva {fmt_minutes(min(later))} prima di /plan {fmt_minutes(arr)} da {fmt_minutes(t)}")
+        if dep <= dep_to and not any(t <= dp and a == arr for dp, a in options):
+            errors.append(f"partenza {fmt_minutes(dep)} -> {fmt_minutes(arr)} di /plan assente dal profilo")
+        # da qui fino alla partenza trovata la risposta di /plan non cambia
+        t = max(t, dep) + 1
+    return errors
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--windows", type=int, default=300)
+    ap.add_argument("--min-transfer", type=int, default=0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out-dir", default=str(BACKEND_DIR / "gtfs-out"))
+    args = ap.parse_args()
+
+    repo = GTFSRepository(args.out_dir)
+    repo.load()
+    planner = MultiModalPlanner(repo, cache_size=64)
+    rng = random.Random(args.seed)
+    stops = sorted(repo.stops)
+    dates = sorted(d for d, trips in repo.date_trips.items() if len(trips))
+
+    failed = 0
+    for _ in range(args.windows):
+        o, d = rng.sample(stops, 2)
+        date = rng.choice(dates)
+        dep_from = rng.randint(5 * 60, 20 * 60)
+        dep_to = dep_from + rng.randint(30, 240)
+        errors = check_window(planner, o, d, date, dep_from, dep_to, args.min_transfer)
+        if errors:
+            failed += 1
+            print(f"{o} -> {d} {date} {fmt_minutes(dep_from)}-{fmt_minutes(dep_to)}: {'; '.join(errors)}")
+    print(f"finestre con errori {failed}/{args.windows}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
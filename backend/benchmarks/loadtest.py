@@ -0,0 +1,180 @@
+"""
+Load test di /plan: avvia gunicorn (wsgi:app) con un numero crescente di worker e misura
+throughput e latenze p50/p99 con client concorrenti (processi separati, keep-alive).
+Con --url misura un server già avviato. La cache dei risultati è disattivata nei server
+avviati dallo script, salvo --cache: così si misura il planner e non la cache.
+
+    python benchmarks/loadtest.py [--workers 1,2,4] [--clients 8] [--duration 10] [--cache]
+    python benchmarks/loadtest.py --url http://127.0.0.1:5000
+
+Le variabili ORAORA_* dell'ambiente arrivano ai server avviati, per esempio
+ORAORA_THREADS=16 ORAORA_PLAN_WORKERS=4 per i thread gthread con il pool di /plan.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def get_json(url: str, path: str):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    conn.request("GET", path)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    if resp.status != 200:
+        raise RuntimeError(f"{path}: HTTP {resp.status}")
+    return json.loads(body)
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 180):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn terminato con codice {proc.returncode}")
+        try:
+            get_json(url, "/health")
+            return
+        except (OSError, RuntimeError):
+            time.sleep(0.5)
+    raise RuntimeError("server non pronto")
+
+def tree_pss_mb(pid: int):
+    """PSS totale (MB) del processo e dei figli: la memoria condivisa viene divisa tra chi la usa."""
+    procs = {pid}
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                stat = (entry / "stat").read_text()
+            except OSError:
+                continue
+            if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+                procs.add(int(entry.name))
+    total = 0
+    for p in procs:
+        try:
+            for line in Path(f"/proc/{p}/smaps_rollup").read_text().splitlines():
+                if line.startswith("Pss:"):
+                    total += int(line.split()[1])
+        except OSError:
+            return None
+    return round(total / 1024, 1)
+
+def make_queries(url: str, n: int, seed: int):
+    """Richieste /plan casuali su fermate e date del catalogo servito."""
+    catalog = get_json(url, "/data/catalog")
+    rng = random.Random(seed)
+    stops = sorted(catalog["stops"])
+    dates = catalog["dates"]
+    queries = []
+    for _ in range(n):
+        o, d = rng.sample(stops, 2)
+        queries.append({"origin": o, "destination": d, "date": rng.choice(dates),
+                        "depart_after": f"{rng.randint(5, 21):02d}:{rng.randint(0, 59):02d}:00"})
+    return queries
+
+def client(args):
+    """Un client: richieste in sequenza fino alla scadenza; restituisce latenze (s), errori e 503."""
+    url, queries, duration, seed = args
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+    rng = random.Random(seed)
+    latencies, errors, rejected = [], 0, 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        body = json.dumps(rng.choice(queries))
+        t0 = time.perf_counter()
+        try:
+            conn.request("POST", "/plan", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            status = None
+        if status == 200:
+            latencies.append(time.perf_counter() - t0)
+        elif status == 503:
+            rejected += 1   # coda piena: il server chiede di riprovare
+        else:
+            errors += 1
+    conn.close()
+    return latencies, errors, rejected
+
+def run_load(url: str, queries, clients: int, duration: float, seed: int):
+    # riscaldamento: connessioni per data in cache nei worker
+    client((url, queries, min(2.0, duration), seed))
+    t0 = time.perf_counter()
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [(url, queries, duration, seed + i) for i in range(clients)])
+    elapsed = time.perf_counter() - t0
+    latencies = [lat for lats, _, _ in results for lat in lats]
+    return {
+        "requests": len(latencies),
+        "errors": sum(err for _, err, _ in results),
+        "rejected": sum(rej for _, _, rej in results),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+def report(label: str, res: dict, pss):
+    mem = f"  PSS {pss:7.1f} MB" if pss is not None else ""
+    print(f"{label:12s} {res['rps']:8.1f} req/s  p50 {res['p50_ms']} ms  p99 {res['p99_ms']} ms  "
+          f"({res['requests']} ok, {res['rejected']} 503, {res['errors']} errori){mem}", flush=True)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", help="server già avviato (non ne avvia uno)")
+    ap.add_argument("--workers", default=",".join(str(w) for w in sorted({1, 2, os.cpu_count() or 1})))
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=10.0)
+    ap.add_argument("--queries", type=int, default=500)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--cache", action="store_true", help="lascia attiva la cache di /plan")
+    args = ap.parse_args()
+
+    if args.url:
+        queries = make_queries(args.url, args.queries, args.seed)
+        report("server", run_load(args.url, queries, args.clients, args.duration, args.seed), None)
+        return
+
+    print(f"{os.cpu_count()} core, {args.clients} client, {args.duration:.0f} s per configurazione")
+    for workers in (int(w) for w in args.workers.split(",")):
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, ORAORA_WORKERS=str(workers), ORAORA_BIND=f"127.0.0.1:{port}", ORAORA_ACCESSLOG="")
+        if not args.cache:
+            env["ORAORA_PLAN_CACHE_SIZE"] = "0"
+        proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"], cwd=BACKEND_DIR, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(url, proc)
+            queries = make_queries(url, args.queries, args.seed)
+            res = run_load(url, queries, args.clients, args.duration, args.seed)
+            report(f"{workers} worker", res, tree_pss_mb(proc.pid))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Suite di benchmark riproducibile: preprocess, caricamento del dataset e /plan, sul feed incluso
+(resources/) e su un feed sintetico (synthetic_feed.py). Ogni misura gira in un processo nuovo,
+così il picco di memoria (RSS) è quello della sola misura.
+
+  - preprocess: tempi per stage di preprocess_gtfs da zero e di un secondo giro senza modifiche
+  - load: GTFSRepository.load a freddo (file tolti dalla page cache, dove il sistema lo
+    permette), a caldo, e dai JSON senza snapshot
+  - plan: query origine/destinazione casuali per optimize='time' e 'transfers', con le
+    connessioni dei giorni già pronte; throughput e percentili di latenza
+
+    python benchmarks/suite.py [--feeds bundled,synthetic] [--queries 300] [--output risultati.json]
+    python benchmarks/suite.py --save-baseline          # salva benchmarks/baseline.json
+    python benchmarks/suite.py --compare [--threshold 0.15]
+
+Con --compare il risultato si confronta con la baseline salvata (sulla stessa macchina):
+l'uscita è 1 se qualche misura peggiora oltre la soglia.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:   # Windows: niente picco RSS
+    resource = None
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from bench_solvers import percentile
+from synthetic_feed import generate_feed
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+OPTIMIZE_MODES = ("time", "transfers")
+PLAN_DATES = 4
+# sotto queste differenze assolute un peggioramento è rumore (secondi, MB)
+NOISE_FLOOR = {"seconds": 0.01, "ms": 0.05, "mb": 2.0}
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+def isolated(fn, *args):
+    """Esegue fn(*args) in un interprete nuovo (spawn) e ne restituisce il risultato."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(fn, *args).result()
+
+def evict_page_cache(out_dir: Path) -> bool:
+    """Chiede al kernel di scartare dalla page cache i file del dataset (solo dove c'è fadvise)."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in out_dir.iterdir():
+        if path.is_file():
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+# --- misure, ognuna in un processo a parte ---
+
+def run_preprocess(in_dir: str, out_dir: str) -> dict:
+    from preprocess import preprocess_gtfs
+    t0 = time.perf_counter()
+    stats = preprocess_gtfs(in_dir, out_dir, force=True)
+    total = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    preprocess_gtfs(in_dir, out_dir)
+    incremental = time.perf_counter() - t0
+    return {
+        "counts": {k: stats[k] for k in ("routes", "stops", "trips", "shapes") if k in stats},
+        "stages": stats["timings"],
+        "total_seconds": round(total, 4),
+        "incremental_seconds": round(incremental, 4),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_load(out_dir: str, mode: str) -> dict:
+    from gtfs_repo import GTFSRepository
+    evicted = evict_page_cache(Path(out_dir)) if mode == "cold" else None
+    repo = GTFSRepository(out_dir, use_snapshot=mode != "json")
+    t0 = time.perf_counter()
+    repo.load()
+    seconds = time.perf_counter() - t0
+    # i dati mappati si toccano davvero alla prima query: la si conta a parte
+    t0 = time.perf_counter()
+    dates = sorted(d for d, trips in repo.date_trips.items() if len(trips))
+    for g in repo.trips_on(dates[len(dates) // 2]):
+        repo.trip_schedule(g)
+    first_day = time.perf_counter() - t0
+    out = {"seconds": round(seconds, 4), "first_day_seconds": round(first_day, 4), "peak_rss_mb": peak_rss_mb()}
+    if evicted is not None:
+        out["evicted"] = evicted
+    return out
+
+def run_plan(out_dir: str, queries: int, seed: int) -> dict:
+    from gtfs_repo import GTFSRepository
+    from planner import MultiModalPlanner
+    repo = GTFSRepository(out_dir)
+    repo.load()
+    planner = MultiModalPlanner(repo)
+
+    rng = random.Random(seed)
+    dates = sorted(d for d, trips in repo.date_trips.items() if len(trips))
+    dates = sorted(rng.sample(dates, min(PLAN_DATES, len(dates))))
+    t0 = time.perf_counter()
+    for date in dates:
+        planner.connections_for(date)
+    prewarm = time.perf_counter() - t0
+
+    stops = sorted(repo.stops)
+    workload = []
+    for _ in range(queries):
+        o, d = rng.sample(stops, 2)
+        workload.append((o, d, rng.choice(dates), f"{rng.randint(5, 21):02d}:{rng.randint(0, 59):02d}:00"))
+
+    out = {"connections_seconds": round(prewarm, 4)}
+    for optimize in OPTIMIZE_MODES:
+        times = []
+        found = 0
+        started = time.perf_counter()
+        for q in workload:
+            t0 = time.perf_counter()
+            res = planner.plan(*q, optimize)
+            times.append((time.perf_counter() - t0) * 1000)
+            found += bool(res.get("found"))
+        elapsed = time.perf_counter() - started
+        out[optimize] = {
+            "queries": len(workload),
+            "found": found,
+            "qps": round(len(workload) / elapsed, 1),
+            "mean_ms": round(statistics.mean(times), 3),
+            "p50_ms": round(percentile(times, 0.5), 3),
+            "p90_ms": round(percentile(times, 0.9), 3),
+            "p99_ms": round(percentile(times, 0.99), 3),
+            "max_ms": round(max(times), 3),
+        }
+    out["peak_rss_mb"] = peak_rss_mb()
+    return out
+
+# --- orchestrazione ---
+
+def median_run(fn, repeat: int, *args) -> dict:
+    """Ripete fn in processi separati; per ogni misura numerica tiene la mediana."""
+    runs = [isolated(fn, *args) for _ in range(repeat)]
+    out = dict(runs[0])
+    for key, value in runs[0].items():
+        if isinstance(value, float):
+            out[key] = round(statistics.median(r[key] for r in runs), 4)
+    return out
+
+def bench_feed(name: str, in_dir: Path, work: Path, args) -> dict:
+    out_dir = work / f"out-{name}"
+    print(f"[{name}] preprocess ...", flush=True)
+    result = {"preprocess": isolated(run_preprocess, str(in_dir), str(out_dir))}
+    print(f"[{name}] load ...", flush=True)
+    result["load"] = {mode: median_run(run_load, args.repeat, str(out_dir), mode) for mode in ("cold", "warm", "json")}
+    print(f"[{name}] plan ({args.queries} query per modalità) ...", flush=True)
+    result["plan"] = isolated(run_plan, str(out_dir), args.queries, args.seed)
+    return result
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def metric_kind(name: str):
+    """'seconds'/'ms'/'mb' (meno è meglio), 'qps' (più è meglio), None se non è una misura."""
+    leaf = name.rsplit(".", 1)[-1]
+    if leaf == "qps":
+        return "qps"
+    if ".stages." in name or leaf.endswith("seconds"):
+        return "seconds"
+    if leaf.endswith("_ms"):
+        return "ms"
+    if leaf.endswith("_mb"):
+        return "mb"
+    return None
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Stampa il confronto e restituisce le misure peggiorate oltre la soglia."""
+    if current["params"] != baseline.get("params"):
+        print(f"attenzione: parametri diversi dalla baseline ({baseline.get('params')})")
+    if current["machine"] != baseline.get("machine"):
+        print("attenzione: baseline registrata su un'altra macchina, i tempi non sono confrontabili")
+    now, base = flatten(current["feeds"]), flatten(baseline.get("feeds", {}))
+    regressions = []
+    print(f"\n{'misura':52s} {'baseline':>11s} {'attuale':>11s} {'delta':>8s}")
+    for name in sorted(now):
+        kind = metric_kind(name)
+        if kind is None or name not in base:
+            continue
+        old, new = base[name], now[name]
+        delta = (new - old) / old if old else 0.0
+        worse = -delta if kind == "qps" else delta
+        flag = ""
+        if worse > threshold and (kind == "qps" or abs(new - old) > NOISE_FLOOR[kind]):
+            flag = "  <- peggiorata"
+            regressions.append(name)
+        print(f"{name:52s} {old:11.4g} {new:11.4g} {delta:+8.1%}{flag}")
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--feeds", default="bundled,synthetic", help="bundled, synthetic o entrambi")
+    ap.add_argument("--in-dir", default=str(BACKEND_DIR / "resources"))
+    ap.add_argument("--stops", type=int, default=400)
+    ap.add_argument("--routes", type=int, default=40)
+    ap.add_argument("--trips", type=int, default=4000)
+    ap.add_argument("--days", type=int, default=60)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--repeat", type=int, default=3, help="ripetizioni (mediana) delle misure di load")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--output", help="scrive i risultati in JSON")
+    ap.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--compare", action="store_true")
+    ap.add_argument("--threshold", type=float, default=0.15, help="peggioramento relativo tollerato")
+    args = ap.parse_args()
+
+    feeds = [f.strip() for f in args.feeds.split(",") if f.strip()]
+    params = {"feeds": feeds, "queries": args.queries, "seed": args.seed}
+    if "synthetic" in feeds:
+        params["synthetic"] = {"stops": args.stops, "routes": args.routes, "trips": args.trips, "days": args.days}
+    results = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "params": params,
+        "feeds": {},
+    }
+
+    with tempfile.TemporaryDirectory() as work:
+        work = Path(work)
+        for name in feeds:
+            if name == "bundled":
+                in_dir = Path(args.in_dir)
+            elif name == "synthetic":
+                in_dir = work / "synthetic"
+                generate_feed(in_dir, args.stops, args.routes, args.trips, args.days, seed=args.seed)
+            else:
+                ap.error(f"feed sconosciuto: {name}")
+            results["feeds"][name] = bench_feed(name, in_dir, work, args)
+
+    for name, feed in results["feeds"].items():
+        pre = feed["preprocess"]
+        print(f"\n{name}: {pre['counts']}")
+        print(f"  preprocess  {pre['total_seconds']:8.3f} s  (senza modifiche {pre['incremental_seconds']:.3f} s)"
+              f"  picco {pre['peak_rss_mb']} MB")
+        for stage, secs in pre["stages"].items():
+            print(f"    {stage:12s} {secs:8.3f} s")
+        for mode, load in feed["load"].items():
+            print(f"  load {mode:6s} {load['seconds']:8.4f} s  prima data {load['first_day_seconds']:.4f} s"
+                  f"  picco {load['peak_rss_mb']} MB")
+        plan = feed["plan"]
+        for optimize in OPTIMIZE_MODES:
+            p = plan[optimize]
+            print(f"  plan {optimize:9s} {p['qps']:8.1f} q/s  p50 {p['p50_ms']:.3f}  p90 {p['p90_ms']:.3f}"
+                  f"  p99 {p['p99_ms']:.3f} ms  trovati {p['found']}/{p['queries']}")
+        print(f"  plan picco {plan['peak_rss_mb']} MB, connessioni {plan['connections_seconds']:.3f} s")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.save_baseline:
+        Path(args.baseline).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"\nbaseline salvata in {args.baseline}")
+    if args.compare:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} misure peggiorate oltre il {args.threshold:.0%}")
+            sys.exit(1)
+        print("\nnessun peggioramento oltre la soglia")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Generatore di feed GTFS sintetici per i benchmark, con dimensioni scelte: fermate, linee,
+trip e giorni di servizio. Le fermate stanno nel riquadro della Sardegna; ogni linea è una
+sequenza di fermate vicine percorsa nei due sensi, e le linee condividono fermate, così il
+planner trova itinerari con cambi. A parità di parametri (e seed) il feed è identico.
+
+    python benchmarks/synthetic_feed.py OUT_DIR [--stops 400] [--routes 40] [--trips 4000] [--days 60]
+"""
+import argparse
+import csv
+import math
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+LAT_RANGE = (38.9, 41.2)
+LON_RANGE = (8.2, 9.8)
+START_DATE = date(2025, 1, 6)   # un lunedì
+SPEED_KMH = {2: 70.0, 3: 40.0}
+DWELL_SECONDS = 60
+
+def _km(a, b) -> float:
+    dlat = (a[0] - b[0]) * 111.0
+    dlon = (a[1] - b[1]) * 111.0 * math.cos(math.radians((a[0] + b[0]) / 2))
+    return math.hypot(dlat, dlon)
+
+def _hhmmss(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def _write(path: Path, header, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
+
+def _line(rng: random.Random, coords, length: int):
+    """Percorso tra fermate vicine: si parte da una fermata a caso e si va alla più vicina non usata."""
+    current = rng.randrange(len(coords))
+    path = [current]
+    used = {current}
+    while len(path) < length:
+        # tra le 4 più vicine, per non avere linee tutte dritte
+        candidates = sorted((i for i in range(len(coords)) if i not in used),
+                            key=lambda i: _km(coords[current], coords[i]))[:4]
+        if not candidates:
+            break
+        current = rng.choice(candidates)
+        path.append(current)
+        used.add(current)
+    return path
+
+def generate_feed(out_dir, stops: int = 400, routes: int = 40, trips: int = 4000, days: int = 60,
+                  stops_per_route: int = 15, shape_points: int = 4, seed: int = 1) -> dict:
+    """
+    Scrive in out_dir i file GTFS letti da preprocess_gtfs e restituisce i conteggi.
+    shape_points: punti della shape per ogni tratta tra due fermate.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+
+    coords = [(round(rng.uniform(*LAT_RANGE), 6), round(rng.uniform(*LON_RANGE), 6)) for _ in range(stops)]
+    stop_ids = [f"S{i:05d}" for i in range(stops)]
+    _write(out_dir / 'stops.txt', ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+           [(sid, f"Stazione di SINTETICA {i}", lat, lon) for i, (sid, (lat, lon)) in enumerate(zip(stop_ids, coords))])
+
+    # un terzo delle linee sono bus, come nel feed reale (route_type 3)
+    lines = []
+    route_rows = []
+    for r in range(routes):
+        route_id = f"R{r:04d}"
+        route_type = 3 if r % 3 == 2 else 2
+        path = _line(rng, coords, min(stops_per_route, stops))
+        lines.append((route_id, route_type, path))
+        route_rows.append((route_id, 'BUS' if route_type == 3 else 'REG', f"Linea {r}", route_type, 'DA1D2A'))
+    _write(out_dir / 'routes.txt', ['route_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color'],
+           route_rows)
+
+    # servizi: tutti i giorni, feriali, festivi, e a giorni alterni
+    dates = [START_DATE + timedelta(days=d) for d in range(days)]
+    services = {
+        'DAILY': dates,
+        'WEEKDAY': [d for d in dates if d.weekday() < 5],
+        'WEEKEND': [d for d in dates if d.weekday() >= 5],
+        'ALT': dates[::2],
+    }
+    _write(out_dir / 'calendar_dates.txt', ['service_id', 'date', 'exception_type'],
+           [(sid, d.strftime('%Y%m%d'), 1) for sid, ds in services.items() for d in ds])
+    service_ids = list(services)
+
+    shape_rows = []
+    for route_id, _, path in lines:
+        for direction, seq in ((0, path), (1, path[::-1])):
+            n = 0
+            for a, b in zip(seq, seq[1:]):
+                for k in range(shape_points):
+                    t = k / shape_points
+                    n += 1
+                    shape_rows.append((f"{route_id}-{direction}",
+                                       round(coords[a][0] + (coords[b][0] - coords[a][0]) * t, 6),
+                                       round(coords[a][1] + (coords[b][1] - coords[a][1]) * t, 6), n))
+            shape_rows.append((f"{route_id}-{direction}", coords[seq[-1]][0], coords[seq[-1]][1], n + 1))
+    _write(out_dir / 'shapes.txt', ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'], shape_rows)
+
+    trip_rows = []
+    stop_time_rows = []
+    for t in range(trips):
+        route_id, route_type, path = lines[t % routes]
+        direction = (t // routes) % 2
+        seq = path[::-1] if direction else path
+        trip_id = f"T{t:06d}"
+        trip_rows.append((route_id, rng.choice(service_ids), trip_id, f"SINTETICA {seq[-1]}",
+                          f"{route_id}-{direction}"))
+        now = rng.randint(5 * 3600, 22 * 3600) // 60 * 60
+        speed = SPEED_KMH[route_type] / 3600.0
+        for i, s in enumerate(seq):
+            if i:
+                now += max(60, int(_km(coords[seq[i - 1]], coords[s]) / speed) // 60 * 60)
+            arrival = now
+            if 0 < i < len(seq) - 1:
+                now += DWELL_SECONDS
+            stop_time_rows.append((trip_id, _hhmmss(arrival), _hhmmss(now), stop_ids[s], i + 1))
+    _write(out_dir / 'trips.txt', ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'shape_id'], trip_rows)
+    _write(out_dir / 'stop_times.txt', ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'],
+           stop_time_rows)
+
+    return {"stops": stops, "routes": routes, "trips": trips, "days": days,
+            "stop_times": len(stop_time_rows), "shape_points": len(shape_rows)}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("out_dir")
+    ap.add_argument("--stops", type=int, default=400)
+    ap.add_argument("--routes", type=int, default=40)
+    ap.add_argument("--trips", type=int, default=4000)
+    ap.add_argument("--days", type=int, default=60)
+    ap.add_argument("--stops-per-route", type=int, default=15)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    counts = generate_feed(args.out_dir, args.stops, args.routes, args.trips, args.days,
+                           stops_per_route=args.stops_per_route, seed=args.seed)
+    print(", ".join(f"{k} {v}" for k, v in counts.items()))
+
+if __name__ == "__main__":
+    main()
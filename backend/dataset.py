@@ -0,0 +1,170 @@
+"""
+Dataset servito dall'API: repository, planner e indici (partenze, mezzi) costruiti insieme e mai modificati dopo la
+pubblicazione. Un ricaricamento ne costruisce uno nuovo a parte e lo sostituisce con un
+solo assegnamento: le richieste in corso finiscono sul riferimento che hanno già preso.
+"""
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:   # Windows: niente lock tra processi, si usa un solo processo
+    fcntl = None
+
+from departures import DepartureIndex
+from gtfs_repo import MANIFEST_FILE, GTFSRepository, dataset_version
+from planner import MultiModalPlanner
+from vehicles import VehicleIndex
+
+@dataclass(frozen=True)
+class Dataset:
+    repo: GTFSRepository
+    planner: MultiModalPlanner
+    departures: DepartureIndex
+    vehicles: VehicleIndex
+    version: str
+    loaded_at: str
+
+@contextmanager
+def process_lock(path, blocking: bool = True):
+    """
+    Lock esclusivo su file, valido tra processi (worker gunicorn che condividono gtfs-out/).
+    Con blocking=False, se è già preso da un altro processo solleva RuntimeError.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            raise RuntimeError("preprocess già in corso in un altro processo") from None
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class DatasetStore:
+    def __init__(self):
+        self._current: Optional[Dataset] = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._checked_at = 0.0
+        self._manifest_stamp = None
+
+    @property
+    def current(self) -> Optional[Dataset]:
+        return self._current
+
+    def publish(self, dataset: Dataset) -> Optional[Dataset]:
+        """Sostituisce il dataset corrente e restituisce il precedente."""
+        with self._lock:
+            old, self._current = self._current, dataset
+        return old
+
+    def load_once(self, build: Callable[[], Dataset]) -> Dataset:
+        """Carica il dataset al primo uso; richieste concorrenti aspettano lo stesso caricamento."""
+        current = self._current
+        if current is not None:
+            return current
+        with self._lock:
+            if self._current is None:
+                self._current = build()
+            return self._current
+
+    def reload_if_changed(self, out_dir, build: Callable[[], Dataset], interval: float) -> Tuple[Dataset, bool]:
+        """
+        Con più processi un preprocess aggiorna gtfs-out/ e pubblica il dataset solo nel proprio:
+        gli altri se ne accorgono dal manifest (al più ogni `interval` secondi) e lo ricaricano.
+        Nel frattempo, e durante il ricaricamento, le richieste usano il dataset corrente.
+        """
+        current = self._current
+        now = time.monotonic()
+        if current is None or now - self._checked_at < interval or not self._reload_lock.acquire(blocking=False):
+            return current, False
+        try:
+            self._checked_at = now
+            try:
+                stamp = (Path(out_dir) / MANIFEST_FILE).stat().st_mtime_ns
+            except OSError:
+                return current, False
+            if stamp == self._manifest_stamp:
+                return current, False
+            self._manifest_stamp = stamp
+            if dataset_version(out_dir) == current.version:
+                return current, False
+            dataset = build()
+            self.publish(dataset)
+            return dataset, True
+        finally:
+            self._reload_lock.release()
+
+class PreprocessJobs:
+    """
+    Esegue un preprocess alla volta in un thread di background. Lo stato degli ultimi
+    job resta interrogabile: queued -> running -> done | failed.
+    """
+    def __init__(self, run: Callable[[Dict], Dict], keep: int = 20):
+        self._run = run
+        self._keep = keep
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._threads: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, params: Dict) -> Tuple[Dict, bool]:
+        """Avvia un job; se ce n'è già uno attivo restituisce quello (started=False)."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job["state"] in ("queued", "running"):
+                    return dict(job), False
+            job_id = uuid.uuid4().hex[:12]
+            job = {"id": job_id, "state": "queued", "params": params,
+                   "submitted_at": datetime.now().isoformat(), "started_at": None, "finished_at": None,
+                   "seconds": None, "result": None, "error": None}
+            self._jobs[job_id] = job
+            while len(self._jobs) > self._keep:
+                self._jobs.popitem(last=False)
+            thread = threading.Thread(target=self._execute, args=(job_id,), name=f"preprocess-{job_id}", daemon=True)
+            self._threads[job_id] = thread
+        thread.start()
+        return dict(job), True
+
+    def _execute(self, job_id: str):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["state"] = "running"
+            job["started_at"] = datetime.now().isoformat()
+            params = job["params"]
+        t0 = time.perf_counter()
+        try:
+            result, state, error = self._run(params), "done", None
+        except Exception as e:
+            traceback.print_exc()
+            result, state, error = None, "failed", f"{type(e).__name__}: {e}"
+        with self._lock:
+            job.update(state=state, result=result, error=error, finished_at=datetime.now().isoformat(),
+                       seconds=round(time.perf_counter() - t0, 3))
+            self._threads.pop(job_id, None)
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        thread = self._threads.get(job_id)
+        if thread is not None:
+            thread.join(timeout)
+        return self.status(job_id)
+
+    def status(self, job_id: Optional[str] = None) -> Optional[Dict]:
+        """Stato del job indicato, o dell'ultimo avviato."""
+        with self._lock:
+            if job_id is None:
+                job = next(reversed(self._jobs.values()), None)
+            else:
+                job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
@@ -0,0 +1,174 @@
+"""
+Indici per tabellone partenze e ricerca trip tra due fermate, costruiti al load del dataset:
+  - fermata -> partenze (trip, posizione) ordinate per orario, in array piatti con un offset
+    per fermata: le partenze dopo un orario sono una ricerca binaria nel blocco della fermata
+  - (fermata, trip) -> posizione della fermata nel trip, come chiavi ordinate fermata*n_trip+trip
+Il filtro per data usa i trip attivi del repository (repo.date_trips). Le corse dopo mezzanotte
+(orari GTFS oltre 24:00) del giorno di servizio precedente compaiono nella data richiesta.
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import numpy as np
+
+from gtfs_repo import GTFSRepository
+from planner import fmt_minutes
+
+DAY_MINUTES = 24 * 60
+# maschere dei trip attivi per data tenute in memoria
+ACTIVE_CACHE_SIZE = 32
+
+def previous_day(date: str) -> str:
+    return (datetime.strptime(date, "%Y%m%d") - timedelta(days=1)).strftime("%Y%m%d")
+
+class DepartureIndex:
+    def __init__(self, repo: GTFSRepository):
+        self.repo = repo
+        self.n_trips = len(repo.trip_ids)
+        n_stops = len(repo.stop_ids)
+
+        stops, deps, trips, positions = [], [], [], []
+        for g in range(self.n_trips):
+            trip_stops, trip_deps, _ = repo.trip_schedule(g)
+            last = len(trip_stops) - 1
+            for k, (s, d) in enumerate(zip(trip_stops, trip_deps)):
+                stops.append(s)
+                # al capolinea si arriva soltanto: non è una partenza
+                deps.append(-1 if d is None or k == last else d)
+                trips.append(g)
+                positions.append(k)
+        stops = np.asarray(stops, dtype=np.int64)
+        deps = np.asarray(deps, dtype=np.int32)
+        trips = np.asarray(trips, dtype=np.int32)
+        positions = np.asarray(positions, dtype=np.int32)
+
+        # partenze: per fermata, poi per orario
+        has_dep = deps >= 0
+        order = np.lexsort((trips[has_dep], deps[has_dep], stops[has_dep]))
+        self._dep_time = deps[has_dep][order]
+        self._dep_trip = trips[has_dep][order]
+        self._dep_pos = positions[has_dep][order]
+        self._dep_start = np.searchsorted(stops[has_dep][order], np.arange(n_stops + 1))
+
+        # (fermata, trip) -> posizione; a parità di chiave (trip ad anello) in ordine di passaggio
+        keys = stops * max(1, self.n_trips) + trips
+        order = np.argsort(keys, kind='stable')
+        self._keys = keys[order]
+        self._key_pos = positions[order]
+
+        self._trip_route = np.asarray(repo.trip_route, dtype=np.int32)
+        self._active: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def active(self, date: str) -> np.ndarray:
+        """Maschera (per indice trip) dei trip attivi nella data."""
+        with self._lock:
+            mask = self._active.get(date)
+            if mask is not None:
+                self._active.move_to_end(date)
+                return mask
+        mask = np.zeros(self.n_trips, dtype=bool)
+        trips = self.repo.trips_on(date)
+        if len(trips):
+            mask[np.frombuffer(trips, dtype=np.int32)] = True
+        with self._lock:
+            self._active[date] = mask
+            while len(self._active) > ACTIVE_CACHE_SIZE:
+                self._active.popitem(last=False)
+        return mask
+
+    def positions(self, stop: int, trips: np.ndarray) -> np.ndarray:
+        """Posizione (l'ultimo passaggio) della fermata in ciascun trip, -1 se non ci passa."""
+        keys = stop * max(1, self.n_trips) + trips.astype(np.int64)
+        idx = np.searchsorted(self._keys, keys, 'right') - 1
+        found = (idx >= 0) & (self._keys[np.maximum(idx, 0)] == keys)
+        return np.where(found, self._key_pos[np.maximum(idx, 0)], -1)
+
+    def _window(self, stop: int, date: str, after: int):
+        """
+        Partenze dalla fermata da `after` (minuti) in poi nella data, comprese quelle oltre
+        mezzanotte del giorno prima, in ordine di orario: (orari nella data, righe degli array
+        delle partenze, giorno di servizio per riga: 0 il precedente, 1 la data).
+        """
+        lo, hi = int(self._dep_start[stop]), int(self._dep_start[stop + 1])
+        times = self._dep_time[lo:hi]
+        parts = []
+        for day, (service_date, shift) in enumerate(((previous_day(date), DAY_MINUTES), (date, 0))):
+            start = lo + int(np.searchsorted(times, after + shift, 'left'))
+            sel = np.arange(start, hi)
+            sel = sel[self.active(service_date)[self._dep_trip[sel]]]
+            parts.append((self._dep_time[sel] - shift, sel, np.full(len(sel), day, dtype=np.int8)))
+        times, rows, days = (np.concatenate(cols) for cols in zip(*parts))
+        order = np.lexsort((self._dep_trip[rows], times))
+        return times[order], rows[order], days[order]
+
+    def _trip_json(self, g: int, service_date: str) -> Dict:
+        trip_id = self.repo.trip_ids[g]
+        trip = self.repo.timetable[trip_id]
+        route_id = self.repo.route_ids[self.repo.trip_route[g]]
+        route = self.repo.routes.get(route_id, {})
+        return {
+            "trip_id": trip_id,
+            "route_id": route_id,
+            "route_short": route.get('short', ''),
+            "mode": route.get('mode', 'train'),
+            "headsign": trip.get('headsign', ''),
+            "service_date": service_date,
+        }
+
+    def departures(self, stop_id: str, date: str, after: int = 0, offset: int = 0, limit: int = 20) -> Optional[Dict]:
+        """Prossime partenze dalla fermata; None se la fermata non esiste."""
+        stop = self.repo.stop_index.get(stop_id)
+        if stop is None:
+            return None
+        times, rows, days = self._window(stop, date, after)
+        service_dates = (previous_day(date), date)
+        page = []
+        for i in range(offset, min(offset + limit, len(rows))):
+            row = int(rows[i])
+            g = int(self._dep_trip[row])
+            pos = int(self._dep_pos[row])
+            trip_stops, _, _ = self.repo.trip_schedule(g)
+            page.append({
+                **self._trip_json(g, service_dates[days[i]]),
+                "departure": fmt_minutes(int(times[i])),
+                "stop_index": pos,
+                "destination": self.repo.stop_ids[trip_stops[-1]],
+            })
+        return {"total": len(rows), "items": page}
+
+    def trips(self, origin_id: str, destination_id: str, date: str, after: int = 0, offset: int = 0,
+              limit: int = 20, route_id: Optional[str] = None) -> Optional[Dict]:
+        """Trip diretti da origine a destinazione che partono da `after` in poi; None se una fermata non esiste."""
+        origin = self.repo.stop_index.get(origin_id)
+        destination = self.repo.stop_index.get(destination_id)
+        if origin is None or destination is None:
+            return None
+        times, rows, days = self._window(origin, date, after)
+        service_dates = (previous_day(date), date)
+        trips = self._dep_trip[rows]
+        to_pos = self.positions(destination, trips)
+        keep = to_pos > self._dep_pos[rows]
+        if route_id is not None:
+            route = self.repo.route_index.get(route_id, -1)
+            keep &= self._trip_route[trips] == route
+        idx = np.flatnonzero(keep)
+
+        page = []
+        for i in idx[offset:offset + limit].tolist():
+            g = int(trips[i])
+            from_pos, dest_pos = int(self._dep_pos[rows[i]]), int(to_pos[i])
+            _, _, trip_arrs = self.repo.trip_schedule(g)
+            shift = 0 if days[i] else DAY_MINUTES
+            arrival = trip_arrs[dest_pos] - shift if trip_arrs[dest_pos] is not None else None
+            page.append({
+                **self._trip_json(g, service_dates[days[i]]),
+                "departure": fmt_minutes(int(times[i])),
+                "arrival": fmt_minutes(arrival) if arrival is not None else None,
+                "duration_minutes": arrival - int(times[i]) if arrival is not None else None,
+                "from_index": from_pos,
+                "to_index": dest_pos,
+            })
+        return {"total": len(idx), "items": page}
@@ -1,16 +1,100 @@
+import hashlib
 import json
+from array import array
 from pathlib import Path
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from snapshot import SNAPSHOT_FILE, Snapshot, SnapshotCalendar, SnapshotShapes, SnapshotTimetable, read_meta
+
+MANIFEST_FILE = 'manifest.json'
+
+def manifest_version(params, inputs) -> str:
+    """Impronta di un dataset: parametri del preprocess e sha256 dei file di input."""
+    key = json.dumps({"params": params, "inputs": {k: v.get("sha256") for k, v in inputs.items()}},
+                     sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def dataset_version(out_dir) -> str:
+    """
+    Impronta del dataset in out_dir: dal manifest (hash degli input + parametri) se c'è,
+    altrimenti dal generated_at di stats.json.
+    """
+    out_dir = Path(out_dir)
+    try:
+        with open(out_dir / MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        return manifest_version(manifest.get("params"), manifest.get("inputs", {}))
+    except (OSError, ValueError):
+        try:
+            with open(out_dir / 'stats.json', 'r', encoding='utf-8') as f:
+                key = json.load(f).get("generated_at", "")
+        except (OSError, ValueError):
+            key = ""
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def parse_hhmmss_to_minutes(t: str) -> Optional[int]:
+    if not t:
+        return None
+    parts = t.split(':')
+    if len(parts) < 2:
+        return None
+    h, m = int(parts[0]), int(parts[1])
+    s = int(parts[2]) if len(parts) == 3 else 0
+    return h * 60 + m + s // 60
+
+def parse_hhmmss_to_seconds(t: str) -> Optional[int]:
+    if not t:
+        return None
+    parts = t.split(':')
+    if len(parts) < 2:
+        return None
+    h, m = int(parts[0]), int(parts[1])
+    s = int(parts[2]) if len(parts) == 3 else 0
+    return h * 3600 + m * 60 + s
 
 class GTFSRepository:
-    def __init__(self, out_dir: str):
+    def __init__(self, out_dir: str, use_snapshot: bool = True):
         self.out_dir = Path(out_dir)
+        self.use_snapshot = use_snapshot
+        self.snapshot: Optional[Snapshot] = None
         self.routes = {}
         self.shapes = {}
         self.stops = {}
         self.timetable = {}
         self.calendar = {}
+        # id stringa <-> indice intero, assegnati al load
+        self.stop_ids: List[str] = []
+        self.stop_index: Dict[str, int] = {}
+        self.trip_ids: List[str] = []
+        self.trip_index: Dict[str, int] = {}
+        self.route_ids: List[str] = []
+        self.route_index: Dict[str, int] = {}
+        self.trip_route: List[int] = []
+        # indice di servizio: data -> service_id attivi / indici dei trip attivi (ordinati)
+        self.date_services: Dict[str, FrozenSet[str]] = {}
+        self.date_trips: Dict[str, array] = {}
 
     def load(self):
+        """Preferisce lo snapshot binario se c'è ed è della stessa versione dei JSON."""
+        snap_path = self.out_dir / SNAPSHOT_FILE
+        if self.use_snapshot and snap_path.exists() and self._snapshot_fresh(snap_path):
+            self._load_snapshot(snap_path)
+        else:
+            self._load_json()
+
+    def _snapshot_fresh(self, snap_path: Path) -> bool:
+        """
+        Lo snapshot porta nell'header la versione del dataset per cui è stato scritto: vale se
+        coincide con quella del manifest. Le mtime no, dopo un clone o un checkout seguono
+        l'ordine in cui git scrive i file.
+        """
+        version = read_meta(snap_path).get("dataset_version")
+        return version is not None and version == dataset_version(self.out_dir)
+
+    def _load_json(self):
+        self.snapshot = None
         with open(self.out_dir / 'routes.json', 'r', encoding='utf-8') as f:
             self.routes = json.load(f)
         with open(self.out_dir / 'shapes.json', 'r', encoding='utf-8') as f:
@@ -21,12 +105,181 @@ class GTFSRepository:
             self.timetable = json.load(f)
         with open(self.out_dir / 'calendar.json', 'r', encoding='utf-8') as f:
             self.calendar = json.load(f)
+        self._build_index()
+        self._build_service_index()
+
+    def _build_index(self):
+        """Interna fermate, trip e linee in indici interi contigui."""
+        stop_ids = list(self.stops)
+        known = set(stop_ids)
+        for trip in self.timetable.values():
+            for st in trip['stops']:
+                if st[0] not in known:
+                    known.add(st[0])
+                    stop_ids.append(st[0])
+        route_ids = list(self.routes)
+        known = set(route_ids)
+        for trip in self.timetable.values():
+            if trip['route_id'] not in known:
+                known.add(trip['route_id'])
+                route_ids.append(trip['route_id'])
+
+        self.stop_ids = stop_ids
+        self.stop_index = {s: i for i, s in enumerate(stop_ids)}
+        self.trip_ids = list(self.timetable)
+        self.trip_index = {t: i for i, t in enumerate(self.trip_ids)}
+        self.route_ids = route_ids
+        self.route_index = {r: i for i, r in enumerate(route_ids)}
+        self.trip_route = [self.route_index[self.timetable[t]['route_id']] for t in self.trip_ids]
+
+    def _build_service_index(self):
+        """
+        Calcola una volta, da calendar, quali servizi e quali trip sono attivi in ogni data.
+        Le eventuali copie service_dates nei trip (formato precedente di timetable.json)
+        vengono assorbite nell'indice e rimosse.
+        """
+        services: Dict[str, set] = {}
+        for service_id, dates in self.calendar.items():
+            for date, exception_type in dates.items():
+                if exception_type == 1:
+                    services.setdefault(date, set()).add(service_id)
+
+        trips_by_service: Dict[str, List[int]] = {}
+        for t, trip_id in enumerate(self.trip_ids):
+            trips_by_service.setdefault(self.timetable[trip_id].get('service_id'), []).append(t)
+
+        date_trips: Dict[str, set] = {}
+        for date, service_ids in services.items():
+            active = date_trips.setdefault(date, set())
+            for service_id in service_ids:
+                active.update(trips_by_service.get(service_id, ()))
+        for t, trip_id in enumerate(self.trip_ids):
+            for date, exception_type in self.timetable[trip_id].pop('service_dates', {}).items():
+                if exception_type == 1:
+                    date_trips.setdefault(date, set()).add(t)
+
+        self.date_services = {date: frozenset(ids) for date, ids in services.items()}
+        self.date_trips = {date: array('i', sorted(ts)) for date, ts in date_trips.items()}
+
+    def _load_snapshot(self, snap_path: Path):
+        """
+        Dati mappati in memoria: routes e stops (piccoli) diventano dict, timetable, shapes
+        e calendar restano viste pigre sugli array. Gli indici si costruiscono sugli array
+        senza passare dai dict dei trip.
+        """
+        snap = self.snapshot = Snapshot(snap_path)
+        strings = snap.strings
+
+        route_cols = {f: strings(snap[f"route_{f}"]) for f in ("short", "long", "color", "type", "mode")}
+        self.routes = {rid: {f: col[i] for f, col in route_cols.items()}
+                       for i, rid in enumerate(strings(snap["route_id"]))}
+        self.stops = {sid: {"name": name, "lat": lat, "lon": lon, "full_name": full}
+                      for sid, name, lat, lon, full in zip(strings(snap["stop_id"]), strings(snap["stop_name"]),
+                                                           snap["stop_lat"].tolist(), snap["stop_lon"].tolist(),
+                                                           strings(snap["stop_full_name"]))}
+        trip_ids = strings(snap["trip_id"])
+        self.timetable = SnapshotTimetable(snap, trip_ids)
+        self.shapes = SnapshotShapes(snap)
+        self.calendar = SnapshotCalendar(snap)
+
+        n_strings = len(snap["str_offsets"]) - 1
+
+        # fermate: quelle di stops.json, poi quelle solo negli orari in ordine di prima comparsa
+        stop_ids = list(self.stops)
+        stop_lut = np.full(n_strings, -1, dtype=np.int32)
+        stop_lut[snap["stop_id"]] = np.arange(len(stop_ids), dtype=np.int32)
+        st_stop = snap["st_stop"]
+        missing = st_stop[stop_lut[st_stop] < 0]
+        if len(missing):
+            uniq, first = np.unique(missing, return_index=True)
+            extra = uniq[np.argsort(first, kind='stable')]
+            stop_lut[extra] = np.arange(len(stop_ids), len(stop_ids) + len(extra), dtype=np.int32)
+            stop_ids.extend(strings(extra))
+
+        route_ids = list(self.routes)
+        route_lut = np.full(n_strings, -1, dtype=np.int32)
+        route_lut[snap["route_id"]] = np.arange(len(route_ids), dtype=np.int32)
+        trip_route = snap["trip_route"]
+        missing = trip_route[route_lut[trip_route] < 0]
+        if len(missing):
+            uniq, first = np.unique(missing, return_index=True)
+            extra = uniq[np.argsort(first, kind='stable')]
+            route_lut[extra] = np.arange(len(route_ids), len(route_ids) + len(extra), dtype=np.int32)
+            route_ids.extend(strings(extra))
+
+        self.stop_ids = stop_ids
+        self.stop_index = {s: i for i, s in enumerate(stop_ids)}
+        self.trip_ids = trip_ids
+        self.trip_index = {t: i for i, t in enumerate(trip_ids)}
+        self.route_ids = route_ids
+        self.route_index = {r: i for i, r in enumerate(route_ids)}
+        self.trip_route = route_lut[trip_route].tolist()
+
+        # orari in minuti: si convertono una volta le stringhe distinte, poi una take per colonna
+        times = np.unique(np.concatenate((snap["st_dep"], snap["st_arr"])))
+        minute_lut = np.full(n_strings, -1, dtype=np.int32)
+        minute_lut[times] = [-1 if m is None else m for m in map(parse_hhmmss_to_minutes, strings(times))]
+        self._st_stop = stop_lut[st_stop]
+        self._st_dep = minute_lut[snap["st_dep"]]
+        self._st_arr = minute_lut[snap["st_arr"]]
+
+        self._build_service_index_snapshot()
+
+    def _build_service_index_snapshot(self):
+        snap = self.snapshot
+        active = snap["cal_exc"] == 1
+        cal_svc = np.repeat(np.arange(len(snap["svc_id"]), dtype=np.int64), snap["svc_cal_count"])[active]
+        cal_date = snap["cal_date"][active]
+        service_ids = snap.strings(snap["svc_id"])
+
+        # trip per servizio: ordinati per servizio, poi per ogni (servizio, data) il blocco di trip
+        trip_service = snap["trip_service"]
+        order = np.argsort(trip_service, kind='stable')
+        sorted_svc = trip_service[order]
+        lo = np.searchsorted(sorted_svc, cal_svc, 'left')
+        hi = np.searchsorted(sorted_svc, cal_svc, 'right')
+        counts = hi - lo
+        total = int(counts.sum())
+        pos = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        pair_trip = order[pos]
+        pair_date = np.repeat(cal_date, counts)
+
+        self.date_services = {}
+        by_date = np.argsort(cal_date, kind='stable')
+        dates_sorted = cal_date[by_date]
+        svc_sorted = cal_svc[by_date]
+        bounds = np.flatnonzero(np.diff(dates_sorted)) + 1
+        for chunk_d, chunk_s in zip(np.split(dates_sorted, bounds), np.split(svc_sorted, bounds)):
+            if len(chunk_d):
+                self.date_services[snap.string(int(chunk_d[0]))] = frozenset(service_ids[i] for i in chunk_s.tolist())
+
+        # ogni trip ha un solo servizio e ogni servizio una data una volta sola: nessun duplicato
+        self.date_trips = {}
+        key = np.lexsort((pair_trip, pair_date))
+        pair_date, pair_trip = pair_date[key], pair_trip[key]
+        bounds = np.flatnonzero(np.diff(pair_date)) + 1
+        for chunk_d, chunk_t in zip(np.split(pair_date, bounds), np.split(pair_trip, bounds)):
+            if len(chunk_d):
+                self.date_trips[snap.string(int(chunk_d[0]))] = array('i', chunk_t.astype(np.int32).tobytes())
+        for date in self.date_services:
+            self.date_trips.setdefault(date, array('i'))
+
+    def trip_schedule(self, g: int) -> Tuple[List[int], List[Optional[int]], List[Optional[int]]]:
+        """Fermate (indici), partenze e arrivi in minuti del trip g, nell'ordine di passaggio."""
+        if self.snapshot is not None:
+            start = int(self.snapshot["trip_st_start"][g])
+            sl = slice(start, start + int(self.snapshot["trip_st_count"][g]))
+            dep = [None if m < 0 else m for m in self._st_dep[sl].tolist()]
+            arr = [None if m < 0 else m for m in self._st_arr[sl].tolist()]
+            return self._st_stop[sl].tolist(), dep, arr
+        stops = self.timetable[self.trip_ids[g]]['stops']
+        return ([self.stop_index[st[0]] for st in stops],
+                [parse_hhmmss_to_minutes(st[1]) for st in stops],
+                [parse_hhmmss_to_minutes(st[2]) for st in stops])
+
+    def trips_on(self, date: str) -> Sequence[int]:
+        """Indici (repo.trip_ids) dei trip attivi nella data, in ordine."""
+        return self.date_trips.get(date, ())
 
     def service_active(self, trip_obj, date: str) -> bool:
-        sd = trip_obj.get('service_dates', {})
-        if date in sd and sd[date] == 1:
-            return True
-        if trip_obj.get('service_id') in self.calendar:
-            if date in self.calendar[trip_obj['service_id']] and self.calendar[trip_obj['service_id']][date] == 1:
-                return True
-        return False
+        return trip_obj.get('service_id') in self.date_services.get(date, ())
@@ -0,0 +1,28 @@
+"""
+Configurazione gunicorn (gunicorn -c gunicorn.conf.py wsgi:app).
+
+    ORAORA_BIND      indirizzo di ascolto (default 0.0.0.0:5000)
+    ORAORA_WORKERS   processi worker (default: numero di core)
+    ORAORA_THREADS   thread per worker (default 1; >1 usa i worker gthread)
+    ORAORA_TIMEOUT   secondi prima che un worker bloccato venga riavviato (default 120)
+    ORAORA_ACCESSLOG file dell'access log ("-" = stdout, default; vuoto = disattivato)
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get("ORAORA_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("ORAORA_WORKERS", "0")) or multiprocessing.cpu_count()
+threads = int(os.environ.get("ORAORA_THREADS", "1"))
+worker_class = "gthread" if threads > 1 else "sync"
+# /preprocess con "wait": true e le richieste /plan/batch grandi possono durare parecchio
+timeout = int(os.environ.get("ORAORA_TIMEOUT", "120"))
+# dataset caricato una volta nel master e condiviso dai worker
+preload_app = True
+accesslog = os.environ.get("ORAORA_ACCESSLOG", "-") or None
+errorlog = "-"
+
+def pre_fork(server, worker):
+    # gli oggetti del dataset finiscono nella generazione permanente: il gc dei worker non li
+    # visita e non ne sporca le pagine, che restano condivise col master
+    gc.freeze()
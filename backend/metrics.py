@@ -0,0 +1,176 @@
+"""
+Metriche per /metrics in formato testo Prometheus (0.0.4), senza dipendenze esterne.
+Contatori e istogrammi stanno nel processo: con più worker gunicorn ogni scrape vede quelli
+del worker che risponde, indicato dall'etichetta pid di oraora_process_info.
+"""
+import math
+import os
+import threading
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs: Iterable[Tuple[str, object]]) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def _number(v: float) -> str:
+    if v == math.inf:
+        return '+Inf'
+    if float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {_number(value)}" for suffix, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield '', _labels(zip(self.labelnames, key)), value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # etichette -> [conteggi per bucket (non cumulativi), somma]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = next(i for i, b in enumerate(self.buckets) if value <= b)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[i] += 1
+            self._values[key] = [counts, total + value]
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        for key, (counts, total) in items:
+            base = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '_bucket', _labels(base + [('le', _number(bound))]), cumulative
+            yield '_sum', _labels(base), total
+            yield '_count', _labels(base), cumulative
+
+class CallbackMetric(Metric):
+    """Valori letti al momento dello scrape da fn() -> {valori delle etichette: valore}."""
+
+    def __init__(self, name, help, kind: str, fn: Callable[[], Dict[Tuple, float]], labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self):
+        for key, value in sorted(self._fn().items()):
+            if value is not None:
+                yield '', _labels(zip(self.labelnames, key)), value
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, kind, fn, labelnames=()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, kind, fn, labelnames))
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self._metrics.values()) + '\n'
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_LATENCY = REGISTRY.histogram("oraora_http_request_duration_seconds", "Durata delle richieste HTTP per endpoint",
+                                  ("endpoint", "method"))
+HTTP_REQUESTS = REGISTRY.counter("oraora_http_requests_total", "Richieste HTTP per endpoint e stato",
+                                 ("endpoint", "method", "status"))
+PLAN_LATENCY = REGISTRY.histogram("oraora_plan_duration_seconds", "Durata di /plan per solver, cache compresa",
+                                  ("solver", "cache"))
+PLAN_PHASES = REGISTRY.histogram("oraora_plan_phase_seconds",
+                                 "Tempo per fase dei calcoli di /plan (connections, scan, reconstruct, assemble)",
+                                 ("solver", "phase"))
+PLAN_WORK = REGISTRY.counter("oraora_plan_work_total",
+                             "Lavoro dei solver: connessioni scandite, etichette create, pattern RAPTOR",
+                             ("solver", "counter"))
+PLAN_PARETO = REGISTRY.histogram("oraora_plan_pareto_set_size",
+                                 "Dimensione degli insiemi di Pareto (destinazione e fermata più affollata)",
+                                 ("solver", "set"), buckets=SIZE_BUCKETS)
+CONNECTION_CACHE = REGISTRY.counter("oraora_connection_cache_total", "Connessioni per data trovate in cache o costruite",
+                                    ("result",))
+
+WORK_COUNTERS = ("scanned", "labels", "patterns_scanned", "stops_improved")
+PARETO_SETS = {"pareto_size": "destination", "pareto_max": "max_stop"}
+
+def observe_request(endpoint: Optional[str], method: str, status: int, seconds: float):
+    endpoint = endpoint or "unmatched"
+    HTTP_LATENCY.observe(seconds, endpoint=endpoint, method=method)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+
+def observe_plan(debug: Optional[Dict], scan: Optional[Dict], cache_hit: bool, seconds: float):
+    """Una risposta di /plan; fasi e contatori solo se calcolata ora (non dalla cache)."""
+    solver = (debug or {}).get("solver", "none")
+    PLAN_LATENCY.observe(seconds, solver=solver, cache="hit" if cache_hit else "miss")
+    if cache_hit or not debug:
+        return
+    for phase, secs in debug.get("phases", {}).items():
+        PLAN_PHASES.observe(secs, solver=solver, phase=phase)
+    CONNECTION_CACHE.inc(result="hit" if debug.get("connections_cached") else "miss")
+    for key in WORK_COUNTERS:
+        if scan and scan.get(key):
+            PLAN_WORK.inc(scan[key], solver=solver, counter=key)
+    for key, name in PARETO_SETS.items():
+        if scan and key in scan:
+            PLAN_PARETO.observe(scan[key], solver=solver, set=name)
+
+REGISTRY.callback("oraora_process_info", "Processo che ha risposto allo scrape", "gauge",
+                  lambda: {(str(os.getpid()),): 1}, ("pid",))
@@ -0,0 +1,138 @@
+"""
+Cache dei risultati di MultiModalPlanner.plan per le coppie origine/destinazione più richieste.
+
+La chiave usa la fascia oraria di depart_after (bucket_minutes) invece dell'orario esatto.
+Un risultato calcolato partendo da t_c vale anche per una richiesta t della stessa fascia se
+t_c <= t <= prima partenza del viaggio trovato. In quel caso il viaggio è ancora fattibile, e
+tutto ciò che è fattibile da t lo era già da t_c, quindi resta ottimo. Cambia solo
+total_minutes, che si ricalcola.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from gtfs_repo import parse_hhmmss_to_minutes
+
+NO_DEPARTURE = float('inf')
+
+def _first_departure(result: Dict) -> float:
+    """Prima partenza del viaggio (o delle alternative pareto); inf se non c'è itinerario."""
+    if not result.get("found"):
+        return NO_DEPARTURE
+    options = result.get("pareto") or [result]
+    deps = [parse_hhmmss_to_minutes(opt["segments"][0]["departure"]) for opt in options if opt.get("segments")]
+    return min((d for d in deps if d is not None), default=NO_DEPARTURE)
+
+def _rebase(result: Dict, shift: int) -> Dict:
+    """Copia del risultato con total_minutes misurato da depart_after spostato di shift minuti."""
+    if shift == 0 or not result.get("found"):
+        return result
+    out = dict(result, total_minutes=result["total_minutes"] - shift)
+    if "pareto" in result:
+        out["pareto"] = [dict(opt, total_minutes=opt["total_minutes"] - shift) for opt in result["pareto"]]
+    return out
+
+class PlanCache:
+    """
+    LRU con TTL, legata a una versione del dataset: invalidate(version) la svuota e da lì in poi
+    scarta i risultati calcolati sul dataset precedente da richieste ancora in corso.
+    Per ogni fascia si tengono al più per_bucket risultati (orari di partenza diversi).
+    """
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0, bucket_minutes: int = 5, per_bucket: int = 4):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bucket_minutes = max(1, bucket_minutes)
+        self.per_bucket = per_bucket
+        self.version: Optional[str] = None
+        self._entries: "OrderedDict[tuple, list]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def plan(self, planner, version: str, origin: str, destination: str, date: str, departure_after: str,
+             optimize: str, min_transfer: Optional[int] = None, solver: Optional[str] = None,
+             debug: bool = False) -> Tuple[Dict, bool]:
+        """Come planner.plan; restituisce anche se il risultato viene dalla cache."""
+        dep = parse_hhmmss_to_minutes(departure_after) if departure_after else 0
+        if not self.enabled or dep is None:
+            return planner.plan(origin, destination, date, departure_after, optimize,
+                                min_transfer=min_transfer, solver=solver, debug=debug), False
+
+        key = (version, origin, destination, date, optimize, min_transfer, solver, debug, dep // self.bucket_minutes)
+        hit = self._lookup(key, dep)
+        if hit is not None:
+            return hit, True
+
+        res = planner.plan(origin, destination, date, departure_after, optimize,
+                           min_transfer=min_transfer, solver=solver, debug=debug)
+        self._store(key, version, dep, res)
+        return res, False
+
+    def _lookup(self, key: tuple, dep: int) -> Optional[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            slot = self._entries.get(key)
+            if slot is not None:
+                live = [e for e in slot if e[0] > now]
+                self._counters["expired"] += len(slot) - len(live)
+                self._size -= len(slot) - len(live)
+                slot[:] = live
+                for _, t_c, first_dep, result in live:
+                    if t_c <= dep <= first_dep:
+                        self._entries.move_to_end(key)
+                        self._counters["hits"] += 1
+                        return _rebase(result, dep - t_c)
+                if not live:
+                    del self._entries[key]
+            self._counters["misses"] += 1
+        return None
+
+    def _store(self, key: tuple, version: str, dep: int, result: Dict):
+        entry = (time.monotonic() + self.ttl, dep, _first_departure(result), result)
+        with self._lock:
+            if self.version is None:
+                self.version = version
+            elif version != self.version:
+                return   # calcolato sul dataset precedente
+            slot = self._entries.setdefault(key, [])
+            slot.append(entry)
+            self._size += 1
+            if len(slot) > self.per_bucket:
+                self._size -= len(slot) - self.per_bucket
+                self._counters["evictions"] += len(slot) - self.per_bucket
+                del slot[:-self.per_bucket]
+            self._entries.move_to_end(key)
+            while self._size > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._counters["evictions"] += len(evicted)
+
+    def invalidate(self, version: Optional[str] = None):
+        """Svuota la cache; i risultati successivi valgono per `version`."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.version = version
+            self._counters["invalidations"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            entries = self._size
+            buckets = len(self._entries)
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            **counters,
+            "hit_rate": round(counters["hits"] / lookups, 4) if lookups else None,
+            "entries": entries,
+            "buckets": buckets,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "bucket_minutes": self.bucket_minutes,
+            "version": self.version,
+        }
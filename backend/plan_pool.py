@@ -0,0 +1,88 @@
+"""
+Calcolo di /plan in un pool di processi invece che nel thread della richiesta.
+
+Ogni processo del pool carica il dataset da gtfs-out/ (snapshot in mmap) e tiene il proprio
+planner con le connessioni per data già costruite, così le scansioni CSA non si contendono il
+GIL del server: il thread della richiesta aspetta soltanto il risultato.
+Le richieste identiche già in corso condividono lo stesso calcolo; oltre max_pending calcoli
+distinti in attesa si rifiuta subito (Overloaded -> 503) invece di allungare la coda.
+"""
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+
+from planner import _init_batch_worker, _run_plan
+
+class Overloaded(Exception):
+    pass
+
+class PlanDispatcher:
+    def __init__(self, out_dir: str, workers: int, max_pending: int = 64, cache_size: int = 16,
+                 min_transfer: int = 0, transfer_minutes: Optional[Dict[str, int]] = None,
+                 prewarm_days: int = 0, prewarm_start: Optional[str] = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._initargs = (str(out_dir), cache_size, min_transfer, transfer_minutes or {}, prewarm_days, prewarm_start)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._version: Optional[str] = None
+        self._inflight: Dict[tuple, Future] = {}
+        # RLock: add_done_callback su un future già concluso richiama _done nello stesso thread
+        self._lock = threading.RLock()
+        self._counters = {"computed": 0, "coalesced": 0, "rejected": 0, "failed": 0}
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # creato al primo uso, quindi nel worker gunicorn e non nel master prima del fork
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_batch_worker,
+                                             initargs=self._initargs)
+        return self._pool
+
+    def reset(self, version: Optional[str] = None):
+        """Nuovo dataset: i processi attuali finiscono quanto hanno in coda, i prossimi calcoli vanno a un pool nuovo."""
+        with self._lock:
+            old, self._pool = self._pool, None
+            self._version = version
+            self._inflight.clear()
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def plan(self, origin: str, destination: str, date: str, departure_after: str, optimize: str,
+             min_transfer: Optional[int] = None, solver: Optional[str] = None, debug: bool = False) -> Dict:
+        """Come MultiModalPlanner.plan, calcolato nel pool."""
+        args = (origin, destination, date, departure_after, optimize, min_transfer, solver, debug)
+        key = (self._version,) + args
+        pool = None
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self._counters["coalesced"] += 1
+            else:
+                if len(self._inflight) >= self.max_pending:
+                    self._counters["rejected"] += 1
+                    raise Overloaded(f"troppe richieste in coda ({self.max_pending}), riprovare tra poco")
+                pool = self._get_pool()
+                fut = pool.submit(_run_plan, args)
+                self._inflight[key] = fut
+                self._counters["computed"] += 1
+                fut.add_done_callback(lambda f, key=key: self._done(key, f))
+        try:
+            return fut.result()
+        except BrokenProcessPool:
+            # un processo del pool è morto: il prossimo calcolo ne avvia uno nuovo
+            with self._lock:
+                if pool is not None and self._pool is pool:
+                    self._pool = None
+            raise
+
+    def _done(self, key: tuple, fut: Future):
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+            if fut.cancelled() or fut.exception() is not None:
+                self._counters["failed"] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._counters, "pending": len(self._inflight), "max_pending": self.max_pending,
+                    "workers": self.workers, "version": self._version}
@@ -1,17 +1,21 @@
+from array import array
+from bisect import bisect_left, bisect_right
 from dataclasses import dataclass
-from typing import Dict, List, Optional
-from collections import defaultdict
+from operator import itemgetter
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date as date_cls, datetime, timedelta
 import math
+import threading
+import time
 
-def parse_hhmmss_to_minutes(t: str) -> Optional[int]:
-    if not t:
-        return None
-    parts = t.split(':')
-    if len(parts) < 2:
-        return None
-    h, m = int(parts[0]), int(parts[1])
-    s = int(parts[2]) if len(parts) == 3 else 0
-    return h * 60 + m + s // 60
+from gtfs_repo import parse_hhmmss_to_minutes
+
+def fmt_minutes(m: int) -> str:
+    h = m // 60
+    r = m % 60
+    return f"{h:02d}:{r:02d}"
 
 @dataclass
 class Connection:
@@ -27,56 +31,165 @@ class Connection:
 class Label:
     arr_time: int
     transfers: int
-    last_trip: Optional[str]
+    last_trip: Optional[int]       # indice trip nella ConnectionTable
     prev: Optional['Label']
-    reached_by: Optional[Connection]
-    stop: str
+    reached_by: Optional[int]      # connessione di discesa (indice nella ConnectionTable)
+    stop: int                      # indice fermata (repo.stop_ids)
+    boarded_at: Optional[int] = None   # connessione di salita sullo stesso trip (default: reached_by)
+
+class ConnectionTable:
+    """
+    Connessioni di un giorno in array paralleli, ordinate per orario di partenza.
+    Le fermate sono indici del repository; trip_idx indicizza `trips`, la tabella
+    dei trip attivi nel giorno (indice globale repo.trip_ids), e hop è la posizione
+    della connessione lungo il proprio trip. `derived` conserva strutture calcolate
+    dagli altri solver per lo stesso giorno, così seguono la stessa cache.
+    """
+    __slots__ = ("date", "trips", "dep_stop", "arr_stop", "dep_time", "arr_time", "trip_idx", "hop", "derived")
+
+    def __init__(self, date: str):
+        self.date = date
+        self.trips = array('i')
+        self.dep_stop = array('i')
+        self.arr_stop = array('i')
+        self.dep_time = array('i')
+        self.arr_time = array('i')
+        self.trip_idx = array('i')
+        self.hop = array('i')
+        self.derived: Dict[str, object] = {}
+
+    def __len__(self):
+        return len(self.dep_time)
 
 class MultiModalPlanner:
     """
     - optimize='time'        → arrivo più presto
     - optimize='transfers'   → meno cambi 
+    - optimize='pareto'      → fronte completo (arrivo, cambi) con RAPTOR
+
+    solver='raptor' usa RAPTOR anche per 'time'/'transfers' (default: CSA).
+    profile() restituisce tutte le partenze ottime in una finestra oraria.
+
+    min_transfer: minuti minimi per cambiare trip in una fermata,
+    transfer_minutes: eventuali valori specifici per fermata (stop_id -> minuti).
     """
-    def __init__(self, repo):
+    def __init__(self, repo, cache_size: int = 16, min_transfer: int = 0,
+                 transfer_minutes: Optional[Dict[str, int]] = None):
         self.repo = repo
+        self.min_transfer = min_transfer
+        self.transfer_minutes = dict(transfer_minutes or {})
+        self._change = self._change_times(min_transfer)
+        # cache LRU data -> connessioni ordinate (le query cadono quasi sempre sugli stessi giorni)
+        self.cache_size = max(1, cache_size)
+        self._conn_cache: "OrderedDict[str, ConnectionTable]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._raptor = None
 
-    def build_connections(self, date: str) -> List[Connection]:
-        conns: List[Connection] = []
-        for trip_id, trip in self.repo.timetable.items():
-            if not self.repo.service_active(trip, date):
-                continue
-            route = self.repo.routes.get(trip['route_id'], {})
-            mode = route.get('mode', 'train')
-            stops = trip['stops']
-            for i in range(len(stops) - 1):
-                s_from = stops[i]
-                s_to = stops[i+1]
-                dep_m = parse_hhmmss_to_minutes(s_from[1])
-                arr_m = parse_hhmmss_to_minutes(s_to[2])
-                if dep_m is None or arr_m is None:
-                    continue
-                conns.append(Connection(
-                    dep_stop=s_from[0],
-                    arr_stop=s_to[0],
-                    dep_time=dep_m,
-                    arr_time=arr_m,
-                    trip_id=trip_id,
-                    route_id=trip['route_id'],
-                    mode=mode
-                ))
-        conns.sort(key=lambda c: c.dep_time)
+        # orari già convertiti in minuti, una volta per trip: (dep_stop, arr_stop, dep, arr)
+        self._trip_hops: List[List[Tuple[int, int, int, int]]] = []
+        for g in range(len(repo.trip_ids)):
+            stops, dep, arr = self.timed_schedule(g)
+            self._trip_hops.append([(stops[i], stops[i+1], dep[i], arr[i+1]) for i in range(len(stops) - 1)])
+        self._trip_route: List[int] = list(repo.trip_route)
+
+    def timed_schedule(self, g: int) -> Tuple[List[int], List[int], List[int]]:
+        """
+        Fermate e orari del trip g come li usano i solver (la tratta h va dalla fermata h
+        alla h+1): a un orario mancante si sostituisce l'altro della stessa fermata, le
+        fermate senza orari si saltano e il trip prosegue dalla successiva.
+        """
+        stops, dep, arr = self.repo.trip_schedule(g)
+        rows = [(s, d if d is not None else a, a if a is not None else d)
+                for s, d, a in zip(stops, dep, arr) if d is not None or a is not None]
+        return [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]
+
+    def _change_times(self, min_transfer: int) -> List[int]:
+        """Tempo di cambio per indice fermata."""
+        return [self.transfer_minutes.get(stop_id, min_transfer) for stop_id in self.repo.stop_ids]
+
+    def connections_for(self, date: str, info: Optional[Dict] = None) -> ConnectionTable:
+        """
+        Connessioni del giorno dalla cache, costruite al primo accesso.
+        Se si passa info, info["cached"] dice se erano già in cache.
+        """
+        with self._cache_lock:
+            conns = self._conn_cache.get(date)
+            if conns is not None:
+                self._conn_cache.move_to_end(date)
+                if info is not None:
+                    info["cached"] = True
+                return conns
+
+        if info is not None:
+            info["cached"] = False
+        conns = self.build_connections(date)
+
+        with self._cache_lock:
+            self._conn_cache[date] = conns
+            self._conn_cache.move_to_end(date)
+            while len(self._conn_cache) > self.cache_size:
+                self._conn_cache.popitem(last=False)
         return conns
 
+    def prewarm(self, days: int, start: Optional[str] = None) -> List[str]:
+        """Precalcola le connessioni per i prossimi `days` giorni (da `start` YYYYMMDD o da oggi)."""
+        first = datetime.strptime(start, "%Y%m%d").date() if start else date_cls.today()
+        dates = [(first + timedelta(days=i)).strftime("%Y%m%d") for i in range(min(days, self.cache_size))]
+        for d in dates:
+            self.connections_for(d)
+        return dates
+
+    @property
+    def raptor(self):
+        if self._raptor is None:
+            from raptor import RaptorSolver
+            self._raptor = RaptorSolver(self)
+        return self._raptor
+
+    def invalidate(self):
+        """Svuota la cache (da chiamare quando il repository viene ricaricato)."""
+        with self._cache_lock:
+            self._conn_cache.clear()
+
+    def build_connections(self, date: str) -> ConnectionTable:
+        table = ConnectionTable(date)
+        rows = []
+        for g in self.repo.trips_on(date):
+            t = len(table.trips)
+            table.trips.append(g)
+            for h, (dep_s, arr_s, dep_m, arr_m) in enumerate(self._trip_hops[g]):
+                rows.append((dep_m, arr_m, dep_s, arr_s, t, h))
+        rows.sort(key=itemgetter(0))
+
+        if rows:
+            dep_m, arr_m, dep_s, arr_s, trips, hops = zip(*rows)
+            table.dep_time.extend(dep_m)
+            table.arr_time.extend(arr_m)
+            table.dep_stop.extend(dep_s)
+            table.arr_stop.extend(arr_s)
+            table.trip_idx.extend(trips)
+            table.hop.extend(hops)
+        return table
+
+    def _hop_connection(self, g: int, h: int) -> Connection:
+        """Connection per la tratta h del trip con indice globale g."""
+        dep_s, arr_s, dep_m, arr_m = self._trip_hops[g][h]
+        route_id = self.repo.route_ids[self._trip_route[g]]
+        return Connection(
+            dep_stop=self.repo.stop_ids[dep_s],
+            arr_stop=self.repo.stop_ids[arr_s],
+            dep_time=dep_m,
+            arr_time=arr_m,
+            trip_id=self.repo.trip_ids[g],
+            route_id=route_id,
+            mode=self.repo.routes.get(route_id, {}).get('mode', 'train')
+        )
+
     def _segment_json(self, conn: Connection) -> Dict:
         stop_from = self.repo.stops.get(conn.dep_stop, {})
         stop_to = self.repo.stops.get(conn.arr_stop, {})
         route = self.repo.routes.get(conn.route_id, {})
 
-        def fmt(m):
-            h = m // 60
-            r = m % 60
-            return f"{h:02d}:{r:02d}"
-
         return {
             "mode": conn.mode,
             "route_id": conn.route_id,
@@ -84,16 +197,20 @@ class MultiModalPlanner:
             "trip_id": conn.trip_id,
             "from_stop": {"id": conn.dep_stop, "name": stop_from.get('name', conn.dep_stop)},
             "to_stop": {"id": conn.arr_stop, "name": stop_to.get('name', conn.arr_stop)},
-            "departure": fmt(conn.dep_time),
-            "arrival": fmt(conn.arr_time),
+            "departure": fmt_minutes(conn.dep_time),
+            "arrival": fmt_minutes(conn.arr_time),
             "duration": conn.arr_time - conn.dep_time
         }
 
-    def _reconstruct(self, label: Label) -> List[Connection]:
+    def _reconstruct(self, table: ConnectionTable, label: Label) -> List[Connection]:
+        """Risale le etichette e materializza le Connection solo per il viaggio scelto."""
         seq: List[Connection] = []
         cur = label
-        while cur and cur.reached_by:
-            seq.append(cur.reached_by)
+        while cur and cur.reached_by is not None:
+            board = cur.reached_by if cur.boarded_at is None else cur.boarded_at
+            g = table.trips[table.trip_idx[cur.reached_by]]
+            for h in range(table.hop[cur.reached_by], table.hop[board] - 1, -1):
+                seq.append(self._hop_connection(g, h))
             cur = cur.prev
         return list(reversed(seq))
 
@@ -102,11 +219,6 @@ class MultiModalPlanner:
         legs = []
         cur = None
 
-        def fmt(m):
-            h = m // 60
-            r = m % 60
-            return f"{h:02d}:{r:02d}"
-
         for c in conns:
             if cur is None or cur['trip_id'] != c.trip_id:
                 if cur is not None:
@@ -118,111 +230,561 @@ class MultiModalPlanner:
                     "mode": c.mode,
                     "from_stop": self.repo.stops.get(c.dep_stop, {"name": c.dep_stop}),
                     "to_stop": self.repo.stops.get(c.arr_stop, {"name": c.arr_stop}),
-                    "departure": fmt(c.dep_time),
-                    "arrival": fmt(c.arr_time),
+                    "departure": fmt_minutes(c.dep_time),
+                    "arrival": fmt_minutes(c.arr_time),
                     "duration": c.arr_time - c.dep_time,
                     "segments": [self._segment_json(c)]
                 }
             else:
                 cur["to_stop"] = self.repo.stops.get(c.arr_stop, {"name": c.arr_stop})
-                cur["arrival"] = fmt(c.arr_time)
+                cur["arrival"] = fmt_minutes(c.arr_time)
                 cur["duration"] += (c.arr_time - c.dep_time)
                 cur["segments"].append(self._segment_json(c))
         if cur is not None:
             legs.append(cur)
         return legs
 
-    def plan(self, origin: str, destination: str, date: str, departure_after: str, optimize: str):
+    def plan(self, origin: str, destination: str, date: str, departure_after: str, optimize: str,
+             min_transfer: Optional[int] = None, solver: Optional[str] = None, debug: bool = False):
+        """
+        Con debug=True il risultato ha anche "debug": secondi spesi per fase (connections, scan,
+        reconstruct, assemble), se le connessioni del giorno erano in cache e il solver usato.
+        """
+        phases: Dict[str, float] = {}
+        conn_info: Dict = {}
+        t0 = time.perf_counter()
         dep_after = parse_hhmmss_to_minutes(departure_after) if departure_after else 0
-        conns = self.build_connections(date)
+        table = self.connections_for(date, info=conn_info)
+        change = self._change if min_transfer is None else self._change_times(min_transfer)
+        phases["connections"] = time.perf_counter() - t0
 
-        if optimize == 'transfers':
-            label = self._plan_min_transfers(conns, origin, destination, dep_after)
-            solver = "csa-transfers"
+        if solver == 'raptor' or optimize == 'pareto':
+            res = self._plan_raptor(table, origin, destination, date, dep_after, optimize, change, phases=phases)
+            solver = "raptor"
         else:
-            label = self._plan_earliest_arrival(conns, origin, destination, dep_after)
-            solver = "csa-time"
+            t0 = time.perf_counter()
+            if optimize == 'transfers':
+                label, scan = self._plan_min_transfers(table, origin, destination, dep_after, change)
+                solver = "csa-transfers"
+            else:
+                label, scan = self._plan_earliest_arrival(table, origin, destination, dep_after, change)
+                solver = "csa-time"
+            phases["scan"] = time.perf_counter() - t0
+            res = self._label_result(table, label, scan, origin, destination, date, dep_after, optimize, solver,
+                                     phases=phases)
 
-        if label is None:
-            return {"found": False, "message": "Nessun itinerario trovato"}
+        if debug:
+            res["debug"] = {
+                "solver": solver,
+                "connections_cached": conn_info["cached"],
+                "phases": {k: round(v, 6) for k, v in phases.items()},
+                "total_seconds": round(sum(phases.values()), 6),
+            }
+        return res
 
-        segments = self._reconstruct(label)
-        segments_json = [self._segment_json(seg) for seg in segments]
-        legs = self.build_legs(segments)
-
-        unique_trips = [leg["trip_id"] for leg in legs]
-        trip_changes = max(0, len(unique_trips) - 1)
-        total_minutes = (label.arr_time - dep_after) if label.arr_time >= dep_after else label.arr_time
+    def _label_result(self, table: ConnectionTable, label: Optional[Label], scan: Dict, origin: str,
+                      destination: str, date: str, dep_after: int, optimize: str, solver: str,
+                      phases: Optional[Dict[str, float]] = None) -> Dict:
+        if label is None:
+            return {"found": False, "message": "Nessun itinerario trovato", "scan": scan}
 
-        return {
-            "found": True,
+        t0 = time.perf_counter()
+        segments = self._reconstruct(table, label)
+        t1 = time.perf_counter()
+        res = self._journey_json(segments, label.arr_time, label.transfers, dep_after)
+        if phases is not None:
+            phases["reconstruct"] = t1 - t0
+            phases["assemble"] = time.perf_counter() - t1
+        res.update({
             "origin": origin,
             "destination": destination,
             "date": date,
             "optimize": optimize,
             "solver": solver,
+            "scan": scan
+        })
+        return res
+
+    def _journey_json(self, segments: List[Connection], arr_time: int, transfers: int, dep_after: int) -> Dict:
+        segments_json = [self._segment_json(seg) for seg in segments]
+        legs = self.build_legs(segments)
+        total_minutes = (arr_time - dep_after) if arr_time >= dep_after else arr_time
+        return {
+            "found": True,
             "total_minutes": total_minutes,
-            "transfers": trip_changes,          
-            "segments_count": len(segments_json), 
-            "unique_trips": unique_trips,
+            "transfers": transfers,
+            "segments_count": len(segments_json),
+            "unique_trips": [leg["trip_id"] for leg in legs],
             "segments": segments_json,
             "legs": legs
         }
 
-    def _plan_earliest_arrival(self, conns: List[Connection], origin: str, destination: str, dep_after: int) -> Optional[Label]:
-        best_arrival: Dict[str, Label] = {}
-        best_arrival[origin] = Label(arr_time=dep_after, transfers=0, last_trip=None, prev=None, reached_by=None, stop=origin)
+    def _plan_raptor(self, table: ConnectionTable, origin: str, destination: str, date: str,
+                     dep_after: int, optimize: str, change: List[int],
+                     phases: Optional[Dict[str, float]] = None) -> Dict:
+        t0 = time.perf_counter()
+        front, scan = self.raptor.solve(table, origin, destination, dep_after, change)
+        scan["pareto_size"] = len(front)
+        t_scan = time.perf_counter() - t0
+        if phases is not None:
+            phases["scan"] = t_scan
+        if not front:
+            message = "Nessun itinerario trovato"
+            if scan.get("round_limit"):
+                message += f" con al più {self.raptor.max_rounds} trip (limite dei round RAPTOR)"
+            return {"found": False, "message": message, "scan": scan}
 
-        for c in conns:
-            if c.dep_time < dep_after:
+        options = []
+        t_reconstruct = t_assemble = 0.0
+        for j in front:
+            t0 = time.perf_counter()
+            segments = [self._hop_connection(g, h) for g, board, alight in j.legs for h in range(board, alight)]
+            t1 = time.perf_counter()
+            options.append(self._journey_json(segments, j.arr_time, j.transfers, dep_after))
+            t_reconstruct += t1 - t0
+            t_assemble += time.perf_counter() - t1
+        if phases is not None:
+            phases["reconstruct"] = t_reconstruct
+            phases["assemble"] = t_assemble
+
+        # il fronte è ordinato per cambi crescenti e arrivo decrescente
+        res = dict(options[-1] if optimize == 'time' else options[0])
+        res.update({
+            "origin": origin,
+            "destination": destination,
+            "date": date,
+            "optimize": optimize,
+            "solver": "raptor",
+            "pareto": options,
+            "scan": scan
+        })
+        return res
+
+    @staticmethod
+    def _scan_stats(table: ConnectionTable, start: int, end: int, **counters) -> Dict:
+        return {
+            "connections": len(table),
+            "start_index": start,
+            "scanned": end - start,
+            "early_exit": end < len(table),
+            **counters
+        }
+
+    def _plan_earliest_arrival(self, table: ConnectionTable, origin: str, destination: str, dep_after: int,
+                               change: List[int]) -> Tuple[Optional[Label], Dict]:
+        o = self.repo.stop_index.get(origin)
+        d = self.repo.stop_index.get(destination)
+        if o is None or d is None:
+            return None, self._scan_stats(table, 0, 0)
+        best, scan = self._scan_earliest_arrival(table, o, dep_after, change, target=d)
+        return best[d], scan
+
+    def _scan_earliest_arrival(self, table: ConnectionTable, o: int, dep_after: int, change: List[int],
+                               target: Optional[int] = None, until: float = math.inf) -> Tuple[List[Optional[Label]], Dict]:
+        """
+        CSA con flag di raggiungibilità per trip: una volta saliti su un trip
+        tutte le sue connessioni successive sono utilizzabili senza cambio.
+        Con target la scansione si ferma quando la destinazione è fissata,
+        senza target calcola l'arrivo migliore verso tutte le fermate (fino a `until`).
+
+        Ogni fermata tiene le etichette non dominate per (arrivo, cambi), in ordine di arrivo
+        crescente e cambi decrescenti, e ogni trip la salita con meno cambi tra quelle possibili:
+        così a parità di arrivo si ottiene il minimo dei cambi, non solo il primo percorso trovato.
+        Il risultato è, per fermata, l'etichetta con arrivo minimo (None se non raggiunta).
+        """
+        n_stops = len(self.repo.stop_ids)
+        origin = Label(arr_time=dep_after, transfers=0, last_trip=None, prev=None, reached_by=None, stop=o)
+        bags: List[List[Label]] = [[] for _ in range(n_stops)]
+        bag_arr: List[List[int]] = [[] for _ in range(n_stops)]
+        bag_ready: List[List[int]] = [[] for _ in range(n_stops)]   # primo orario utile per un altro trip
+        bags[o].append(origin)
+        bag_arr[o].append(dep_after)
+        bag_ready[o].append(dep_after)
+        best_arr = [math.inf] * n_stops
+        best_arr[o] = dep_after
+
+        n_trips = len(table.trips)
+        reached = bytearray(n_trips)
+        board_conn = [0] * n_trips
+        board_label: List[Optional[Label]] = [None] * n_trips
+        board_cost = [0] * n_trips          # cambi di chi prosegue sul trip
+
+        dep_stop, arr_stop = table.dep_stop, table.arr_stop
+        dep_time, arr_time, trip_idx = table.dep_time, table.arr_time, table.trip_idx
+        created = 0
+        # le connessioni sono ordinate per partenza: si parte dalla prima utile
+        start = end = bisect_left(dep_time, dep_after)
+        for i in range(start, len(table)):
+            c_dep = dep_time[i]
+            # nessuna connessione che parte da qui in poi può arrivare prima (o con meno cambi
+            # allo stesso orario: servirebbe partire e arrivare nello stesso minuto)
+            if c_dep >= until or (target is not None and c_dep > best_arr[target]):
+                break
+            end = i + 1
+            t = trip_idx[i]
+            s = dep_stop[i]
+            ready = bag_ready[s]
+            if ready and ready[0] <= c_dep:
+                # tra le etichette pronte, l'ultima in ordine di arrivo è quella con meno cambi
+                lab = bags[s][bisect_right(ready, c_dep) - 1]
+                cost = lab.transfers + (lab.reached_by is not None)
+                if not reached[t] or cost < board_cost[t]:
+                    reached[t] = 1
+                    board_conn[t] = i
+                    board_label[t] = lab
+                    board_cost[t] = cost
+            if not reached[t]:
                 continue
-            if c.dep_stop not in best_arrival:
+
+            a = arr_stop[i]
+            c_arr = arr_time[i]
+            transfers = board_cost[t]
+            arrs, bag = bag_arr[a], bags[a]
+            k = bisect_right(arrs, c_arr)
+            # dominata da un'etichetta che arriva non dopo con non più cambi
+            if k and bag[k - 1].transfers <= transfers:
                 continue
-            cur_label = best_arrival[c.dep_stop]
-            if cur_label.arr_time <= c.dep_time:
-                if (c.arr_time < best_arrival.get(c.arr_stop, Label(math.inf, 0, None, None, None, c.arr_stop)).arr_time):
-                    new_label = Label(
-                        arr_time=c.arr_time,
-                        transfers=cur_label.transfers + (0 if cur_label.last_trip == c.trip_id else 1 if cur_label.last_trip is not None else 0),
-                        last_trip=c.trip_id,
-                        prev=cur_label,
-                        reached_by=c,
-                        stop=c.arr_stop
-                    )
-                    best_arrival[c.arr_stop] = new_label
-
-        return best_arrival.get(destination)
-
-    def _plan_min_transfers(self, conns: List[Connection], origin: str, destination: str, dep_after: int) -> Optional[Label]:
-        labels: Dict[str, List[Label]] = defaultdict(list)
-        labels[origin].append(Label(dep_after, 0, None, None, None, origin))
-
-        def dominated(new_l: Label, existing: List[Label]) -> bool:
-            for l in existing:
-                if l.transfers <= new_l.transfers and l.arr_time <= new_l.arr_time:
-                    return True
-            return False
+            # via quelle che arrivano non prima con non meno cambi
+            j = k
+            while j < len(bag) and bag[j].transfers >= transfers:
+                j += 1
+            label = Label(
+                arr_time=c_arr,
+                transfers=transfers,
+                last_trip=t,
+                prev=board_label[t],
+                reached_by=i,
+                stop=a,
+                boarded_at=board_conn[t]
+            )
+            if k and arrs[k - 1] == c_arr:
+                # stesso arrivo con più cambi: sostituita
+                k -= 1
+            bag[k:j] = [label]
+            arrs[k:j] = [c_arr]
+            bag_ready[a][k:j] = [c_arr + change[a]]
+            if c_arr < best_arr[a]:
+                best_arr[a] = c_arr
+            created += 1
 
-        for c in conns:
-            if c.dep_time < dep_after:
+        best = [bag[0] if bag else None for bag in bags]
+        return best, self._scan_stats(table, start, end, labels=created)
+
+    def _plan_min_transfers(self, table: ConnectionTable, origin: str, destination: str, dep_after: int,
+                            change: List[int]) -> Tuple[Optional[Label], Dict]:
+        o = self.repo.stop_index.get(origin)
+        d = self.repo.stop_index.get(destination)
+        if o is None or d is None:
+            return None, self._scan_stats(table, 0, 0)
+
+        labels: List[List[Label]] = [[] for _ in range(len(self.repo.stop_ids))]
+        labels[o].append(Label(dep_after, 0, None, None, None, o))
+
+        def dominates(l: Label, other: Label, c_change: int) -> bool:
+            """
+            l può prendere tutto quello che prende other, con non più cambi: stesso trip (o
+            l è l'origine) e arrivo non dopo, oppure può cambiare sul trip di other in tempo
+            e anche con quel cambio non fa più cambi di lui.
+            """
+            if l.arr_time > other.arr_time or l.transfers > other.transfers:
+                return False
+            return (l.last_trip == other.last_trip or l.last_trip is None
+                    or (l.transfers < other.transfers and l.arr_time + c_change <= other.arr_time))
+
+        dep_stop, arr_stop = table.dep_stop, table.arr_stop
+        dep_time, arr_time, trip_idx = table.dep_time, table.arr_time, table.trip_idx
+        # migliore (cambi, arrivo) a destinazione: le etichette che non possono fare meglio si scartano
+        target = (math.inf, math.inf)
+        created = 0
+        start = end = bisect_left(dep_time, dep_after)
+        for i in range(start, len(table)):
+            c_dep = dep_time[i]
+            # arrivo diretto già trovato: nessuna partenza successiva arriva prima
+            if target[0] == 0 and c_dep >= target[1]:
+                break
+            end = i + 1
+            from_labels = labels[dep_stop[i]]
+            if not from_labels:
+                continue
+
+            a = arr_stop[i]
+            t = trip_idx[i]
+            c_change = change[dep_stop[i]]
+            for lab in list(from_labels):
+                if lab.last_trip == t or lab.last_trip is None:
+                    if lab.arr_time > c_dep:
+                        continue
+                    transfers = lab.transfers
+                elif lab.arr_time + c_change <= c_dep:
+                    transfers = lab.transfers + 1
+                else:
+                    continue
+                if (transfers, arr_time[i]) >= target:
+                    continue
+                new_label = Label(
+                    arr_time=arr_time[i],
+                    transfers=transfers,
+                    last_trip=t,
+                    prev=lab,
+                    reached_by=i,
+                    stop=a
+                )
+                created += 1
+                a_change = change[a]
+                if not any(dominates(l, new_label, a_change) for l in labels[a]):
+                    labels[a] = [l for l in labels[a] if not dominates(new_label, l, a_change)]
+                    labels[a].append(new_label)
+                    if a == d:
+                        target = min(target, (transfers, new_label.arr_time))
+
+        # insiemi di Pareto (arrivo, cambi): il più grande tra le fermate e quello della destinazione
+        scan = self._scan_stats(table, start, end, labels=created, pareto_max=max(map(len, labels), default=0),
+                                pareto_size=len(labels[d]))
+        if not labels[d]:
+            return None, scan
+
+        return min(labels[d], key=lambda l: (l.transfers, l.arr_time)), scan
+
+    def plan_many(self, requests: List[Dict], workers: Optional[int] = None,
+                  parallel_threshold: int = 200) -> List[Dict]:
+        """
+        Pianifica molte richieste {origin, destination, date, depart_after, optimize, min_transfer, solver}.
+        Le connessioni si costruiscono una volta per data e per optimize='time' si fa una sola
+        scansione one-to-all per ogni origine/orario distinto. Con workers > 1 e almeno
+        parallel_threshold richieste le date vengono distribuite su un pool di processi.
+        Il risultato i-esimo corrisponde alla richiesta i-esima.
+        """
+        results: List[Optional[Dict]] = [None] * len(requests)
+        by_date: Dict[Optional[str], List[Tuple[int, Dict]]] = {}
+        for i, req in enumerate(requests):
+            # una richiesta malformata dà errore solo per sé, non per tutto il batch
+            if not isinstance(req, dict):
+                results[i] = {"found": False, "message": "ogni richiesta deve essere un oggetto"}
+                continue
+            date = req.get('date')
+            if date is not None and not isinstance(date, str):
+                results[i] = {"found": False, "message": "date deve essere YYYYMMDD"}
+                continue
+            by_date.setdefault(date, []).append((i, req))
+
+        if workers and workers > 1 and len(requests) >= parallel_threshold and len(by_date) > 1:
+            init = (str(self.repo.out_dir), self.cache_size, self.min_transfer, self.transfer_minutes)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=init) as pool:
+                for chunk in pool.map(_run_batch_chunk, by_date.values()):
+                    for i, res in chunk:
+                        results[i] = res
+        else:
+            for chunk in by_date.values():
+                for i, res in self._plan_date_group(chunk):
+                    results[i] = res
+        return results
+
+    def _plan_date_group(self, chunk: List[Tuple[int, Dict]]) -> List[Tuple[int, Dict]]:
+        """Richieste della stessa data: le scansioni earliest-arrival sono condivise per origine."""
+        out = []
+        scans: Dict[Tuple[str, int, Optional[int]], Tuple[List[Optional[Label]], Dict]] = {}
+        for i, req in chunk:
+            origin, destination, date = req.get('origin'), req.get('destination'), req.get('date')
+            optimize = req.get('optimize', 'time')
+            min_transfer = req.get('min_transfer')
+            if not origin or not destination or not date:
+                out.append((i, {"found": False, "message": "origin, destination, date sono obbligatori"}))
+                continue
+            depart_after = req.get('depart_after', '00:00:00')
+            try:
+                dep_after = parse_hhmmss_to_minutes(depart_after) if isinstance(depart_after, str) else None
+            except ValueError:
+                dep_after = None
+            if dep_after is None:
+                out.append((i, {"found": False, "message": "depart_after deve essere HH:MM[:SS]"}))
+                continue
+            if optimize != 'time' or req.get('solver') == 'raptor':
+                out.append((i, self.plan(origin, destination, date, depart_after,
+                                         optimize, min_transfer=min_transfer, solver=req.get('solver'))))
+                continue
+
+            o = self.repo.stop_index.get(origin)
+            d = self.repo.stop_index.get(destination)
+            table = self.connections_for(date)
+            if o is None or d is None:
+                label, scan = None, self._scan_stats(table, 0, 0)
+            else:
+                key = (origin, dep_after, min_transfer)
+                if key not in scans:
+                    change = self._change if min_transfer is None else self._change_times(min_transfer)
+                    scans[key] = self._scan_earliest_arrival(table, o, dep_after, change)
+                best, scan = scans[key]
+                label = best[d]
+            out.append((i, self._label_result(table, label, scan, origin, destination, date, dep_after,
+                                              optimize, "csa-time")))
+        return out
+
+    def isochrone(self, origin: str, date: str, departure_after: str, max_minutes: Optional[int] = None,
+                  min_transfer: Optional[int] = None) -> Dict:
+        """Arrivo migliore (e cambi) verso tutte le fermate da origin, con una sola scansione."""
+        dep_after = parse_hhmmss_to_minutes(departure_after) if departure_after else 0
+        table = self.connections_for(date)
+        change = self._change if min_transfer is None else self._change_times(min_transfer)
+
+        o = self.repo.stop_index.get(origin)
+        if o is None:
+            return {"found": False, "message": f"Fermata {origin} sconosciuta"}
+        until = dep_after + max_minutes if max_minutes is not None else math.inf
+        best, scan = self._scan_earliest_arrival(table, o, dep_after, change, until=until)
+
+        stops = {}
+        for stop_id, stop in self.repo.stops.items():
+            label = best[self.repo.stop_index[stop_id]]
+            if label is None or label.arr_time > until:
+                stops[stop_id] = {"name": stop.get('name', stop_id), "lat": stop.get('lat'), "lon": stop.get('lon'),
+                                  "reachable": False, "arrival": None, "minutes": None, "transfers": None}
+            else:
+                stops[stop_id] = {"name": stop.get('name', stop_id), "lat": stop.get('lat'), "lon": stop.get('lon'),
+                                  "reachable": True, "arrival": fmt_minutes(label.arr_time),
+                                  "minutes": label.arr_time - dep_after, "transfers": label.transfers}
+
+        return {
+            "found": True,
+            "origin": origin,
+            "date": date,
+            "depart_after": fmt_minutes(dep_after),
+            "max_minutes": max_minutes,
+            "reachable": sum(1 for v in stops.values() if v["reachable"]),
+            "stops": stops,
+            "scan": scan
+        }
+
+    def profile(self, origin: str, destination: str, date: str, window_from: str, window_to: str,
+                min_transfer: Optional[int] = None) -> Dict:
+        """
+        Profile query: tutte le coppie partenza/arrivo non dominate con partenza
+        da origin nella finestra [window_from, window_to], in un'unica scansione CSA
+        all'indietro.
+        """
+        dep_from = parse_hhmmss_to_minutes(window_from) if window_from else 0
+        dep_to = parse_hhmmss_to_minutes(window_to) if window_to else 48 * 60
+        table = self.connections_for(date)
+        change = self._change if min_transfer is None else self._change_times(min_transfer)
+
+        o = self.repo.stop_index.get(origin)
+        d = self.repo.stop_index.get(destination)
+        options = []
+        if o is None or d is None or o == d:
+            scan = self._scan_stats(table, 0, 0)
+        else:
+            prof, prof_neg_dep, scan = self._profile_scan(table, d, dep_from, change, origin=o, dep_to=dep_to)
+            # il profilo è in ordine di partenza decrescente
+            for dep, arr, enter, exit_ in reversed(prof[o]):
+                if dep > dep_to:
+                    break
+                segments = self._profile_journey(table, d, enter, exit_, change, prof, prof_neg_dep)
+                res = self._journey_json(segments, arr, 0, dep)
+                res["transfers"] = len(res["legs"]) - 1
+                res["departure"] = fmt_minutes(dep)
+                res["arrival"] = fmt_minutes(arr)
+                options.append(res)
+
+        return {
+            "found": bool(options),
+            "origin": origin,
+            "destination": destination,
+            "date": date,
+            "window": {"from": fmt_minutes(dep_from), "to": fmt_minutes(dep_to)},
+            "solver": "csa-profile",
+            "options": options,
+            "scan": scan
+        }
+
+    def _profile_scan(self, table: ConnectionTable, d: int, dep_from: int, change: List[int],
+                      origin: Optional[int] = None, dep_to: float = math.inf):
+        """
+        Scansione all'indietro verso la destinazione d. Il profilo di ogni fermata è una
+        lista di (partenza, arrivo, connessione di salita, connessione di discesa) con
+        partenze e arrivi decrescenti; per ogni trip si tiene il miglior arrivo restandoci sopra.
+        Nel profilo di origin non entrano le partenze dopo dep_to: altrimenti una partenza
+        fuori finestra toglierebbe quelle nella finestra che arrivano alla stessa ora o dopo.
+        """
+        n_stops = len(self.repo.stop_ids)
+        prof: List[List[Tuple[int, int, int, int]]] = [[] for _ in range(n_stops)]
+        prof_neg_dep: List[List[int]] = [[] for _ in range(n_stops)]   # partenze negate, crescenti
+        trip_arr = [math.inf] * len(table.trips)
+        trip_exit = [-1] * len(table.trips)
+
+        dep_stop, arr_stop = table.dep_stop, table.arr_stop
+        dep_time, arr_time, trip_idx = table.dep_time, table.arr_time, table.trip_idx
+        start = bisect_left(dep_time, dep_from)
+        for i in range(len(table) - 1, start - 1, -1):
+            t = trip_idx[i]
+            v = arr_stop[i]
+            if v == d:
+                tau, exit_ = arr_time[i], i
+            else:
+                entry = self._profile_at(prof, prof_neg_dep, v, arr_time[i] + change[v])
+                tau, exit_ = (entry[1], i) if entry else (math.inf, -1)
+            if trip_arr[t] <= tau:
+                tau, exit_ = trip_arr[t], trip_exit[t]
+            else:
+                trip_arr[t], trip_exit[t] = tau, exit_
+            if tau == math.inf:
                 continue
 
-            for lab in list(labels[c.dep_stop]):
-                if lab.arr_time <= c.dep_time:
-                    transfers = lab.transfers + (0 if lab.last_trip == c.trip_id else 1 if lab.last_trip is not None else 0)
-                    new_label = Label(
-                        arr_time=c.arr_time,
-                        transfers=transfers,
-                        last_trip=c.trip_id,
-                        prev=lab,
-                        reached_by=c,
-                        stop=c.arr_stop
-                    )
-                    if not dominated(new_label, labels[c.arr_stop]):
-                        labels[c.arr_stop] = [l for l in labels[c.arr_stop] if not (new_label.transfers <= l.transfers and new_label.arr_time <= l.arr_time)]
-                        labels[c.arr_stop].append(new_label)
-
-        if not labels[destination]:
-            return None
-
-        return min(labels[destination], key=lambda l: (l.transfers, l.arr_time))
+            u = dep_stop[i]
+            c_dep = dep_time[i]
+            if u == origin and c_dep > dep_to:
+                continue
+            entries = prof[u]
+            if entries and entries[-1][1] <= tau:
+                continue
+            if entries and entries[-1][0] == c_dep:
+                entries[-1] = (c_dep, tau, i, exit_)
+            else:
+                entries.append((c_dep, tau, i, exit_))
+                prof_neg_dep[u].append(-c_dep)
+
+        scan = self._scan_stats(table, start, len(table))
+        scan["early_exit"] = False
+        return prof, prof_neg_dep, scan
+
+    @staticmethod
+    def _profile_at(prof, prof_neg_dep, s: int, not_before: int) -> Optional[Tuple[int, int, int, int]]:
+        """Voce del profilo di s con arrivo minimo tra le partenze >= not_before."""
+        k = bisect_right(prof_neg_dep[s], -not_before)
+        return prof[s][k - 1] if k else None
+
+    def _profile_journey(self, table: ConnectionTable, d: int, enter: int, exit_: int,
+                         change: List[int], prof, prof_neg_dep) -> List[Connection]:
+        seq: List[Connection] = []
+        while True:
+            g = table.trips[table.trip_idx[enter]]
+            seq.extend(self._hop_connection(g, h) for h in range(table.hop[enter], table.hop[exit_] + 1))
+            v = table.arr_stop[exit_]
+            if v == d:
+                return seq
+            _, _, enter, exit_ = self._profile_at(prof, prof_neg_dep, v, table.arr_time[exit_] + change[v])
+
+
+# pool di processi per plan_many: ogni worker carica il proprio repository
+_batch_planner: Optional[MultiModalPlanner] = None
+
+def _init_batch_worker(out_dir: str, cache_size: int, min_transfer: int, transfer_minutes: Dict[str, int],
+                       prewarm_days: int = 0, prewarm_start: Optional[str] = None):
+    global _batch_planner
+    from gtfs_repo import GTFSRepository
+    repo = GTFSRepository(out_dir)
+    repo.load()
+    _batch_planner = MultiModalPlanner(repo, cache_size=cache_size, min_transfer=min_transfer,
+                                       transfer_minutes=transfer_minutes)
+    if prewarm_days > 0:
+        _batch_planner.prewarm(prewarm_days, start=prewarm_start)
+
+def _run_batch_chunk(chunk: List[Tuple[int, Dict]]) -> List[Tuple[int, Dict]]:
+    return _batch_planner._plan_date_group(chunk)
+
+def _run_plan(args: Tuple) -> Dict:
+    """
+    Una richiesta /plan nel worker:
+    (origin, destination, date, depart_after, optimize, min_transfer, solver, debug).
+    """
+    origin, destination, date, departure_after, optimize, min_transfer, solver, debug = args
+    return _batch_planner.plan(origin, destination, date, departure_after, optimize,
+                               min_transfer=min_transfer, solver=solver, debug=debug)
@@ -1,16 +1,55 @@
+import codecs
+import hashlib
 import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from datetime import datetime
 
-def safe_read_csv(file_path):
-    try:
-        return pd.read_csv(file_path, encoding='utf-8')
-    except UnicodeDecodeError:
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+from gtfs_repo import MANIFEST_FILE, dataset_version, manifest_version
+from slices import build_slices, slices_fresh
+from snapshot import (SNAPSHOT_FILE, Snapshot, SnapshotShapes, SnapshotTimetable, SnapshotWriter, read_meta,
+                      write_snapshot)
+
+REQUIRED_INPUTS = {
+    "routes.txt",
+    "trips.txt",
+    "stops.txt",
+    "shapes.txt",
+    "stop_times.txt",
+    "calendar_dates.txt"
+}
+
+# colonne lette in modalità streaming (le altre non finiscono negli output)
+TRIP_COLUMNS = ('trip_id', 'route_id', 'service_id', 'trip_headsign', 'shape_id')
+STOP_TIME_COLUMNS = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+SHAPE_COLUMNS = ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']
+
+def detect_encoding(file_path, block_size=1 << 20) -> str:
+    """utf-8 se l'intero file decodifica, altrimenti latin-1 (accetta qualsiasi byte)."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(file_path, 'rb') as f:
         try:
-            return pd.read_csv(file_path, encoding='latin-1')
-        except:
-            return pd.read_csv(file_path, encoding='cp1252')
+            for block in iter(lambda: f.read(block_size), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return 'latin-1'
+    return 'utf-8'
+
+def safe_read_csv(file_path, **kwargs):
+    # encoding rilevato sui byte: il CSV si analizza una volta sola
+    return pd.read_csv(file_path, encoding=detect_encoding(file_path), **kwargs)
 
 def parse_time_to_seconds(time_str):
     if pd.isna(time_str) or time_str == '':
@@ -26,163 +65,587 @@ def parse_time_to_seconds(time_str):
     except ValueError:
         return None
 
-def create_shape_from_stops(stop_times_group, stops_df):
-    coordinates = []
-    stop_times_sorted = stop_times_group.sort_values('stop_sequence')
-    for _, stop_time in stop_times_sorted.iterrows():
-        stop_id = stop_time['stop_id']
-        stop_info = stops_df[stops_df['stop_id'] == stop_id]
-        if not stop_info.empty:
-            stop_data = stop_info.iloc[0]
-            coordinates.append([float(stop_data['stop_lat']), float(stop_data['stop_lon'])])
-    return coordinates
-
-def preprocess_gtfs(in_dir: str, out_dir: str, include_route_types=(2, 3)):
+def create_shape_from_stops(stop_ids, stop_coords):
+    """Shape di ripiego: le coordinate delle fermate del trip, nell'ordine di passaggio."""
+    return [stop_coords[s] for s in stop_ids if s in stop_coords]
+
+def group_bounds(keys: np.ndarray):
+    """Inizio/fine dei blocchi di chiavi uguali in un array già ordinato."""
+    if len(keys) == 0:
+        return []
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [len(keys)]))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def sort_ids(ids) -> list:
+    """
+    Id distinti (stringhe) nell'ordine che darebbe sort_values sulla colonna letta con
+    inferenza dei tipi: numerico se sono tutti numeri, altrimenti lessicografico.
+    """
+    ids = pd.Series(pd.unique(pd.Series(ids, dtype=object)), dtype=object)
+    num = pd.to_numeric(ids, errors='coerce')
+    if len(ids) and num.notna().all():
+        return ids.iloc[np.argsort(num.to_numpy(), kind='mergesort')].tolist()
+    return ids.sort_values(kind='mergesort').tolist()
+
+def partition_bounds(counts: np.ndarray, max_rows: int) -> list:
+    """Confini di partizioni di rank contigui con al più max_rows righe (un rank da solo può superarlo)."""
+    cum = np.cumsum(counts)
+    bounds = [0]
+    done = 0
+    while bounds[-1] < len(counts):
+        end = max(int(np.searchsorted(cum, done + max_rows, 'right')), bounds[-1] + 1)
+        bounds.append(end)
+        done = int(cum[end - 1])
+    return bounds
+
+def spill_partitions(path: Path, key_col: str, ranks: dict, usecols, dtype, convert, record: np.dtype,
+                     chunk_rows: int, tmp_dir):
+    """
+    Legge il CSV a blocchi e distribuisce le righe la cui chiave è in `ranks` su partizioni di
+    rank contigui (al più ~chunk_rows righe), salvate su disco come record `record`
+    (campi 'rank', 'seq' e quelli restituiti da `convert`). Le partizioni tornano una alla
+    volta in ordine di rank e sequenza, a parità nell'ordine del file.
+    Un primo passaggio legge solo la colonna chiave per contare le righe di ogni rank.
+    """
+    if not ranks:
+        return
+    encoding = detect_encoding(path)
+    counts = np.zeros(len(ranks), dtype=np.int64)
+    for chunk in pd.read_csv(path, encoding=encoding, usecols=[key_col], dtype=str, chunksize=chunk_rows):
+        r = chunk[key_col].map(ranks).dropna().to_numpy(dtype=np.int64)
+        counts += np.bincount(r, minlength=len(ranks))
+    bounds = np.asarray(partition_bounds(counts, chunk_rows))
+    files = [Path(tmp_dir) / f"{path.stem}-{i}.bin" for i in range(len(bounds) - 1)]
+
+    for chunk in pd.read_csv(path, encoding=encoding, usecols=usecols, dtype=dtype, chunksize=chunk_rows):
+        r = chunk[key_col].map(ranks)
+        keep = r.notna().to_numpy()
+        if not keep.any():
+            continue
+        chunk = chunk[keep]
+        rows = np.empty(len(chunk), dtype=record)
+        rows['rank'] = r[keep].to_numpy(dtype=np.int32)
+        for name, values in convert(chunk).items():
+            rows[name] = values
+        part = np.searchsorted(bounds, rows['rank'], 'right') - 1
+        order = np.argsort(part, kind='stable')
+        rows, part = rows[order], part[order]
+        for start, end in group_bounds(part):
+            with open(files[part[start]], 'ab') as f:
+                f.write(rows[start:end].tobytes())
+
+    for file in files:
+        if file.exists():
+            rows = np.fromfile(file, dtype=record)
+            file.unlink()
+            yield rows[np.lexsort((rows['seq'], rows['rank']))]
+
+class CodeBook:
+    """Stringhe ripetute (fermate, orari) come codici interi, stabili tra un blocco e l'altro."""
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, series: pd.Series) -> np.ndarray:
+        for v in pd.unique(series):
+            if v not in self.codes:
+                self.codes[v] = len(self.values)
+                self.values.append(v)
+        return series.map(self.codes).to_numpy(dtype=np.int32)
+
+class JsonObjectWriter:
+    """Un oggetto JSON scritto una chiave alla volta, con lo stesso formato di save_json."""
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp = path.with_name(path.name + ".tmp")
+        self.f = open(self.tmp, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, key: str, value):
+        text = json.dumps(value, separators=(',', ':'), ensure_ascii=False, indent=2)
+        self.f.write('{\n  ' if self.count == 0 else ',\n  ')
+        self.f.write(json.dumps(key, ensure_ascii=False) + ':' + text.replace('\n', '\n  '))
+        self.count += 1
+
+    def close(self):
+        self.f.write('\n}' if self.count else '{}')
+        self.f.close()
+        os.replace(self.tmp, self.path)
+
+def stream_shapes_and_timetable(in_dir: Path, out_dir: Path, sel_trips: pd.DataFrame, stops_df: pd.DataFrame,
+                                snapshot: SnapshotWriter, chunk_rows: int):
+    """
+    shapes.json e timetable.json senza caricare stop_times e shapes: i due file si leggono
+    a blocchi con le sole colonne utili, si partizionano su disco per rank di shape/trip e
+    ogni partizione si scrive appena ordinata. In memoria restano i trip selezionati e i
+    codici di fermate e orari. Restituisce (numero di shape, numero di trip).
+    """
+    trip_info = sel_trips.drop_duplicates('trip_id')
+    trip_keys = sort_ids(trip_info['trip_id'])
+    trip_info = trip_info.set_index('trip_id').loc[trip_keys]
+    n = len(trip_keys)
+    route = trip_info['route_id'].astype(str).tolist()
+    service = trip_info['service_id'].astype(str).tolist() if 'service_id' in trip_info else [''] * n
+    headsign = trip_info['trip_headsign'].astype(str).tolist() if 'trip_headsign' in trip_info else [''] * n
+    shape = trip_info['shape_id'].tolist() if 'shape_id' in trip_info else [None] * n
+
+    first_stops = stops_df.drop_duplicates('stop_id')
+    stop_coords = dict(zip(first_stops['stop_id'].astype(str).tolist(),
+                           first_stops[['stop_lat', 'stop_lon']].to_numpy(dtype=float).tolist()))
+
+    shapes_out = JsonObjectWriter(out_dir / 'shapes.json')
+    timetable_out = JsonObjectWriter(out_dir / 'timetable.json')
+    known_shapes = set()
+    n_trips = 0
+    with tempfile.TemporaryDirectory(prefix="oraora-preprocess-") as tmp:
+        shape_keys = sort_ids(trip_info['shape_id'].dropna()) if 'shape_id' in trip_info else []
+        shape_record = np.dtype([('rank', '<i4'), ('seq', '<f8'), ('lat', '<f8'), ('lon', '<f8')])
+        for rows in spill_partitions(
+                in_dir / 'shapes.txt', 'shape_id', {s: i for i, s in enumerate(shape_keys)}, SHAPE_COLUMNS,
+                {'shape_id': str, 'shape_pt_lat': float, 'shape_pt_lon': float, 'shape_pt_sequence': float},
+                lambda c: {'seq': c['shape_pt_sequence'].to_numpy(), 'lat': c['shape_pt_lat'].to_numpy(),
+                           'lon': c['shape_pt_lon'].to_numpy()},
+                shape_record, chunk_rows, tmp):
+            coords = np.column_stack((rows['lat'], rows['lon'])).tolist()
+            for start, end in group_bounds(rows['rank']):
+                shape_id = shape_keys[rows['rank'][start]]
+                shapes_out.write(shape_id, coords[start:end])
+                snapshot.add_shape(shape_id, coords[start:end])
+                known_shapes.add(shape_id)
+
+        stop_book, time_book = CodeBook(), CodeBook()
+        st_record = np.dtype([('rank', '<i4'), ('seq', '<i8'), ('stop', '<i4'), ('dep', '<i4'), ('arr', '<i4')])
+        for rows in spill_partitions(
+                in_dir / 'stop_times.txt', 'trip_id', {t: i for i, t in enumerate(trip_keys)}, STOP_TIME_COLUMNS,
+                {'trip_id': str, 'arrival_time': str, 'departure_time': str, 'stop_id': str, 'stop_sequence': 'int64'},
+                lambda c: {'seq': c['stop_sequence'].to_numpy(), 'stop': stop_book.encode(c['stop_id'].astype(str)),
+                           'dep': time_book.encode(c['departure_time'].astype(str)),
+                           'arr': time_book.encode(c['arrival_time'].astype(str))},
+                st_record, chunk_rows, tmp):
+            ranks = rows['rank']
+            st_stop = [stop_book.values[i] for i in rows['stop'].tolist()]
+            st_dep = [time_book.values[i] for i in rows['dep'].tolist()]
+            st_arr = [time_book.values[i] for i in rows['arr'].tolist()]
+            st_seq = rows['seq'].tolist()
+            for start, end in group_bounds(ranks):
+                r = int(ranks[start])
+                trip_id = trip_keys[r]
+                last = end - 1
+
+                stops_list = [list(row) for row in zip(st_stop[start:end], st_dep[start:end],
+                                                          st_arr[start:end], st_seq[start:end])]
+
+                shape_id = shape[r]
+                if pd.isna(shape_id) or shape_id == '' or str(shape_id) not in known_shapes:
+                    generated_shape_id = f"generated_{trip_id}"
+                    coords = create_shape_from_stops(st_stop[start:end], stop_coords)
+                    if coords:
+                        shapes_out.write(generated_shape_id, coords)
+                        snapshot.add_shape(generated_shape_id, coords)
+                        known_shapes.add(generated_shape_id)
+                        shape_id = generated_shape_id
+                    else:
+                        shape_id = "default"
+
+                dep_time = parse_time_to_seconds(st_dep[start])
+                arr_time = parse_time_to_seconds(st_arr[last])
+                duration_minutes = 0
+                if dep_time is not None and arr_time is not None:
+                    duration_minutes = (arr_time - dep_time) // 60
+
+                trip = {
+                    "route_id": route[r],
+                    "shape_id": str(shape_id),
+                    "service_id": service[r],
+                    "departure": st_dep[start],
+                    "arrival": st_arr[last],
+                    "headsign": headsign[r],
+                    "duration_minutes": duration_minutes,
+                    "stops": stops_list,
+                    "stop_count": len(stops_list)
+                }
+                timetable_out.write(trip_id, trip)
+                snapshot.add_trip(trip_id, trip)
+                n_trips += 1
+
+    shapes_out.close()
+    timetable_out.close()
+    return len(known_shapes), n_trips
+
+PREPROCESS_VERSION = 1
+# stage -> file GTFS da cui dipende / file prodotti in out_dir
+# shapes e timetable si costruiscono insieme: le shape generate dipendono dai trip
+STAGE_INPUTS = {
+    'routes': ('routes.txt',),
+    'stops': ('stops.txt',),
+    'calendar': ('calendar_dates.txt',),
+    'timetable': ('routes.txt', 'trips.txt', 'stops.txt', 'shapes.txt', 'stop_times.txt'),
+}
+STAGE_OUTPUTS = {
+    'routes': ('routes.json',),
+    'stops': ('stops.json',),
+    'calendar': ('calendar.json',),
+    'timetable': ('shapes.json', 'timetable.json'),
+}
+
+# cache locale (non versionata) degli hash già calcolati, per file di input
+FINGERPRINT_CACHE = '.fingerprints.json'
+
+def file_fingerprint(path: Path, hint=None):
+    """
+    Dimensione, mtime e sha256 del file. hint è la voce della cache locale: se dimensione e
+    mtime coincidono si riusa l'hash senza rileggere il file. Nel manifest finiscono solo
+    dimensione e sha256 (manifest_inputs): le mtime cambiano da una macchina all'altra.
+    """
+    st = path.stat()
+    if hint and hint.get('size') == st.st_size and hint.get('mtime_ns') == st.st_mtime_ns:
+        return hint
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": h.hexdigest()}
+
+def manifest_inputs(fingerprints) -> dict:
+    return {name: {"size": fp["size"], "sha256": fp["sha256"]} for name, fp in fingerprints.items()}
+
+def load_fingerprint_cache(out_dir: Path, in_dir: Path) -> dict:
+    try:
+        with open(out_dir / FINGERPRINT_CACHE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache.get('files', {}) if cache.get('in_dir') == str(in_dir.resolve()) else {}
+
+def save_fingerprint_cache(out_dir: Path, in_dir: Path, fingerprints: dict):
+    tmp = out_dir / f"{FINGERPRINT_CACHE}.tmp"
+    tmp.write_text(json.dumps({"in_dir": str(in_dir.resolve()), "files": fingerprints}), encoding='utf-8')
+    os.replace(tmp, out_dir / FINGERPRINT_CACHE)
+
+def load_manifest(out_dir: Path):
+    try:
+        with open(out_dir / MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def preprocess_gtfs(in_dir: str, out_dir: str, include_route_types=(2, 3), force: bool = False,
+                    streaming: bool = False, chunk_rows: int = 500_000, measure_memory: bool = False):
     """
     Converte i GTFS in JSON: routes, shapes, stops, timetable, calendar, stats.
-    include_route_types: 2=train, 3=bus 
+    Scrive anche dataset.bin, lo snapshot binario che il repository carica al posto dei JSON,
+    e le fette per il frontend in slices/ (catalogo + trip per data, già compresse).
+    Incrementale: gtfs-out/manifest.json registra l'impronta dei file di input e si
+    ricostruiscono solo gli stage i cui input sono cambiati (force=True rifà tutto).
+    streaming=True legge stop_times e shapes a blocchi di chunk_rows righe e scrive gli
+    output man mano (per feed più grandi della memoria).
+    Nelle statistiche c'è sempre il picco RSS del processo; con measure_memory=True anche il
+    picco delle allocazioni di questa esecuzione (tracemalloc, rallenta parecchio).
+    include_route_types: 2=train, 3=bus
     """
+    if not measure_memory or tracemalloc.is_tracing():
+        return _preprocess(in_dir, out_dir, include_route_types, force, streaming, chunk_rows)
+    tracemalloc.start()
+    try:
+        return _preprocess(in_dir, out_dir, include_route_types, force, streaming, chunk_rows)
+    finally:
+        tracemalloc.stop()
+
+def _preprocess(in_dir, out_dir, include_route_types, force, streaming, chunk_rows):
     in_dir = Path(in_dir)
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    routes_df = safe_read_csv(in_dir / 'routes.txt')
-    trips_df = safe_read_csv(in_dir / 'trips.txt')
-    stops_df = safe_read_csv(in_dir / 'stops.txt')
-    shapes_df = safe_read_csv(in_dir / 'shapes.txt')
-    stop_times_df = safe_read_csv(in_dir / 'stop_times.txt')
-    calendar_dates_df = safe_read_csv(in_dir / 'calendar_dates.txt')
-
-    sel_routes = routes_df[routes_df['route_type'].isin(include_route_types)].copy()
-    route_ids = set(sel_routes['route_id'])
-    sel_trips = trips_df[trips_df['route_id'].isin(route_ids)].copy()
-
-    trip_ids = set(sel_trips['trip_id'])
-    sel_shapes = shapes_df[shapes_df['shape_id'].isin(sel_trips['shape_id'])].copy()
-    sel_stop_times = stop_times_df[stop_times_df['trip_id'].isin(trip_ids)].copy()
-
-    routes_json = {}
-    for _, route in sel_routes.iterrows():
-        color = "#3388ff"
-        if pd.notna(route.get('route_color')) and route['route_color'] != '':
-            color_val = str(route['route_color']).strip()
-            color = f"#{color_val}" if not color_val.startswith('#') else color_val
-
-        mode = 'train' if int(route.get('route_type', 2)) == 2 else 'bus'
-        routes_json[str(route['route_id'])] = {
-            "short": str(route.get('route_short_name', 'REG')),
-            "long": str(route.get('route_long_name', 'Linea')),
-            "color": color,
-            "type": str(route.get('route_type', 2)),
-            "mode": mode
-        }
-
-    shapes_json = {}
-    for shape_id, shape_group in sel_shapes.groupby('shape_id'):
-        points = shape_group.sort_values('shape_pt_sequence')
-        coords = []
-        for _, p in points.iterrows():
-            coords.append([float(p['shape_pt_lat']), float(p['shape_pt_lon'])])
-        shapes_json[str(shape_id)] = coords
-
-    stops_json = {}
-    for _, stop in stops_df.iterrows():
-        stops_json[str(stop['stop_id'])] = {
-            "name": str(stop['stop_name']).replace('Stazione di ', ''),
-            "lat": float(stop['stop_lat']),
-            "lon": float(stop['stop_lon']),
-            "full_name": str(stop['stop_name'])
-        }
-
-    calendar_lookup = {}
-    for _, cal_date in calendar_dates_df.iterrows():
-        service_id = str(cal_date['service_id'])
-        date = str(cal_date['date'])
-        exception_type = int(cal_date['exception_type'])
-        calendar_lookup.setdefault(service_id, {})[date] = exception_type
-
-    timetable_json = {}
-    for trip_id, stop_times_group in sel_stop_times.groupby('trip_id'):
-        trip_info = sel_trips[sel_trips['trip_id'] == trip_id]
-        if trip_info.empty:
-            continue
-        trip_info = trip_info.iloc[0]
+    timings = {}
+    t0 = time.perf_counter()
 
-        stop_times_sorted = stop_times_group.sort_values('stop_sequence')
-        if stop_times_sorted.empty:
-            continue
+    def lap(stage):
+        nonlocal t0
+        now = time.perf_counter()
+        timings[stage] = round(now - t0, 4)
+        t0 = now
+
+    manifest = load_manifest(out_dir)
+    params = {"version": PREPROCESS_VERSION, "include_route_types": sorted(int(t) for t in include_route_types)}
+    old_inputs = manifest.get('inputs', {}) if manifest.get('params') == params else {}
+    hints = load_fingerprint_cache(out_dir, in_dir)
+    fingerprints = {name: file_fingerprint(in_dir / name, hints.get(name)) for name in sorted(REQUIRED_INPUTS)}
+    if fingerprints != hints:
+        save_fingerprint_cache(out_dir, in_dir, fingerprints)
+    inputs = manifest_inputs(fingerprints)
+    lap('fingerprint')
+
+    def fresh(stage):
+        return (not force
+                and all(name in old_inputs and old_inputs[name]['sha256'] == inputs[name]['sha256']
+                        for name in STAGE_INPUTS[stage])
+                and all((out_dir / f).exists() for f in STAGE_OUTPUTS[stage]))
+
+    stale = [stage for stage in STAGE_INPUTS if not fresh(stage)]
+    version = manifest_version(params, inputs)
+    skipped = [stage for stage in STAGE_INPUTS if stage not in stale]
+    def save_json(data, filename):
+        # file temporaneo + rename: chi legge gtfs-out/ mentre si rigenera vede il vecchio o il nuovo
+        tmp = out_dir / f"{filename}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'), ensure_ascii=False, indent=2)
+        os.replace(tmp, out_dir / filename)
+
+    def write_slices():
+        # dopo il manifest: le fette portano la versione del dataset che ne deriva
+        version = dataset_version(out_dir)
+        if not force and slices_fresh(out_dir, version):
+            return False
+        build_slices(out_dir, version)
+        lap('slices')
+        return True
+
+    # lo snapshot vale per la versione scritta nel suo header, come in GTFSRepository
+    snapshot_stale = bool(stale) or read_meta(out_dir / SNAPSHOT_FILE).get("dataset_version") != version
+    if not snapshot_stale:
+        if inputs != old_inputs:
+            # manifest di un formato precedente (con le mtime): si riscrive con le sole impronte
+            save_json({**manifest, "inputs": inputs}, MANIFEST_FILE)
+        skipped = skipped + ['snapshot'] + ([] if write_slices() else ['slices'])
+        return {**manifest.get('counts', {}), "timings": timings, "skipped": skipped}
+
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    needed = {name for stage in stale for name in STAGE_INPUTS[stage]}
+    read_options = {}
+    if streaming:
+        # stop_times e shapes si leggono a blocchi più avanti; gli id dei trip restano stringhe
+        needed -= {'stop_times.txt', 'shapes.txt'}
+        read_options = {'routes.txt': {'dtype': {'route_id': str}},
+                        'trips.txt': {'usecols': lambda c: c in TRIP_COLUMNS, 'dtype': str}}
+    frames = {name: safe_read_csv(in_dir / name, **read_options.get(name, {})) for name in sorted(needed)}
+    lap('read')
+
+    def load_output(filename):
+        with open(out_dir / filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    if 'routes.txt' in frames:
+        routes_df = frames['routes.txt']
+        sel_routes = routes_df[routes_df['route_type'].isin(include_route_types)].copy()
+
+    if 'timetable' in stale and streaming:
+        trips_df = frames['trips.txt']
+        route_ids = set(sel_routes['route_id'])
+        sel_trips = trips_df[trips_df['route_id'].isin(route_ids)]
+        lap('filter')
+    elif 'timetable' in stale:
+        trips_df = frames['trips.txt']
+        shapes_df = frames['shapes.txt']
+        stop_times_df = frames['stop_times.txt']
+        route_ids = set(sel_routes['route_id'])
+        sel_trips = trips_df[trips_df['route_id'].isin(route_ids)].copy()
 
-        first_stop = stop_times_sorted.iloc[0]
-        last_stop = stop_times_sorted.iloc[-1]
-
-        stops_list = []
-        for _, st in stop_times_sorted.iterrows():
-            stops_list.append([
-                str(st['stop_id']),
-                str(st['departure_time']),
-                str(st['arrival_time']),
-                int(st['stop_sequence'])
-            ])
-
-        shape_id = trip_info.get('shape_id')
-        if pd.isna(shape_id) or shape_id == '' or str(shape_id) not in shapes_json:
-            generated_shape_id = f"generated_{trip_id}"
-            coords = create_shape_from_stops(stop_times_sorted, stops_df)
-            if coords:
-                shapes_json[generated_shape_id] = coords
-                shape_id = generated_shape_id
-            else:
-                shape_id = "default"
-
-        dep_time = parse_time_to_seconds(first_stop['departure_time'])
-        arr_time = parse_time_to_seconds(last_stop['arrival_time'])
-        duration_minutes = 0
-        if dep_time is not None and arr_time is not None:
-            duration_minutes = (arr_time - dep_time) // 60
-
-        service_id = str(trip_info.get('service_id', ''))
-        service_dates = calendar_lookup.get(service_id, {})
-
-        timetable_json[str(trip_id)] = {
-            "route_id": str(trip_info['route_id']),
-            "shape_id": str(shape_id),
-            "service_id": service_id,
-            "departure": str(first_stop['departure_time']),
-            "arrival": str(last_stop['arrival_time']),
-            "headsign": str(trip_info.get('trip_headsign', '')),
-            "duration_minutes": duration_minutes,
-            "stops": stops_list,
-            "stop_count": len(stops_list),
-            "service_dates": service_dates
-        }
-
-    calendar_json = {}
-    for _, cal_date in calendar_dates_df.iterrows():
-        calendar_json.setdefault(str(cal_date['service_id']), {})[str(cal_date['date'])] = int(cal_date['exception_type'])
+        trip_ids = set(sel_trips['trip_id'])
+        sel_shapes = shapes_df[shapes_df['shape_id'].isin(sel_trips['shape_id'])].copy()
+        sel_stop_times = stop_times_df[stop_times_df['trip_id'].isin(trip_ids)].copy()
+        lap('filter')
+
+    if 'routes' in stale:
+        routes_json = {}
+        for route in sel_routes.to_dict('records'):
+            color = "#3388ff"
+            if pd.notna(route.get('route_color')) and route['route_color'] != '':
+                color_val = str(route['route_color']).strip()
+                color = f"#{color_val}" if not color_val.startswith('#') else color_val
+
+            mode = 'train' if int(route.get('route_type', 2)) == 2 else 'bus'
+            routes_json[str(route['route_id'])] = {
+                "short": str(route.get('route_short_name', 'REG')),
+                "long": str(route.get('route_long_name', 'Linea')),
+                "color": color,
+                "type": str(route.get('route_type', 2)),
+                "mode": mode
+            }
+        lap('routes')
+    else:
+        routes_json = load_output('routes.json')
+
+    if 'timetable' in stale and not streaming:
+        # punti ordinati per shape e sequenza, poi tagliati a blocchi
+        sel_shapes = sel_shapes.sort_values(['shape_id', 'shape_pt_sequence'], kind='mergesort')
+        shape_keys = sel_shapes['shape_id'].to_numpy()
+        shape_coords = sel_shapes[['shape_pt_lat', 'shape_pt_lon']].to_numpy(dtype=float).tolist()
+        shapes_json = {}
+        for start, end in group_bounds(shape_keys):
+            shapes_json[str(shape_keys[start])] = shape_coords[start:end]
+        lap('shapes')
+
+    if 'stops.txt' in frames:
+        stops_df = frames['stops.txt']
+    if 'stops' in stale:
+        stop_names = stops_df['stop_name'].astype(str)
+        stops_json = {}
+        for stop_id, name, lat, lon in zip(stops_df['stop_id'].astype(str).tolist(),
+                                           stop_names.tolist(),
+                                           stops_df['stop_lat'].astype(float).tolist(),
+                                           stops_df['stop_lon'].astype(float).tolist()):
+            stops_json[stop_id] = {
+                "name": name.replace('Stazione di ', ''),
+                "lat": lat,
+                "lon": lon,
+                "full_name": name
+            }
+        lap('stops')
+    else:
+        stops_json = load_output('stops.json')
+
+    if 'calendar' in stale:
+        calendar_dates_df = frames['calendar_dates.txt']
+        calendar_json = {}
+        for service_id, date, exception_type in zip(calendar_dates_df['service_id'].astype(str).tolist(),
+                                                    calendar_dates_df['date'].astype(str).tolist(),
+                                                    calendar_dates_df['exception_type'].astype(int).tolist()):
+            calendar_json.setdefault(service_id, {})[date] = exception_type
+        lap('calendar')
+    else:
+        calendar_json = load_output('calendar.json')
+
+    if streaming:
+        snapshot = SnapshotWriter(out_dir / SNAPSHOT_FILE, calendar_json)
+
+    if 'timetable' in stale and streaming:
+        n_shapes, n_trips = stream_shapes_and_timetable(in_dir, out_dir, sel_trips, stops_df, snapshot, chunk_rows)
+        lap('timetable')
+    elif 'timetable' in stale:
+        # prima occorrenza per stop_id, come lookup per le shape generate
+        first_stops = stops_df.drop_duplicates('stop_id')
+        stop_coords = dict(zip(first_stops['stop_id'].tolist(),
+                               first_stops[['stop_lat', 'stop_lon']].to_numpy(dtype=float).tolist()))
+
+        # un'unica join stop_times -> trip, ordinata per trip e stop_sequence
+        trip_cols = [c for c in ('trip_id', 'route_id', 'service_id', 'trip_headsign', 'shape_id') if c in sel_trips.columns]
+        trip_info_df = sel_trips.drop_duplicates('trip_id')[trip_cols]
+        st = sel_stop_times.merge(trip_info_df, on='trip_id', how='inner', suffixes=('', '_trip'))
+        st = st.sort_values(['trip_id', 'stop_sequence'], kind='mergesort')
+
+        st_trip = st['trip_id'].to_numpy()
+        st_stop_raw = st['stop_id'].tolist()
+        st_stop = st['stop_id'].astype(str).tolist()
+        st_dep = st['departure_time'].astype(str).tolist()
+        st_arr = st['arrival_time'].astype(str).tolist()
+        st_dep_raw = st['departure_time'].tolist()
+        st_arr_raw = st['arrival_time'].tolist()
+        st_seq = st['stop_sequence'].astype(int).tolist()
+        st_route = st['route_id'].astype(str).tolist()
+        st_service = st['service_id'].astype(str).tolist() if 'service_id' in st else [''] * len(st)
+        st_headsign = st['trip_headsign'].astype(str).tolist() if 'trip_headsign' in st else [''] * len(st)
+        st_shape = st['shape_id'].tolist() if 'shape_id' in st else [None] * len(st)
+
+        timetable_json = {}
+        for start, end in group_bounds(st_trip):
+            trip_id = st_trip[start]
+            last = end - 1
+
+            stops_list = [list(row) for row in zip(st_stop[start:end], st_dep[start:end],
+                                                      st_arr[start:end], st_seq[start:end])]
+
+            shape_id = st_shape[start]
+            if pd.isna(shape_id) or shape_id == '' or str(shape_id) not in shapes_json:
+                generated_shape_id = f"generated_{trip_id}"
+                coords = create_shape_from_stops(st_stop_raw[start:end], stop_coords)
+                if coords:
+                    shapes_json[generated_shape_id] = coords
+                    shape_id = generated_shape_id
+                else:
+                    shape_id = "default"
+
+            dep_time = parse_time_to_seconds(st_dep_raw[start])
+            arr_time = parse_time_to_seconds(st_arr_raw[last])
+            duration_minutes = 0
+            if dep_time is not None and arr_time is not None:
+                duration_minutes = (arr_time - dep_time) // 60
+
+            timetable_json[str(trip_id)] = {
+                "route_id": st_route[start],
+                "shape_id": str(shape_id),
+                "service_id": st_service[start],
+                "departure": st_dep[start],
+                "arrival": st_arr[last],
+                "headsign": st_headsign[start],
+                "duration_minutes": duration_minutes,
+                "stops": stops_list,
+                "stop_count": len(stops_list)
+            }
+        n_shapes, n_trips = len(shapes_json), len(timetable_json)
+        lap('timetable')
+    elif streaming:
+        # trip e shape invariati: si ricopiano dal vecchio snapshot senza caricare i JSON
+        # il vecchio snapshot si ricopia solo se è davvero quello del dataset precedente
+        if read_meta(out_dir / SNAPSHOT_FILE).get("dataset_version") == dataset_version(out_dir):
+            old = Snapshot(out_dir / SNAPSHOT_FILE)
+            shapes_src, timetable_src = SnapshotShapes(old), SnapshotTimetable(old, old.strings(old['trip_id']))
+        else:
+            shapes_src, timetable_src = load_output('shapes.json'), load_output('timetable.json')
+        for shape_id, coords in shapes_src.items():
+            snapshot.add_shape(shape_id, coords)
+        for trip_id, trip in timetable_src.items():
+            snapshot.add_trip(trip_id, trip)
+        n_shapes, n_trips = snapshot.n_shapes, snapshot.n_trips
+        lap('load_unchanged')
+    else:
+        shapes_json = load_output('shapes.json')
+        timetable_json = load_output('timetable.json')
+        n_shapes, n_trips = len(shapes_json), len(timetable_json)
+        lap('load_unchanged')
 
     stats_json = {
         "total_routes": len(routes_json),
-        "total_trips": len(timetable_json),
+        "total_trips": n_trips,
         "total_stops": len(stops_json),
-        "total_shapes": len(shapes_json),
+        "total_shapes": n_shapes,
         "generated_at": datetime.now().isoformat(),
+        "skipped_stages": skipped,
     }
 
-    def save_json(data, filename):
-        with open(out_dir / filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, separators=(',', ':'), ensure_ascii=False, indent=2)
+    outputs = {'routes.json': routes_json, 'stops.json': stops_json, 'calendar.json': calendar_json}
+    if not streaming:
+        outputs.update({'shapes.json': shapes_json, 'timetable.json': timetable_json})
+    for stage in stale:
+        for filename in STAGE_OUTPUTS[stage]:
+            if filename in outputs:   # in streaming shapes/timetable sono già su disco
+                save_json(outputs[filename], filename)
+    lap('write')
 
-    save_json(routes_json, 'routes.json')
-    save_json(shapes_json, 'shapes.json')
-    save_json(stops_json, 'stops.json')
-    save_json(timetable_json, 'timetable.json')
-    save_json(calendar_json, 'calendar.json')
-    save_json(stats_json, 'stats.json')
+    # con la versione del dataset: il repository lo usa solo se coincide con quella del manifest
+    meta = {"generated_at": stats_json["generated_at"], "dataset_version": version}
+    if streaming:
+        snapshot.close(routes_json, stops_json, meta)
+    else:
+        write_snapshot(out_dir / SNAPSHOT_FILE, routes_json, shapes_json, stops_json, timetable_json, calendar_json,
+                       meta=meta)
+    lap('snapshot')
 
-    return {
+    counts = {
         "routes": len(routes_json),
-        "shapes": len(shapes_json),
+        "shapes": n_shapes,
         "stops": len(stops_json),
-        "trips": len(timetable_json),
-        "calendar": len(calendar_json)
+        "trips": n_trips,
+        "calendar": len(calendar_json),
     }
+    stats_json["timings"] = timings
+    if tracemalloc.is_tracing():
+        stats_json["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+    if resource is not None:
+        # ru_maxrss è in KB su Linux, in byte su macOS. È il picco dell'intero processo, non di
+        # questo preprocess: nel server (/preprocess) può venire da qualsiasi cosa girata prima
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats_json["process_peak_rss_mb"] = round(rss / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+    save_json(stats_json, 'stats.json')
+    # il manifest per ultimo: se il processo si interrompe prima, al giro dopo si rifà
+    save_json({"params": params, "inputs": inputs, "counts": counts}, MANIFEST_FILE)
+    if not write_slices():
+        skipped = skipped + ['slices']
+
+    result = {**counts, "timings": timings, "skipped": skipped}
+    for key in ("peak_memory_mb", "process_peak_rss_mb"):
+        if key in stats_json:
+            result[key] = stats_json[key]
+    return result
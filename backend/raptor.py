@@ -0,0 +1,182 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import math
+
+from planner import ConnectionTable
+
+@dataclass
+class RaptorJourney:
+    arr_time: int
+    transfers: int
+    legs: List[Tuple[int, int, int]]   # (trip globale, posizione salita, posizione discesa)
+
+class RaptorDay:
+    """Per ogni pattern, i trip attivi nel giorno e le colonne degli orari per posizione."""
+    __slots__ = ("trips", "dep_cols")
+
+    def __init__(self):
+        self.trips: Dict[int, List[int]] = {}
+        self.dep_cols: Dict[int, List[List[int]]] = {}
+
+class RaptorSolver:
+    """
+    RAPTOR a round sui pattern (sequenze di fermate identiche) derivati da repo.timetable.
+    Il round k contiene i migliori arrivi usando k trip: un solo run restituisce
+    l'intero fronte di Pareto (arrivo, cambi).
+    Senza max_rounds si procede finché un round migliora l'arrivo di qualche fermata (prima o
+    poi nessuno migliora più), quindi il fronte è completo; con max_rounds gli itinerari con
+    più trip non si cercano e stats["round_limit"] dice se il limite ha interrotto la ricerca.
+    """
+    def __init__(self, planner, max_rounds: Optional[int] = None):
+        self.planner = planner
+        self.repo = planner.repo
+        self.max_rounds = max_rounds
+
+        self.pattern_stops: List[List[int]] = []
+        self.stop_patterns: List[List[Tuple[int, int]]] = [[] for _ in self.repo.stop_ids]
+        self.trip_pattern: List[int] = [-1] * len(self.repo.trip_ids)
+        self.trip_dep: List[List[int]] = []
+        self.trip_arr: List[List[int]] = []
+        self._build_patterns()
+
+    def _build_patterns(self):
+        by_seq: Dict[Tuple[int, ...], List[int]] = {}
+        for g in range(len(self.repo.trip_ids)):
+            # stesse fermate e orari della tabella CSA: la posizione nel pattern coincide con la tratta
+            stops, dep, arr = self.planner.timed_schedule(g)
+            self.trip_dep.append(dep)
+            self.trip_arr.append(arr)
+            if len(stops) < 2:
+                continue
+            seq = tuple(stops)
+            by_seq.setdefault(seq, []).append(g)
+
+        for seq, trips in by_seq.items():
+            trips.sort(key=lambda g: self.trip_dep[g][0])
+            # un pattern non deve avere sorpassi: altrimenti si divide in più pattern FIFO
+            groups: List[List[int]] = []
+            for g in trips:
+                for group in groups:
+                    last = group[-1]
+                    if all(self.trip_dep[last][i] <= self.trip_dep[g][i] and
+                           self.trip_arr[last][i + 1] <= self.trip_arr[g][i + 1] for i in range(len(seq) - 1)):
+                        group.append(g)
+                        break
+                else:
+                    groups.append([g])
+
+            for group in groups:
+                p = len(self.pattern_stops)
+                self.pattern_stops.append(list(seq))
+                for pos, s in enumerate(seq[:-1]):
+                    self.stop_patterns[s].append((p, pos))
+                for g in group:
+                    self.trip_pattern[g] = p
+
+    def day(self, table: ConnectionTable) -> RaptorDay:
+        """Dati del giorno, calcolati una volta e salvati insieme alla ConnectionTable in cache."""
+        day = table.derived.get('raptor')
+        if day is not None:
+            return day
+
+        day = RaptorDay()
+        for g in table.trips:
+            p = self.trip_pattern[g]
+            if p >= 0:
+                day.trips.setdefault(p, []).append(g)
+        for p, trips in day.trips.items():
+            trips.sort(key=lambda g: self.trip_dep[g][0])
+            n = len(self.pattern_stops[p]) - 1
+            day.dep_cols[p] = [[self.trip_dep[g][pos] for g in trips] for pos in range(n)]
+        table.derived['raptor'] = day
+        return day
+
+    def solve(self, table: ConnectionTable, origin: str, destination: str, dep_after: int,
+              change: List[int]) -> Tuple[List[RaptorJourney], Dict]:
+        o = self.repo.stop_index.get(origin)
+        d = self.repo.stop_index.get(destination)
+        stats = {"rounds": 0, "patterns_scanned": 0, "stops_improved": 0, "round_limit": False}
+        if o is None or d is None:
+            return [], stats
+
+        day = self.day(table)
+        n_stops = len(self.repo.stop_ids)
+        best = [math.inf] * n_stops
+        best[o] = dep_after
+        tau = [math.inf] * n_stops
+        tau[o] = dep_after
+        # parent[s] = (trip, posizione salita, posizione discesa, fermata di salita)
+        parents: List[List[Optional[Tuple[int, int, int, int]]]] = [[None] * n_stops]
+        reached_in: List[List[int]] = [[0] * n_stops]   # round in cui è stato fissato tau[s]
+
+        front: List[RaptorJourney] = []
+        marked = {o}
+        k = 0
+        while marked:
+            if self.max_rounds is not None and k == self.max_rounds:
+                stats["round_limit"] = True
+                break
+            k += 1
+            queue: Dict[int, int] = {}
+            for s in marked:
+                for p, pos in self.stop_patterns[s]:
+                    if p in day.trips and pos < queue.get(p, math.inf):
+                        queue[p] = pos
+            if not queue:
+                break
+            stats["rounds"] = k
+            stats["patterns_scanned"] += len(queue)
+
+            prev = tau
+            tau = list(prev)
+            parent = list(parents[-1])
+            rounds = list(reached_in[-1])
+            marked = set()
+            for p, pos0 in queue.items():
+                stops = self.pattern_stops[p]
+                trips = day.trips[p]
+                cols = day.dep_cols[p]
+                cur = -1          # indice del trip nel pattern, -1 = non ancora a bordo
+                board_pos = 0
+                for pos in range(pos0, len(stops)):
+                    s = stops[pos]
+                    if cur >= 0:
+                        arr = self.trip_arr[trips[cur]][pos]
+                        # pruning locale e sulla destinazione
+                        if arr < best[s] and arr < best[d]:
+                            tau[s] = best[s] = arr
+                            parent[s] = (trips[cur], board_pos, pos, stops[board_pos])
+                            rounds[s] = k
+                            marked.add(s)
+                            stats["stops_improved"] += 1
+                    if pos == len(stops) - 1:
+                        break
+                    if prev[s] == math.inf:
+                        continue
+                    ready = prev[s] + (change[s] if reached_in[-1][s] > 0 else 0)
+                    if cur >= 0 and cols[pos][cur] < ready:
+                        continue
+                    e = bisect_left(cols[pos], ready)
+                    if e < len(trips) and (cur < 0 or e < cur):
+                        cur = e
+                        board_pos = pos
+
+            parents.append(parent)
+            reached_in.append(rounds)
+            if rounds[d] == k:
+                legs = self._legs(parents, reached_in, k, d, o)
+                front.append(RaptorJourney(tau[d], len(legs) - 1, legs))
+
+        return front, stats
+
+    @staticmethod
+    def _legs(parents, reached_in, k: int, d: int, o: int) -> List[Tuple[int, int, int]]:
+        legs = []
+        s = d
+        while s != o and k > 0:
+            g, board, alight, board_stop = parents[k][s]
+            legs.append((g, board, alight))
+            s = board_stop
+            k = reached_in[k - 1][s]
+        return list(reversed(legs))
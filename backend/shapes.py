@@ -0,0 +1,229 @@
+"""
+Shape pronte per la mappa, calcolate a fine preprocess insieme alle fette:
+  - proiezione di ogni fermata sulle shape dei suoi trip (indice del punto più vicino e
+    distanza in metri dall'inizio della shape), al posto della ricerca lineare nel frontend
+  - versioni semplificate con Douglas–Peucker a più tolleranze (livelli di zoom), in
+    encoded polyline (precisione 1e-5, ~1 m), molto più compatte delle coppie di float
+I punti proiettati delle fermate restano in ogni livello, così un tratto tra due fermate
+si ritaglia con gli indici anche sulle shape semplificate.
+"""
+import json
+import math
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from gtfs_repo import GTFSRepository
+
+# livello -> tolleranza in metri (0 = tutti i punti)
+ZOOM_TOLERANCES = {"full": 0.0, "high": 5.0, "mid": 25.0, "low": 100.0}
+# livello delle shape nelle fette per data
+DAY_LEVEL = "high"
+POLYLINE_PRECISION = 5
+EARTH_RADIUS_M = 6371000.0
+
+def encode_polyline(coords: Sequence[Sequence[float]], precision: int = POLYLINE_PRECISION) -> str:
+    """Encoded polyline (formato Google) di una lista di [lat, lon]."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        for delta in (lat - prev_lat, lon - prev_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                out.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            out.append(chr(value + 63))
+        prev_lat, prev_lon = lat, lon
+    return ''.join(out)
+
+def decode_polyline(encoded: str, precision: int = POLYLINE_PRECISION) -> List[List[float]]:
+    factor = 10 ** precision
+    coords = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(encoded[index]) - 63
+                index += 1
+                result |= (b & 0x1f) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coords.append([lat / factor, lon / factor])
+    return coords
+
+def to_meters(coords, ref_lat: Optional[float] = None) -> np.ndarray:
+    """
+    Proiezione equirettangolare locale in metri: basta per distanze dentro una regione.
+    ref_lat (gradi) fissa il parallelo di riferimento, di default la latitudine media.
+    """
+    pts = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if ref_lat is None:
+        ref_lat = float(pts[:, 0].mean()) if len(pts) else 0.0
+    lat0 = math.radians(ref_lat)
+    rad = np.radians(pts)
+    return np.column_stack((rad[:, 1] * math.cos(lat0), rad[:, 0])) * EARTH_RADIUS_M
+
+def cumulative_distance(xy: np.ndarray) -> np.ndarray:
+    """Distanza in metri dall'inizio della shape a ogni punto."""
+    if len(xy) == 0:
+        return np.zeros(0)
+    return np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+
+def _segment_distances(xy: np.ndarray, start: int, end: int) -> np.ndarray:
+    """Distanza dei punti interni start+1..end-1 dal segmento start-end."""
+    a, b = xy[start], xy[end]
+    pts = xy[start + 1:end]
+    ab = b - a
+    length2 = float(ab @ ab)
+    if length2 == 0.0:
+        return np.hypot(*(pts - a).T)
+    t = np.clip((pts - a) @ ab / length2, 0.0, 1.0)
+    return np.hypot(*(pts - (a + t[:, None] * ab)).T)
+
+def simplify(xy: np.ndarray, tolerance: float, keep: Sequence[int] = ()) -> List[int]:
+    """
+    Douglas–Peucker: indici dei punti da tenere, in ordine. I punti in keep (e gli estremi)
+    restano sempre: la shape si semplifica pezzo per pezzo tra uno e l'altro.
+    """
+    n = len(xy)
+    if n <= 2 or tolerance <= 0:
+        return list(range(n))
+    anchors = sorted({0, n - 1, *(int(k) for k in keep)})
+    kept = set(anchors)
+    stack = list(zip(anchors, anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dist = _segment_distances(xy, start, end)
+        i = int(dist.argmax())
+        if dist[i] > tolerance:
+            mid = start + 1 + i
+            kept.add(mid)
+            stack.append((start, mid))
+            stack.append((mid, end))
+    return sorted(kept)
+
+def project_stops(xy: np.ndarray, stop_xy: Dict[str, np.ndarray]) -> Dict[str, int]:
+    """Per ogni fermata l'indice del punto della shape più vicino."""
+    return {stop_id: int(np.hypot(*(xy - p).T).argmin()) for stop_id, p in stop_xy.items()}
+
+def shape_stops(repo: GTFSRepository) -> Dict[str, List[str]]:
+    """shape_id -> fermate dei trip che la usano."""
+    out: Dict[str, Dict[str, None]] = {}
+    for trip in repo.timetable.values():
+        shape_id = trip.get('shape_id')
+        if shape_id and shape_id in repo.shapes:
+            stops = out.setdefault(shape_id, {})
+            for stop in trip['stops']:
+                stops[stop[0]] = None
+    return {shape_id: list(stops) for shape_id, stops in out.items()}
+
+def build_shape_index(repo: GTFSRepository) -> dict:
+    """
+    Per ogni shape usata: lunghezza, fermate proiettate ([indice, metri dall'inizio] sulla
+    shape completa) e per ogni livello di zoom la polyline con gli indici delle fermate.
+    """
+    shapes = {}
+    for shape_id, stop_ids in shape_stops(repo).items():
+        coords = repo.shapes[shape_id]
+        stop_coords = [(s, repo.stops[s]) for s in stop_ids if s in repo.stops]
+        if not coords or not stop_coords:
+            continue
+        # stessa proiezione per shape e fermate, così le distanze sono confrontabili
+        xy_all = to_meters(list(coords) + [[st['lat'], st['lon']] for _, st in stop_coords])
+        xy = xy_all[:len(coords)]
+        projected = project_stops(xy, {s: p for (s, _), p in zip(stop_coords, xy_all[len(coords):])})
+        dist = cumulative_distance(xy)
+
+        levels = {}
+        for level, tolerance in ZOOM_TOLERANCES.items():
+            kept = simplify(xy, tolerance, keep=projected.values())
+            position = {idx: i for i, idx in enumerate(kept)}
+            levels[level] = {
+                "polyline": encode_polyline([coords[i] for i in kept]),
+                "points": len(kept),
+                "stops": {s: position[idx] for s, idx in projected.items()},
+            }
+        shapes[shape_id] = {
+            "length_m": round(float(dist[-1]), 1),
+            "stops": {s: [idx, round(float(dist[idx]), 1)] for s, idx in projected.items()},
+            "levels": levels,
+        }
+    return {"precision": POLYLINE_PRECISION, "tolerances_m": ZOOM_TOLERANCES, "shapes": shapes}
+
+class ShapeSegments:
+    """
+    Lato server: tratti di shape tra due fermate, dal file delle shape della versione corrente
+    delle fette (riletto quando cambia versione; le polyline si decodificano alla prima richiesta).
+    Condiviso tra i thread di Flask: lo stato si sostituisce in blocco e la cache sotto lock.
+    """
+    def __init__(self, slice_index):
+        self.slice_index = slice_index
+        self._etag: Optional[str] = None
+        # (versione, shape, polyline decodificate per (shape_id, livello))
+        self._state: Optional[Tuple[str, dict, Dict[tuple, List[List[float]]]]] = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        """Stato per la versione corrente delle fette (None se mancano)."""
+        entry = self.slice_index.shapes()
+        if entry is None:
+            return None
+        path, etag, _ = entry
+        with self._lock:
+            if etag == self._etag:
+                return self._state
+        with open(path, 'r', encoding='utf-8') as f:
+            state = (self.slice_index.version, json.load(f)["shapes"], {})
+        with self._lock:
+            self._etag, self._state = etag, state
+        return state
+
+    def _coords(self, shapes: dict, decoded: dict, shape_id: str, level: str) -> List[List[float]]:
+        key = (shape_id, level)
+        with self._lock:
+            coords = decoded.get(key)
+        if coords is None:
+            coords = decode_polyline(shapes[shape_id]["levels"][level]["polyline"])
+            with self._lock:
+                decoded[key] = coords
+        return coords
+
+    def segment(self, shape_id: str, origin: str, destination: str, level: str = DAY_LEVEL):
+        """
+        Tratto della shape da origin a destination (invertito se la shape va al contrario),
+        oppure None se la shape o le fermate non ci sono. ValueError per un livello sconosciuto.
+        """
+        if level not in ZOOM_TOLERANCES:
+            raise ValueError(f"livello sconosciuto: {level} (validi: {', '.join(ZOOM_TOLERANCES)})")
+        state = self._current()
+        if state is None:
+            return None
+        version, shapes, decoded = state
+        shape = shapes.get(shape_id)
+        if shape is None or origin not in shape["stops"] or destination not in shape["stops"]:
+            return None
+        stops = shape["levels"][level]["stops"]
+        i, j = stops[origin], stops[destination]
+        coords = self._coords(shapes, decoded, shape_id, level)
+        points = coords[i:j + 1] if i <= j else coords[j:i + 1][::-1]
+        return {
+            "version": version,
+            "shape_id": shape_id,
+            "from": origin,
+            "to": destination,
+            "level": level,
+            "distance_m": round(abs(shape["stops"][destination][1] - shape["stops"][origin][1]), 1),
+            "points": len(points),
+            "polyline": encode_polyline(points),
+        }
@@ -0,0 +1,248 @@
+"""
+Fette del dataset per il frontend, al posto dei JSON interi:
+  - catalog: linee, fermate, date di servizio e, per ogni sequenza di fermate di una linea,
+    le date in cui circola (basta per scegliere partenza, destinazione e data)
+  - day: i soli trip attivi in una data, con le shape che usano in encoded polyline; ogni trip
+    ha in shape_points il punto della shape su cui cade ciascuna fermata (vedi shapes.py)
+  - shapes: tutte le shape a più livelli di zoom, per /shape/<id>/segment
+Si generano a fine preprocess in gtfs-out/slices/<versione>-<build>/, già compresse in .gz
+(e .br se è installato il modulo brotli), così il server le manda senza ricomprimerle.
+Le date con gli stessi trip condividono lo stesso file.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:   # opzionale: senza si generano solo le varianti gzip
+    brotli = None
+
+from gtfs_repo import GTFSRepository
+from shapes import DAY_LEVEL, build_shape_index, encode_polyline
+
+SLICES_DIR = 'slices'
+INDEX_FILE = 'index.json'
+# Content-Encoding -> suffisso del file precompresso, in ordine di preferenza
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# 11 comprime ~15% meglio ma è dieci volte più lento: pesa su ogni preprocess incrementale
+BROTLI_QUALITY = 9
+# formato dei file: se cambia, le fette si rigenerano anche a parità di dataset
+SLICES_FORMAT = 2
+# build lasciate a metà da un processo interrotto: si cancellano dopo questo tempo
+STALE_BUILD_SECONDS = 3600
+
+def _dump(data) -> bytes:
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def write_variants(path: Path, payload: bytes) -> Dict[str, int]:
+    """Scrive payload in path e accanto le varianti compresse; restituisce i byte per encoding."""
+    sizes = {'identity': len(payload)}
+    path.write_bytes(payload)
+    # mtime=0: a parità di contenuto il .gz è identico byte per byte
+    gz = gzip.compress(payload, compresslevel=9, mtime=0)
+    path.with_name(path.name + ENCODING_SUFFIXES['gzip']).write_bytes(gz)
+    sizes['gzip'] = len(gz)
+    if brotli is not None:
+        br = brotli.compress(payload, quality=BROTLI_QUALITY)
+        path.with_name(path.name + ENCODING_SUFFIXES['br']).write_bytes(br)
+        sizes['br'] = len(br)
+    return sizes
+
+def load_index(out_dir) -> dict:
+    try:
+        with open(Path(out_dir) / SLICES_DIR / INDEX_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def slices_dir(index: dict) -> str:
+    """Cartella delle fette pubblicate da index.json (gli indici più vecchi usano la versione)."""
+    return index.get('dir', index.get('version', ''))
+
+def slices_fresh(out_dir, version: str) -> bool:
+    out_dir = Path(out_dir)
+    index = load_index(out_dir)
+    return (index.get('version') == version and index.get('format') == SLICES_FORMAT
+            and (out_dir / SLICES_DIR / slices_dir(index)).is_dir())
+
+def service_dates(repo: GTFSRepository):
+    """Date con almeno un trip attivo."""
+    return sorted(d for d, trips in repo.date_trips.items() if len(trips))
+
+def build_catalog(repo: GTFSRepository, stats: dict, version: str) -> dict:
+    dates = service_dates(repo)
+    trip_dates = [[] for _ in repo.trip_ids]
+    for i, date in enumerate(dates):
+        for g in repo.date_trips[date]:
+            trip_dates[g].append(i)
+
+    patterns: Dict[Tuple[str, Tuple[str, ...]], set] = {}
+    for g in range(len(repo.trip_ids)):
+        stops, _, _ = repo.trip_schedule(g)
+        key = (repo.route_ids[repo.trip_route[g]], tuple(repo.stop_ids[s] for s in stops))
+        patterns.setdefault(key, set()).update(trip_dates[g])
+
+    return {
+        "version": version,
+        "routes": dict(repo.routes),
+        "stops": dict(repo.stops),
+        "stats": stats,
+        "dates": dates,
+        "patterns": [{"route_id": route_id, "stops": list(stops), "dates": sorted(ds)}
+                     for (route_id, stops), ds in patterns.items()],
+    }
+
+def build_day(repo: GTFSRepository, date: str, shape_index: Optional[dict] = None) -> dict:
+    if shape_index is None:
+        shape_index = build_shape_index(repo)
+    trips = {}
+    shapes = {}
+    for g in repo.trips_on(date):
+        trip_id = repo.trip_ids[g]
+        trip = repo.timetable[trip_id]
+        shape_id = trip.get('shape_id')
+        indexed = shape_index["shapes"].get(shape_id)
+        if indexed is not None:
+            # punto della shape (al livello DAY_LEVEL) di ogni fermata, allineato a trip["stops"]
+            stop_points = indexed["levels"][DAY_LEVEL]["stops"]
+            trip = dict(trip, shape_points=[stop_points.get(stop[0], -1) for stop in trip['stops']])
+        trips[trip_id] = trip
+        if shape_id and shape_id not in shapes and shape_id in repo.shapes:
+            shapes[shape_id] = (indexed["levels"][DAY_LEVEL]["polyline"] if indexed is not None
+                                else encode_polyline(repo.shapes[shape_id]))
+    return {"date": date, "trips": trips, "shapes": shapes}
+
+def build_slices(out_dir, version: str, repo: Optional[GTFSRepository] = None) -> dict:
+    """
+    Genera le fette in una cartella temporanea, la rinomina in gtfs-out/slices/<version>-<build>/
+    e poi sostituisce index.json, che le rende visibili. Ogni build ha la sua cartella, quindi
+    anche a parità di versione (format cambiato, force) non si tocca quella servita adesso;
+    resta anche la precedente, per le richieste partite prima del cambio.
+    """
+    out_dir = Path(out_dir)
+    if repo is None:
+        repo = GTFSRepository(str(out_dir))
+        repo.load()
+    try:
+        with open(out_dir / 'stats.json', 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        stats = {}
+
+    root = out_dir / SLICES_DIR
+    build = f"{version}-{time.time_ns():x}"
+    vdir = root / f".{build}.tmp-{os.getpid()}"
+    vdir.mkdir(parents=True)
+
+    totals: Dict[str, int] = {}
+    def emit(name: str, data) -> str:
+        payload = _dump(data)
+        for enc, n in write_variants(vdir / name, payload).items():
+            totals[enc] = totals.get(enc, 0) + n
+        return hashlib.sha1(payload).hexdigest()[:16]
+
+    catalog = {"file": "catalog.json", "hash": emit("catalog.json", build_catalog(repo, stats, version))}
+    shape_index = build_shape_index(repo)
+    shapes = {"file": "shapes.json", "hash": emit("shapes.json", shape_index)}
+    days = {}
+    files = {}
+    by_trips: Dict[bytes, str] = {}
+    for date in service_dates(repo):
+        trips = repo.trips_on(date)
+        key = hashlib.sha1(memoryview(trips).cast('B')).digest()
+        if key not in by_trips:
+            name = f"day-{len(files):04d}.json"
+            files[name] = emit(name, build_day(repo, date, shape_index))
+            by_trips[key] = name
+        days[date] = by_trips[key]
+
+    os.rename(vdir, root / build)
+    previous = slices_dir(load_index(out_dir))
+    index = {
+        "version": version,
+        "dir": build,
+        "format": SLICES_FORMAT,
+        "generated_at": datetime.now().isoformat(),
+        "encodings": [enc for enc in ENCODING_SUFFIXES if enc != 'br' or brotli is not None],
+        "catalog": catalog,
+        "shapes": shapes,
+        "days": days,
+        "files": files,
+    }
+    tmp = root / f"{INDEX_FILE}.tmp"
+    tmp.write_text(json.dumps(index, separators=(',', ':')), encoding='utf-8')
+    os.replace(tmp, root / INDEX_FILE)
+
+    # le vecchie build solo dopo la pubblicazione; le temporanee solo se abbandonate
+    for d in root.iterdir():
+        if not d.is_dir() or d.name in (build, previous):
+            continue
+        if not d.name.startswith('.') or time.time() - d.stat().st_mtime > STALE_BUILD_SECONDS:
+            shutil.rmtree(d, ignore_errors=True)
+    return {"days": len(days), "files": len(files) + 2, "bytes": totals}
+
+class SliceIndex:
+    """
+    Lato server: index.json delle fette, riletto quando un preprocess lo sostituisce.
+    Ogni voce è (file, etag, last_modified); l'etag lega il contenuto alla versione del dataset.
+    """
+    def __init__(self, out_dir):
+        self.root = Path(out_dir) / SLICES_DIR
+        self._stamp = None
+        self._index: dict = {}
+
+    def current(self) -> dict:
+        try:
+            stamp = (self.root / INDEX_FILE).stat().st_mtime_ns
+        except OSError:
+            return {}
+        if stamp != self._stamp:
+            index = load_index(self.root.parent)
+            # generated_at è in ora locale: Last-Modified va in UTC
+            index["_last_modified"] = (datetime.fromisoformat(index["generated_at"]).astimezone(timezone.utc)
+                                       if index else None)
+            self._index, self._stamp = index, stamp
+        return self._index
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.current().get('version')
+
+    def _entry(self, index: dict, name: str, content_hash: str):
+        return self.root / slices_dir(index) / name, f"{index['version']}-{content_hash}", index['_last_modified']
+
+    def catalog(self):
+        index = self.current()
+        if not index:
+            return None
+        return self._entry(index, index['catalog']['file'], index['catalog']['hash'])
+
+    def shapes(self):
+        index = self.current()
+        if 'shapes' not in index:
+            return None
+        return self._entry(index, index['shapes']['file'], index['shapes']['hash'])
+
+    def day(self, date: str):
+        index = self.current()
+        name = index.get('days', {}).get(date)
+        if name is None:
+            return None
+        return self._entry(index, name, index['files'][name])
+
+    @staticmethod
+    def variant(path: Path, accept_encodings) -> Tuple[Path, Optional[str]]:
+        """Variante precompressa migliore tra quelle accettate dal client (None = non compressa)."""
+        for enc, suffix in ENCODING_SUFFIXES.items():
+            if accept_encodings[enc] > 0:
+                candidate = path.with_name(path.name + suffix)
+                if candidate.exists():
+                    return candidate, enc
+        return path, None
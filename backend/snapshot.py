@@ -0,0 +1,321 @@
+"""
+Snapshot binario del dataset (gtfs-out/dataset.bin).
+
+Layout: magic, lunghezza dell'header, header JSON con dtype/shape/offset di ogni
+array, poi gli array a larghezza fissa allineati a 64 byte. Tutte le stringhe
+(id, nomi, orari, date) stanno in un'unica tabella interna (str_offsets + str_data)
+e gli array ne contengono gli indici. In lettura il file è mappato in memoria
+in sola lettura, quindi le pagine sono condivise tra i processi che lo aprono.
+"""
+import json
+import mmap
+import shutil
+import struct
+import tempfile
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+MAGIC = b"ORAORA\x00\x01"
+ALIGN = 64
+SNAPSHOT_FILE = "dataset.bin"
+
+class StringTable:
+    def __init__(self):
+        self.index: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def __call__(self, s) -> int:
+        s = str(s)
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.values)
+            self.values.append(s)
+        return i
+
+    def arrays(self):
+        encoded = [v.encode('utf-8') for v in self.values]
+        offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+class SnapshotWriter:
+    """
+    Scrittura a pezzi: trip e shape si aggiungono uno alla volta e le colonne grandi
+    (trip, stop_times, punti delle shape) vanno su file temporanei a blocchi, quindi la
+    memoria non cresce con il feed. Routes, stops e calendar arrivano interi (sono piccoli).
+    """
+    def __init__(self, path, calendar: Dict, buffer_rows: int = 1 << 16):
+        self.path = Path(path)
+        self.calendar = calendar
+        self.buffer_rows = buffer_rows
+        self.strings = StringTable()
+        self.service_ids = list(calendar)
+        self.service_pos = {s: i for i, s in enumerate(self.service_ids)}
+        self._tmp = tempfile.TemporaryDirectory(prefix="oraora-snapshot-")
+        self._columns: Dict[str, list] = {}     # nome -> [dtype, colonne extra, buffer, righe scritte]
+        self.n_trips = self.n_stop_times = self.n_shapes = self.n_points = 0
+
+    def _append(self, name: str, dtype: str, values, width: int = 0):
+        col = self._columns.get(name)
+        if col is None:
+            col = self._columns[name] = [dtype, width, [], 0]
+        col[2].extend(values)
+        if len(col[2]) >= self.buffer_rows:
+            self._flush(name)
+
+    def _flush(self, name: str):
+        dtype, width, buf, rows = self._columns[name]
+        if buf:
+            arr = np.asarray(buf, dtype=dtype)
+            with open(Path(self._tmp.name) / name, 'ab') as f:
+                f.write(arr.tobytes())
+            self._columns[name][3] = rows + (len(arr) if not width else len(arr) // width)
+            self._columns[name][2] = []
+
+    def add_trip(self, trip_id: str, trip: Dict):
+        strings = self.strings
+        service_id = trip['service_id']
+        if service_id not in self.service_pos:
+            self.service_pos[service_id] = len(self.service_ids)
+            self.service_ids.append(service_id)
+        self._append("trip_id", '<i4', (strings(trip_id),))
+        self._append("trip_route", '<i4', (strings(trip['route_id']),))
+        self._append("trip_shape", '<i4', (strings(trip['shape_id']),))
+        self._append("trip_service", '<i4', (self.service_pos[service_id],))
+        self._append("trip_headsign", '<i4', (strings(trip['headsign']),))
+        self._append("trip_departure", '<i4', (strings(trip['departure']),))
+        self._append("trip_arrival", '<i4', (strings(trip['arrival']),))
+        self._append("trip_duration", '<i4', (trip['duration_minutes'],))
+        self._append("trip_st_start", '<i8', (self.n_stop_times,))
+        self._append("trip_st_count", '<i4', (len(trip['stops']),))
+        self._append("st_stop", '<i4', [strings(st[0]) for st in trip['stops']])
+        self._append("st_dep", '<i4', [strings(st[1]) for st in trip['stops']])
+        self._append("st_arr", '<i4', [strings(st[2]) for st in trip['stops']])
+        self._append("st_seq", '<i4', [st[3] for st in trip['stops']])
+        self.n_trips += 1
+        self.n_stop_times += len(trip['stops'])
+
+    def add_shape(self, shape_id: str, coords):
+        self._append("shape_id", '<i4', (self.strings(shape_id),))
+        self._append("shape_pt_start", '<i8', (self.n_points,))
+        self._append("shape_pt_count", '<i4', (len(coords),))
+        self._append("shape_pts", '<f8', [v for pt in coords for v in pt], width=2)
+        self.n_shapes += 1
+        self.n_points += len(coords)
+
+    def close(self, routes: Dict, stops: Dict, meta: Dict = None):
+        strings = self.strings
+        arrays: Dict[str, np.ndarray] = {}
+
+        def i4(values):
+            return np.asarray(values, dtype='<i4')
+
+        arrays["route_id"] = i4([strings(r) for r in routes])
+        for field in ("short", "long", "color", "type", "mode"):
+            arrays[f"route_{field}"] = i4([strings(r.get(field, '')) for r in routes.values()])
+
+        arrays["stop_id"] = i4([strings(s) for s in stops])
+        arrays["stop_name"] = i4([strings(s['name']) for s in stops.values()])
+        arrays["stop_full_name"] = i4([strings(s['full_name']) for s in stops.values()])
+        arrays["stop_lat"] = np.asarray([s['lat'] for s in stops.values()], dtype='<f8')
+        arrays["stop_lon"] = np.asarray([s['lon'] for s in stops.values()], dtype='<f8')
+
+        cal_date, cal_exc, svc_start, svc_count = [], [], [], []
+        for service_id in self.service_ids:
+            dates = self.calendar.get(service_id, {})
+            svc_start.append(len(cal_date))
+            svc_count.append(len(dates))
+            for date, exception_type in dates.items():
+                cal_date.append(strings(date))
+                cal_exc.append(exception_type)
+        arrays["svc_id"] = i4([strings(s) for s in self.service_ids])
+        arrays["svc_cal_start"] = np.asarray(svc_start, dtype='<i8')
+        arrays["svc_cal_count"] = i4(svc_count)
+        arrays["cal_date"] = i4(cal_date)
+        arrays["cal_exc"] = np.asarray(cal_exc, dtype='i1')
+
+        # colonne su file: (dtype, shape, percorso); quelle mai scritte restano vuote
+        spilled = {}
+        for name, dtype, width in SPILLED_COLUMNS:
+            if name in self._columns:
+                self._flush(name)
+                rows = self._columns[name][3]
+            else:
+                rows = 0
+            spilled[name] = (np.dtype(dtype), [rows, width] if width else [rows], Path(self._tmp.name) / name)
+
+        arrays["str_offsets"], arrays["str_data"] = strings.arrays()
+
+        header = {"version": 1, "meta": meta or {}, "arrays": {}}
+        # gli offset dipendono dalla lunghezza dell'header: si calcolano relativi all'area dati
+        offset = 0
+        layout = [(name, arr.dtype, list(arr.shape)) for name, arr in arrays.items()]
+        layout += [(name, dtype, shape) for name, (dtype, shape, _) in spilled.items()]
+        for name, dtype, shape in layout:
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            header["arrays"][name] = {"dtype": dtype.str, "shape": shape, "offset": offset}
+            offset += -(-nbytes // ALIGN) * ALIGN
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGN) * ALIGN
+
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            for name, arr in arrays.items():
+                f.seek(data_start + header["arrays"][name]["offset"])
+                f.write(np.ascontiguousarray(arr).tobytes())
+            for name, (_, shape, path) in spilled.items():
+                f.seek(data_start + header["arrays"][name]["offset"])
+                if shape[0]:
+                    with open(path, 'rb') as src:
+                        shutil.copyfileobj(src, f, 1 << 20)
+            f.truncate(data_start + offset)
+        tmp.replace(self.path)
+        self._tmp.cleanup()
+
+SPILLED_COLUMNS = (
+    ("trip_id", '<i4', 0), ("trip_route", '<i4', 0), ("trip_shape", '<i4', 0), ("trip_service", '<i4', 0),
+    ("trip_headsign", '<i4', 0), ("trip_departure", '<i4', 0), ("trip_arrival", '<i4', 0),
+    ("trip_duration", '<i4', 0), ("trip_st_start", '<i8', 0), ("trip_st_count", '<i4', 0),
+    ("st_stop", '<i4', 0), ("st_dep", '<i4', 0), ("st_arr", '<i4', 0), ("st_seq", '<i4', 0),
+    ("shape_id", '<i4', 0), ("shape_pt_start", '<i8', 0), ("shape_pt_count", '<i4', 0), ("shape_pts", '<f8', 2),
+)
+
+def write_snapshot(path, routes: Dict, shapes: Dict, stops: Dict, timetable: Dict, calendar: Dict,
+                   meta: Dict = None):
+    """Scrive il dataset già convertito (gli stessi dict dei JSON) in formato binario."""
+    writer = SnapshotWriter(path, calendar)
+    for trip_id, trip in timetable.items():
+        writer.add_trip(trip_id, trip)
+    for shape_id, coords in shapes.items():
+        writer.add_shape(shape_id, coords)
+    writer.close(routes, stops, meta)
+
+def read_meta(path) -> Dict:
+    """meta dell'header senza mappare il file ({} se manca o non è uno snapshot valido)."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(len(MAGIC) + 8)
+            if len(head) < len(MAGIC) + 8 or head[:len(MAGIC)] != MAGIC:
+                return {}
+            (header_len,) = struct.unpack_from('<Q', head, len(MAGIC))
+            return json.loads(f.read(header_len).decode('utf-8')).get("meta", {})
+    except (OSError, ValueError):
+        return {}
+
+class Snapshot:
+    """Array del file mappati in memoria (sola lettura, nessuna copia)."""
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} non è uno snapshot valido")
+        (header_len,) = struct.unpack_from('<Q', self._mm, len(MAGIC))
+        header_end = len(MAGIC) + 8 + header_len
+        header = json.loads(self._mm[len(MAGIC) + 8:header_end].decode('utf-8'))
+        data_start = -(-header_end // ALIGN) * ALIGN
+
+        self.meta = header.get("meta", {})
+        self.arrays: Dict[str, np.ndarray] = {}
+        for name, spec in header["arrays"].items():
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(spec["shape"])) if spec["shape"] else 1
+            arr = np.frombuffer(self._mm, dtype=dtype, count=count, offset=data_start + spec["offset"])
+            self.arrays[name] = arr.reshape(spec["shape"])
+        self._str_offsets = self.arrays["str_offsets"]
+        self._str_data = self.arrays["str_data"]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def string(self, i: int) -> str:
+        return self._str_data[self._str_offsets[i]:self._str_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def strings(self, idx) -> List[str]:
+        return [self.string(i) for i in np.asarray(idx).tolist()]
+
+class SnapshotTimetable(Mapping):
+    """timetable.json come vista pigra: il dict del trip si costruisce solo quando richiesto."""
+    def __init__(self, snap: Snapshot, trip_ids: List[str]):
+        self.snap = snap
+        self._ids = trip_ids
+        self._pos = {t: i for i, t in enumerate(trip_ids)}
+
+    def __getitem__(self, trip_id):
+        i = self._pos[trip_id]
+        a, s = self.snap.arrays, self.snap.string
+        start, count = int(a["trip_st_start"][i]), int(a["trip_st_count"][i])
+        sl = slice(start, start + count)
+        stops = [[s(stop), s(dep), s(arr), seq] for stop, dep, arr, seq in
+                 zip(a["st_stop"][sl].tolist(), a["st_dep"][sl].tolist(), a["st_arr"][sl].tolist(),
+                     a["st_seq"][sl].tolist())]
+        return {
+            "route_id": s(int(a["trip_route"][i])),
+            "shape_id": s(int(a["trip_shape"][i])),
+            "service_id": s(int(a["svc_id"][a["trip_service"][i]])),
+            "departure": s(int(a["trip_departure"][i])),
+            "arrival": s(int(a["trip_arrival"][i])),
+            "headsign": s(int(a["trip_headsign"][i])),
+            "duration_minutes": int(a["trip_duration"][i]),
+            "stops": stops,
+            "stop_count": count
+        }
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, trip_id):
+        return trip_id in self._pos
+
+class SnapshotShapes(Mapping):
+    def __init__(self, snap: Snapshot):
+        self.snap = snap
+        self._ids = snap.strings(snap["shape_id"])
+        self._pos = {s: i for i, s in enumerate(self._ids)}
+
+    def __getitem__(self, shape_id):
+        i = self._pos[shape_id]
+        start = int(self.snap["shape_pt_start"][i])
+        return self.snap["shape_pts"][start:start + int(self.snap["shape_pt_count"][i])].tolist()
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, shape_id):
+        return shape_id in self._pos
+
+class SnapshotCalendar(Mapping):
+    def __init__(self, snap: Snapshot):
+        self.snap = snap
+        self._ids = snap.strings(snap["svc_id"])
+        # i servizi usati solo dai trip (senza date) non compaiono in calendar.json
+        counts = snap["svc_cal_count"]
+        self._pos = {s: i for i, s in enumerate(self._ids) if counts[i] > 0}
+
+    def __getitem__(self, service_id):
+        i = self._pos[service_id]
+        start = int(self.snap["svc_cal_start"][i])
+        sl = slice(start, start + int(self.snap["svc_cal_count"][i]))
+        dates = self.snap.strings(self.snap["cal_date"][sl])
+        return dict(zip(dates, self.snap["cal_exc"][sl].tolist()))
+
+    def __iter__(self):
+        return iter(self._pos)
+
+    def __len__(self):
+        return len(self._pos)
+
+    def __contains__(self, service_id):
+        return service_id in self._pos
@@ -0,0 +1,207 @@
+"""
+Posizioni di tutti i mezzi in circolazione a un dato istante, per /vehicles.
+
+Per ogni data di servizio si costruisce (alla prima richiesta, poi in cache) un indice a
+intervalli sulle finestre [prima partenza, ultimo arrivo] dei trip attivi: ordinate per
+inizio, i trip in corso all'istante t stanno tra gli inizi in [t - durata massima, t], quindi
+bastano due ricerche binarie invece di guardare tutti i trip. Insieme all'indice si tengono
+le tracce dei trip (orari alle fermate e distanza lungo la shape di ciascuna fermata): la
+posizione è un'interpolazione lineare nel tempo, poi lungo la shape.
+"""
+import bisect
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from departures import previous_day
+from gtfs_repo import GTFSRepository
+from shapes import cumulative_distance, to_meters
+
+DAY_SECONDS = 24 * 3600
+# date con indice e tracce in memoria, istanti con la risposta già calcolata
+DAY_CACHE_SIZE = 4
+SNAPSHOT_CACHE_SIZE = 256
+
+@dataclass(frozen=True)
+class Geometry:
+    """Shape (o fermate in fila, se il trip non ha shape) con le distanze progressive in metri."""
+    coords: np.ndarray   # (n, 2) lat, lon
+    xy: np.ndarray       # (n, 2) metri, con to_meters(coords, ref_lat)
+    dist: np.ndarray     # (n,)
+    ref_lat: float
+
+    @classmethod
+    def of(cls, coords) -> "Geometry":
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        ref_lat = float(coords[:, 0].mean())
+        xy = to_meters(coords, ref_lat)
+        return cls(coords, xy, cumulative_distance(xy), ref_lat)
+
+@dataclass(frozen=True)
+class Track:
+    """Orari (secondi) e distanze lungo la geometria alle fermate di un trip."""
+    arr: List[int]
+    dep: List[int]
+    dist: List[float]
+    stops: List[int]
+    geometry: Geometry
+
+    def position(self, t: float) -> Tuple[float, int, bool]:
+        """(distanza lungo la geometria, indice dell'ultima fermata passata, fermo in stazione)."""
+        k = bisect.bisect_right(self.arr, t) - 1   # ultima fermata raggiunta
+        if k < 0:
+            return self.dist[0], 0, True
+        if k == len(self.arr) - 1 or t <= self.dep[k]:
+            return self.dist[k], k, True
+        span = self.arr[k + 1] - self.dep[k]
+        frac = (t - self.dep[k]) / span if span > 0 else 1.0
+        return self.dist[k] + (self.dist[k + 1] - self.dist[k]) * frac, k, False
+
+@dataclass
+class DayIndex:
+    """Indice a intervalli di una data di servizio: trip ordinati per inizio della finestra."""
+    start: np.ndarray
+    end: np.ndarray
+    trips: np.ndarray
+    max_duration: int
+    tracks: Dict[int, Track]
+
+    def active(self, t: float) -> np.ndarray:
+        lo = int(np.searchsorted(self.start, t - self.max_duration, 'left'))
+        hi = int(np.searchsorted(self.start, t, 'right'))
+        sel = np.arange(lo, hi)
+        return self.trips[sel[self.end[sel] >= t]]
+
+def _bearing(a: np.ndarray, b: np.ndarray) -> Optional[int]:
+    dx, dy = float(b[0] - a[0]), float(b[1] - a[1])
+    if dx == 0 and dy == 0:
+        return None
+    return int(round(math.degrees(math.atan2(dx, dy)))) % 360
+
+class VehicleIndex:
+    def __init__(self, repo: GTFSRepository):
+        self.repo = repo
+        self._geometries: Dict[str, Geometry] = {}
+        self._tracks: Dict[int, Optional[Track]] = {}
+        self._days: "OrderedDict[str, DayIndex]" = OrderedDict()
+        self._snapshots: "OrderedDict[Tuple[str, int], Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- tracce dei trip ---
+
+    def _geometry(self, shape_id: Optional[str], stops: List[int]) -> Geometry:
+        shape = self.repo.shapes[shape_id] if shape_id and shape_id in self.repo.shapes else None
+        if shape is None or len(shape) < 2:
+            # senza shape: linea spezzata tra le fermate
+            return Geometry.of([self._stop_coords(s) for s in stops])
+        geometry = self._geometries.get(shape_id)
+        if geometry is None:
+            geometry = self._geometries[shape_id] = Geometry.of(shape)
+        return geometry
+
+    def _stop_coords(self, s: int) -> List[float]:
+        stop = self.repo.stops.get(self.repo.stop_ids[s], {})
+        return [stop.get('lat', 0.0), stop.get('lon', 0.0)]
+
+    def _build_track(self, g: int) -> Optional[Track]:
+        stops, deps, arrs = self.repo.trip_schedule(g)
+        # orari mancanti: si usa l'altro della stessa fermata, le fermate senza orari si saltano
+        rows = [(s, (a if a is not None else d) * 60, (d if d is not None else a) * 60)
+                for s, d, a in zip(stops, deps, arrs) if a is not None or d is not None]
+        if len(rows) < 2:
+            return None
+        stops = [r[0] for r in rows]
+        trip = self.repo.timetable[self.repo.trip_ids[g]]
+        geometry = self._geometry(trip.get('shape_id'), stops)
+
+        # proiezione in avanti: ogni fermata sul punto più vicino dopo quello della precedente
+        stop_xy = to_meters([self._stop_coords(s) for s in stops], geometry.ref_lat)
+        dist, start = [], 0
+        for p in stop_xy:
+            start += int(np.hypot(*(geometry.xy[start:] - p).T).argmin())
+            dist.append(float(geometry.dist[start]))
+        return Track(arr=[r[1] for r in rows], dep=[r[2] for r in rows], dist=dist, stops=stops, geometry=geometry)
+
+    def track(self, g: int) -> Optional[Track]:
+        if g not in self._tracks:
+            self._tracks[g] = self._build_track(g)
+        return self._tracks[g]
+
+    # --- indice per data ---
+
+    def day(self, date: str) -> DayIndex:
+        with self._lock:
+            index = self._days.get(date)
+            if index is not None:
+                self._days.move_to_end(date)
+                return index
+        tracks = {}
+        for g in self.repo.trips_on(date):
+            track = self.track(g)
+            if track is not None:
+                tracks[g] = track
+        trips = np.fromiter(tracks, dtype=np.int64, count=len(tracks))
+        start = np.fromiter((tracks[g].dep[0] for g in tracks), dtype=np.int64, count=len(tracks))
+        end = np.fromiter((tracks[g].arr[-1] for g in tracks), dtype=np.int64, count=len(tracks))
+        order = np.argsort(start, kind='stable')
+        index = DayIndex(start=start[order], end=end[order], trips=trips[order],
+                         max_duration=int((end - start).max()) if len(tracks) else 0, tracks=tracks)
+        with self._lock:
+            self._days[date] = index
+            while len(self._days) > DAY_CACHE_SIZE:
+                self._days.popitem(last=False)
+        return index
+
+    # --- posizioni ---
+
+    def _vehicle(self, g: int, track: Track, t: float, service_date: str) -> Dict:
+        d, k, stopped = track.position(t)
+        geo = track.geometry
+        i = min(max(int(np.searchsorted(geo.dist, d, 'right')) - 1, 0), len(geo.dist) - 2)
+        seg = geo.dist[i + 1] - geo.dist[i]
+        frac = (d - geo.dist[i]) / seg if seg > 0 else 0.0
+        lat, lon = geo.coords[i] + (geo.coords[i + 1] - geo.coords[i]) * frac
+        route_id = self.repo.route_ids[self.repo.trip_route[g]]
+        route = self.repo.routes.get(route_id, {})
+        total = track.dist[-1] - track.dist[0]
+        return {
+            "trip_id": self.repo.trip_ids[g],
+            "route_id": route_id,
+            "route_short": route.get('short', ''),
+            "mode": route.get('mode', 'train'),
+            "service_date": service_date,
+            "lat": round(float(lat), 6),
+            "lon": round(float(lon), 6),
+            "bearing": _bearing(geo.xy[i], geo.xy[i + 1]),
+            "status": "stopped" if stopped else "in_transit",
+            "last_stop_id": self.repo.stop_ids[track.stops[k]],
+            "next_stop_id": self.repo.stop_ids[track.stops[k + 1]] if k + 1 < len(track.stops) else None,
+            "progress": round((d - track.dist[0]) / total, 4) if total > 0 else 0.0,
+        }
+
+    def vehicles(self, date: str, seconds: int) -> Dict:
+        """
+        Mezzi in circolazione nella data all'istante `seconds` dalla mezzanotte, comprese le corse
+        del giorno di servizio precedente oltre la mezzanotte.
+        """
+        key = (date, seconds)
+        with self._lock:
+            cached = self._snapshots.get(key)
+            if cached is not None:
+                self._snapshots.move_to_end(key)
+                return cached
+        out = []
+        for service_date, t in ((previous_day(date), seconds + DAY_SECONDS), (date, seconds)):
+            index = self.day(service_date)
+            for g in index.active(t).tolist():
+                out.append(self._vehicle(g, index.tracks[g], t, service_date))
+        snapshot = {"count": len(out), "vehicles": out}
+        with self._lock:
+            self._snapshots[key] = snapshot
+            while len(self._snapshots) > SNAPSHOT_CACHE_SIZE:
+                self._snapshots.popitem(last=False)
+        return snapshot
@@ -0,0 +1,13 @@
+"""
+Entry point WSGI per la produzione:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Con preload_app (vedi gunicorn.conf.py) app.py viene importato una volta nel master: il
+preprocess incrementale e il caricamento del dataset avvengono prima del fork e i worker
+condividono repository e planner in copy-on-write. Le pagine di dataset.bin, aperto in mmap
+in sola lettura, stanno comunque nella page cache comune a tutti i processi.
+"""
+from app import app
+
+application = app
@@ -5,35 +5,40 @@ const DataManager = {
     shapes: null,
     stops: null,
     timetable: null,
-    calendar: null,
     stats: null,
 
+    // catalogo: versione del dataset, date di servizio e sequenze di fermate per linea
+    version: null,
+    dates: [],
+    patterns: [],
+    // data -> Set degli id dei trip attivi, per le date già scaricate
+    days: {},
+    _dayRequests: {},
+
 
     async loadData() {
         try {
-            Utils.log('Caricamento dati GTFS...');
-            
-            const [routesData, shapesData, stopsData, timetableData, calendarData, statsData] = await Promise.all([
-                this.fetchJSON('routes.json'),
-                this.fetchJSON('shapes.json'),
-                this.fetchJSON('stops.json'),
-                this.fetchJSON('timetable.json'),
-                this.fetchJSON('calendar.json', true),
-                this.fetchJSON('stats.json', true)
-            ]);
-
-            this.routes = routesData;
-            this.shapes = shapesData;
-            this.stops = stopsData;
-            this.timetable = timetableData;
-            this.calendar = calendarData || {};
-            this.stats = statsData || {};
-
-            Utils.log('Dati GTFS caricati:', {
+            Utils.log('Caricamento catalogo GTFS...');
+
+            const catalog = await this.fetchJSON('catalog');
+
+            this.routes = catalog.routes;
+            this.stops = catalog.stops;
+            this.stats = catalog.stats || {};
+            this.version = catalog.version;
+            this.dates = catalog.dates;
+            this.patterns = catalog.patterns;
+            // trip e shape arrivano una data alla volta con loadDay
+            this.timetable = {};
+            this.shapes = {};
+            this.days = {};
+            this._dayRequests = {};
+
+            Utils.log('Catalogo GTFS caricato:', {
                 routes: Object.keys(this.routes).length,
-                shapes: Object.keys(this.shapes).length,
                 stops: Object.keys(this.stops).length,
-                trips: Object.keys(this.timetable).length
+                dates: this.dates.length,
+                patterns: this.patterns.length
             });
 
             return true;
@@ -43,6 +48,29 @@ const DataManager = {
         }
     },
 
+    /**
+     * Scarica (una volta sola) i trip attivi nella data e le loro shape.
+     * L'URL porta la versione del catalogo: il browser la tiene in cache finché il dataset non cambia.
+     */
+    loadDay(date) {
+        if (!date) return Promise.resolve(false);
+        if (!this._dayRequests[date]) {
+            this._dayRequests[date] = this.fetchJSON(`day/${date}?v=${this.version}`, true)
+                .then(day => {
+                    const trips = (day && day.trips) || {};
+                    Object.assign(this.timetable, trips);
+                    Object.assign(this.shapes, (day && day.shapes) || {});
+                    this.days[date] = new Set(Object.keys(trips));
+                    return true;
+                })
+                .catch(error => {
+                    delete this._dayRequests[date];
+                    throw error;
+                });
+        }
+        return this._dayRequests[date];
+    },
+
     async fetchJSON(filename, optional = false) {
         try {
             const response = await fetch(this.DATA_URL + filename);
@@ -70,8 +98,15 @@ const DataManager = {
         return this.stops[stopId] || null;
     },
 
+    /**
+     * Coordinate della shape: nelle fette arriva come encoded polyline, decodificata al primo uso.
+     */
     getShape(shapeId) {
-        return this.shapes[shapeId] || null;
+        let shape = this.shapes[shapeId];
+        if (typeof shape === 'string') {
+            shape = this.shapes[shapeId] = Utils.decodePolyline(shape);
+        }
+        return shape || null;
     },
 
     getTrip(tripId) {
@@ -91,6 +126,9 @@ const DataManager = {
             .map(([id, trip]) => ({ id, ...trip }));
     },
 
+    getPatternsForRoute(routeId) {
+        return this.patterns.filter(p => p.route_id === routeId);
+    },
 
     getAllStops() {
         return Object.entries(this.stops || {}).map(([id, s]) => ({ id, ...s }));
@@ -112,13 +150,10 @@ const DataManager = {
      * Tutte le fermate toccate da QUALSIASI trip della route
      */
     getOriginsForRoute(routeId) {
-        const trips = this.getTripsForRoute(routeId);
         const origins = new Map();
 
-        trips.forEach(trip => {
-            if (!trip.stops) return;
-            trip.stops.forEach(st => {
-                const stopId = st[0];
+        this.getPatternsForRoute(routeId).forEach(pattern => {
+            pattern.stops.forEach(stopId => {
                 const stop = this.getStop(stopId);
                 if (stop) {
                     origins.set(stopId, stop);
@@ -135,17 +170,16 @@ const DataManager = {
      * Tutte le fermate raggiungibili DOPO originId (all'interno di ogni trip della route)
      */
     getDestinationsFromOrigin(routeId, originId) {
-        const trips = this.getTripsForRoute(routeId);
         const destinations = new Map();
 
-        trips.forEach(trip => {
-            if (!trip.stops || trip.stops.length < 2) return;
+        this.getPatternsForRoute(routeId).forEach(pattern => {
+            if (pattern.stops.length < 2) return;
 
-            const idxOrigin = trip.stops.findIndex(s => s[0] === originId);
+            const idxOrigin = pattern.stops.indexOf(originId);
             if (idxOrigin === -1) return;
 
-            for (let i = idxOrigin + 1; i < trip.stops.length; i++) {
-                const stopId = trip.stops[i][0];
+            for (let i = idxOrigin + 1; i < pattern.stops.length; i++) {
+                const stopId = pattern.stops[i];
                 const stop = this.getStop(stopId);
                 if (stop) destinations.set(stopId, stop);
             }
@@ -160,27 +194,16 @@ const DataManager = {
      * Ritorna le date in cui c'è almeno un trip che passa da originId a destinationId (origin prima di destination)
      */
     getAvailableDates(routeId, originId, destinationId) {
-        const trips = this.getTripsForRoute(routeId);
         const dates = new Set();
 
-        trips.forEach(trip => {
-            if (!trip.stops || trip.stops.length < 2) return;
+        this.getPatternsForRoute(routeId).forEach(pattern => {
+            if (pattern.stops.length < 2) return;
 
-            const { idxO, idxD } = this._findIndicesInTrip(trip, originId, destinationId);
+            const idxO = pattern.stops.indexOf(originId);
+            const idxD = pattern.stops.lastIndexOf(destinationId);
             if (idxO === -1 || idxD === -1 || idxD <= idxO) return;
 
-            if (trip.service_dates) {
-                Object.entries(trip.service_dates).forEach(([date, active]) => {
-                    if (active === 1) dates.add(date);
-                });
-            }
-
-            const cal = this.calendar[trip.service_id];
-            if (cal) {
-                Object.entries(cal).forEach(([date, exceptionType]) => {
-                    if (exceptionType === 1) dates.add(date);
-                });
-            }
+            pattern.dates.forEach(i => dates.add(this.dates[i]));
         });
 
         return Array.from(dates).sort();
@@ -189,28 +212,26 @@ const DataManager = {
     /**
      * Trips che coprono originId -> destinationId (origin prima di destination) nel giorno richiesto.
      * Ordina per orario di partenza reale dall'origine (non per la prima fermata del trip).
+     * La data deve essere già stata scaricata con loadDay.
      */
     getTripsForCriteria(routeId, originId, destinationId, date) {
-        const trips = this.getTripsForRoute(routeId);
+        const active = this.days[date];
         const result = [];
+        if (!active) return result;
 
-        trips.forEach(trip => {
+        active.forEach(id => {
+            const trip = this.timetable[id];
+            if (!trip || trip.route_id !== routeId) return;
             if (!trip.stops || trip.stops.length < 2) return;
 
             const { idxO, idxD } = this._findIndicesInTrip(trip, originId, destinationId);
             if (idxO === -1 || idxD === -1 || idxD <= idxO) return;
 
-            // attivo nel giorno
-            let active = false;
-            if (trip.service_dates && trip.service_dates[date] === 1) active = true;
-            const cal = this.calendar[trip.service_id];
-            if (!active && cal && cal[date] === 1) active = true;
-            if (!active) return;
-
             const depFromOrigin = trip.stops[idxO][1]; // orario di partenza dalla fermata origin
             const arrToDest = trip.stops[idxD][2];     // orario di arrivo alla fermata destinazione
 
             result.push({
+                id,
                 ...trip,
                 _dep_from_origin: depFromOrigin,
                 _arr_to_destination: arrToDest,
@@ -245,8 +266,12 @@ const DataManager = {
             return shape;
         }
 
-        const i1 = Utils.nearestIndexOnShape(shape, oStop.lat, oStop.lon);
-        const i2 = Utils.nearestIndexOnShape(shape, dStop.lat, dStop.lon);
+        // punti della shape delle fermate, calcolati nel preprocess (shape_points nelle fette)
+        const points = trip.shape_points || [];
+        let i1 = points[idxO] ?? -1;
+        let i2 = points[idxD] ?? -1;
+        if (i1 === -1) i1 = Utils.nearestIndexOnShape(shape, oStop.lat, oStop.lon);
+        if (i2 === -1) i2 = Utils.nearestIndexOnShape(shape, dStop.lat, dStop.lon);
 
         let segment;
         if (i1 <= i2) {
@@ -82,6 +82,8 @@ const PlanningManager = {
         return;
       }
       
+      // trip e shape delle tratte servono alla mappa: arrivano con la fetta della data
+      await DataManager.loadDay(date);
       const processedLegs = this.processLegsForVisualization(data.legs || []);
       
       this.renderPlan(data, processedLegs);
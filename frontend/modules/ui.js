@@ -114,12 +114,19 @@ const UIManager = {
         this.updateStatusPanel();
     },
 
-    selectDate(date) {
+    async selectDate(date) {
         Utils.log('Selezione data:', date);
         
         this.selectedDate = date;
 
         this.resetFromTime();
+        try {
+            await DataManager.loadDay(date);
+        } catch (error) {
+            Utils.error('Errore caricamento viaggi del giorno', error);
+        }
+        // nel frattempo l'utente può aver cambiato selezione
+        if (this.selectedDate !== date) return;
         this.populateTimes();
         this.updateStatusPanel();
     },
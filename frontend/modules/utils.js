@@ -89,6 +89,29 @@ Utils.haversine = function(lat1, lon1, lat2, lon2) {
   return 2 * R * Math.atan2(Math.sqrt(a), Math.sqrt(1 - a));
 };
 
+/**
+ * Decodifica una encoded polyline (precisione 1e-5) in [[lat, lon], ...]
+ */
+Utils.decodePolyline = function(encoded, precision = 5) {
+  const factor = 10 ** precision;
+  const coords = [];
+  let index = 0, lat = 0, lon = 0;
+  while (index < encoded.length) {
+    for (let k = 0; k < 2; k++) {
+      let shift = 0, result = 0, b;
+      do {
+        b = encoded.charCodeAt(index++) - 63;
+        result |= (b & 0x1f) << shift;
+        shift += 5;
+      } while (b >= 0x20);
+      const delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+      if (k === 0) lat += delta; else lon += delta;
+    }
+    coords.push([lat / factor, lon / factor]);
+  }
+  return coords;
+};
+
 /**
  * Ritorna l'indice del punto della shape più vicino a (lat, lon)
  */